@@ -2,15 +2,32 @@ import os
 import re
 import json
 import glob
-import fastremap
+import shutil
+import hashlib
+import argparse
 import numpy as np
 import SimpleITK as sitk
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 nrrds_dir = "/home/paul/projects/orthovis/ankle-data/split-and-curated"
 datasets_dir = f"/home/paul/projects/orthovis/ankle-data/nnUNet_raw"
 
+# One dataset per label variant; both share the same CT images
+dataset_names = {
+    "binary": "Dataset001_Ankle_Binary",
+    "multiclass": "Dataset002_Ankle_Multiclass",
+}
+
+# gzip level for the written NIfTI files (1 is fastest, 9 smallest), and what compresses them: 'itk' (SimpleITK's
+# writer), 'gzip' (Python's) or 'isal' (python-isal's igzip, much faster but only levels 0-3; pip install isal)
+compression_level = 1
+compression_backend = "itk"
+
+# Kept in datasets_dir: each leg's case id, source file hashes and the conversion parameters, so re-runs only convert
+# new or changed legs and case ids never change
+manifest_file_name = "conversion_manifest.json"
+
 bone_name_to_label = {
     "tibia": 1,
     "fibula": 2,
@@ -48,85 +65,302 @@ def get_legs():
     return annotated_legs, unannotated_legs
 
 
-def relabel(seg_nrrd, binary_or_multiclass):
-    seg_arr = sitk.GetArrayFromImage(seg_nrrd)
+def get_segments(seg_nrrd):
+    """
+    Read a Slicer segmentation's segment metadata.
+
+    Returns:
+        dict mapping layer to dict mapping label value (in that layer) to instance label, and dict mapping instance
+        label to bone name; instance labels are the label values for single-layer segmentations, and numbered from 1
+        in segment order for multi-layer ones
+    """
     ids = [int(key.split('_')[0][7:]) for key in seg_nrrd.GetMetaDataKeys() if re.match(r'Segment\d+_LabelValue', key)]
     assert len(ids) == len(set(ids)), 'Duplicate IDs found'
 
+    layer_to_value_to_label = {}
     label_to_bone = {}
+    multi_layer = seg_nrrd.GetNumberOfComponentsPerPixel() > 1
+    for N in ids:
+        layer_id = int(seg_nrrd.GetMetaData(f'Segment{N}_Layer')) if multi_layer else 0
+        label_value = int(seg_nrrd.GetMetaData(f'Segment{N}_LabelValue'))
+        seg_name = seg_nrrd.GetMetaData(f'Segment{N}_Name').replace(' ', '_')
+        if multi_layer:
+            label = len(label_to_bone) + 1
+        else:
+            print(f'{label_value}: {seg_name}')
+            label = label_value
+        layer_to_value_to_label.setdefault(layer_id, {})[label_value] = label
+        label_to_bone[label] = seg_name.split('_')[0]
+
+    if len(label_to_bone) == 0:  # probably a whole-body crop; hopefully labels are already good
+        assert not multi_layer
+        layer_to_value_to_label = {0: {label: label for label in bone_name_to_label.values()}}
+        label_to_bone = {label: bone for bone, label in bone_name_to_label.items()}
+    return layer_to_value_to_label, label_to_bone
+
+
+def get_lookup_table(value_to_label, dtype, unknown_label, label_dtype):
+    # Indexed by a layer's voxels (viewed as unsigned): every possible value for 8- and 16-bit segmentations, otherwise
+    # up to the largest known value plus one, with larger values clipped to that last entry; all values not in
+    # value_to_label (besides 0) give unknown_label
+    num_values = 2 ** (8 * dtype.itemsize) if dtype.itemsize <= 2 else max(value_to_label, default=0) + 2
+    lookup_table = np.full(num_values, unknown_label, dtype=label_dtype)
+    lookup_table[0] = 0
+    for value, label in value_to_label.items():
+        lookup_table[np.asarray(value, dtype=dtype).view(lookup_table_index_dtype(dtype))] = label
+    return lookup_table
+
+
+def lookup_table_index_dtype(dtype):
+    return np.dtype(f'u{dtype.itemsize}')
+
+
+def relabel(seg_nrrd, variants=('binary', 'multiclass'), chunk_voxels=2 ** 24):
+    """
+    Map a Slicer segmentation's segments to our labels, for each of the label variants ('binary': bone vs
+    background; 'multiclass': see bone_name_to_label).
+
+    Both go through lookup tables built from the segment metadata, applied in one pass over the volume (chunk_voxels
+    at a time), which merges layers and maps to every variant at once, so memory beyond the segmentation itself is
+    the outputs (in the smallest dtype that fits) and a chunk's worth of temporaries.
+
+    Returns:
+        dict mapping variant to label image
+    """
+    layer_to_value_to_label, label_to_bone = get_segments(seg_nrrd)
+    variant_to_label_to_class = {}
+    for binary_or_multiclass in variants:
+        if binary_or_multiclass == 'binary':
+            variant_to_label_to_class[binary_or_multiclass] = {label: 1 for label in label_to_bone}
+        elif binary_or_multiclass == 'multiclass':
+            variant_to_label_to_class[binary_or_multiclass] = {label: bone_name_to_label[bone.lower()] for label, bone in label_to_bone.items()}
+        else:
+            assert False
+
+    # Voxels with label values not in the metadata get unknown_label, which is larger than all others, so survives
+    # merging layers and can be caught per chunk
+    unknown_label = max(label_to_bone) + 1
+    label_dtype = np.min_scalar_type(unknown_label)
+    seg_arr = sitk.GetArrayViewFromImage(seg_nrrd)  # no copy; valid while seg_nrrd is
     if seg_nrrd.GetNumberOfComponentsPerPixel() == 1:
         assert seg_arr.ndim == 3
-        for N in ids:
-            seg_id = seg_nrrd.GetMetaData(f'Segment{N}_LabelValue')
-            seg_name = seg_nrrd.GetMetaData(f'Segment{N}_Name').replace(' ', '_')
-            print(f'{seg_id}: {seg_name}')
-            label_to_bone[int(seg_id)] = seg_name.split('_')[0]
+        seg_arr = seg_arr[..., None]
     else:
-        # Slicer sometimes uses multiple layers, presumably due to overlaps; we merge these, arbitrarily favouring later layers
         assert seg_arr.ndim == 4
         assert seg_arr.shape[-1] == seg_nrrd.GetNumberOfComponentsPerPixel()
-        layer_to_label_to_new_label = defaultdict(lambda: {})
-        label_to_bone = {}
-        for N in ids:
-            layer_id = int(seg_nrrd.GetMetaData(f'Segment{N}_Layer'))
-            label_id = int(seg_nrrd.GetMetaData(f'Segment{N}_LabelValue'))
-            seg_name = seg_nrrd.GetMetaData(f'Segment{N}_Name').replace(' ', '_')
-            new_label = len(label_to_bone) + 1
-            layer_to_label_to_new_label[layer_id][label_id] = new_label
-            label_to_bone[new_label] = seg_name.split('_')[0]
-        new_seg = np.zeros_like(seg_arr[..., 0])
-        for layer_id, label_to_new_label in layer_to_label_to_new_label.items():
-            orig_layer = seg_arr[..., layer_id]
-            new_layer = fastremap.remap(orig_layer, {**label_to_new_label, 0: 0})
-            new_seg = np.maximum(new_seg, new_layer)
-        seg_arr = new_seg
+    index_dtype = lookup_table_index_dtype(seg_arr.dtype)
+    layer_to_lookup_table = {
+        layer_id: get_lookup_table(value_to_label, seg_arr.dtype, unknown_label, label_dtype)
+        for layer_id, value_to_label in layer_to_value_to_label.items()
+    }
+    variant_to_lookup_table = {}
+    for binary_or_multiclass, label_to_class in variant_to_label_to_class.items():
+        lookup_table = np.zeros(unknown_label + 1, dtype=np.min_scalar_type(max(label_to_class.values(), default=0)))
+        for label, class_label in label_to_class.items():
+            lookup_table[label] = class_label
+        variant_to_lookup_table[binary_or_multiclass] = lookup_table
 
-    if len(label_to_bone) == 0:  # probably a whole-body crop; hopefully labels are already good
-        assert seg_arr.min() == 0 and seg_arr.max() <= 4
-        label_to_bone = {label: bone for bone, label in bone_name_to_label.items()}
+    labels_remapped = {
+        binary_or_multiclass: np.empty(seg_arr.shape[:3], dtype=lookup_table.dtype)
+        for binary_or_multiclass, lookup_table in variant_to_lookup_table.items()
+    }
+    chunk_rows = max(chunk_voxels // int(np.prod(seg_arr.shape[1:3])), 1)
+    for start in range(0, seg_arr.shape[0], chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        # Slicer sometimes uses multiple layers, presumably due to overlaps; we merge these, keeping the larger
+        # (i.e. later segment's) label where they overlap
+        labels = None
+        for layer_id, lookup_table in layer_to_lookup_table.items():
+            values = seg_arr[rows, ..., layer_id].view(index_dtype)
+            if len(lookup_table) < 2 ** (8 * index_dtype.itemsize):
+                values = np.minimum(values, len(lookup_table) - 1)
+            layer_labels = np.take(lookup_table, values)
+            labels = layer_labels if labels is None else np.maximum(labels, layer_labels, out=labels)
+        if labels is None:  # no segments in any layer
+            labels = np.zeros(seg_arr[rows].shape[:3], dtype=label_dtype)
+        assert labels.max(initial=0) < unknown_label, f'Label values not found in the segment metadata, in rows {rows.start}-{min(rows.stop, seg_arr.shape[0])}'
+        for binary_or_multiclass, lookup_table in variant_to_lookup_table.items():
+            np.take(lookup_table, labels, out=labels_remapped[binary_or_multiclass][rows])
 
-    for label in fastremap.unique(seg_arr):
-        if label > 0:
-            assert label in label_to_bone, f'Label {label} not found in label_to_bone'
+    labels_remapped_imgs = {}
+    for binary_or_multiclass in variants:
+        labels_remapped_img = sitk.GetImageFromArray(labels_remapped.pop(binary_or_multiclass))
+        labels_remapped_img.CopyInformation(seg_nrrd)
+        labels_remapped_imgs[binary_or_multiclass] = labels_remapped_img
+    return labels_remapped_imgs
 
-    if binary_or_multiclass == 'binary':
-        instance_label_to_class_label = {0: 0, **{label: 1 for label in label_to_bone.keys()}}
-    elif binary_or_multiclass == 'multiclass':
-        instance_label_to_class_label = {
-            **{instance_label: bone_name_to_label[bone_name.lower()] for instance_label, bone_name in label_to_bone.items()},
-            0: 0
-        }
+
+def write_nifti(image, path, compression_level, compression_backend):
+    if compression_backend == 'itk':
+        sitk.WriteImage(image, path, useCompression=True, compressionLevel=compression_level)
+        return
+    if compression_backend == 'gzip':
+        import gzip as gzip_module
+    elif compression_backend == 'isal':
+        from isal import igzip as gzip_module  # optional, only needed for this backend
     else:
-        assert False
+        assert False, f'Unknown compression backend {compression_backend}'
+    # ITK writes uncompressed NIfTI for a .nii path, which we then stream through the compressor
+    uncompressed_path = path[:-len('.nii.gz')] + '.tmp.nii'
+    sitk.WriteImage(image, uncompressed_path)
+    with open(uncompressed_path, 'rb') as src, gzip_module.open(path, 'wb', compresslevel=compression_level) as dst:
+        shutil.copyfileobj(src, dst, 1024 ** 2)
+    os.remove(uncompressed_path)
+
+
+def link_or_copy(src_path, dst_path):
+    # Hard link where possible (same filesystem), so shared images take no extra space or write time
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+def convert_leg(leg, case_id, dataset_dirs, compression_level, compression_backend):
+    """
+    Convert one leg into every dataset, reading each file once: the CT is written to the first dataset and
+    hard-linked into the others, and the segmentation (if any; otherwise it's a test case) is relabelled for all
+    datasets' label variants in one pass.
 
-    labels_remapped = fastremap.remap(seg_arr, instance_label_to_class_label)
-    labels_remapped_img = sitk.GetImageFromArray(labels_remapped)
-    labels_remapped_img.CopyInformation(seg_nrrd)
-    return labels_remapped_img
+    Args:
+        dataset_dirs: dict mapping label variant ('binary' or 'multiclass') to dataset directory
+    """
+    images_dir = 'imagesTr' if 'seg_path' in leg else 'imagesTs'
+    ct_paths = [f"{dataset_dir}/{images_dir}/{case_id}_0000.nii.gz" for dataset_dir in dataset_dirs.values()]
+    write_nifti(sitk.ReadImage(leg["ct_path"]), ct_paths[0], compression_level, compression_backend)
+    for ct_path in ct_paths[1:]:
+        link_or_copy(ct_paths[0], ct_path)
 
+    if 'seg_path' in leg:
+        seg_imgs = relabel(sitk.ReadImage(leg["seg_path"]), list(dataset_dirs))
+        for binary_or_multiclass, dataset_dir in dataset_dirs.items():
+            write_nifti(seg_imgs[binary_or_multiclass], f"{dataset_dir}/labelsTr/{case_id}.nii.gz", compression_level, compression_backend)
+    return case_id
 
-def convert_legs(training_legs, testing_legs, dataset_dir, binarise):
-    # Convert and organize training cases
-    os.makedirs(f"{dataset_dir}/imagesTr", exist_ok=True)
-    os.makedirs(f"{dataset_dir}/labelsTr", exist_ok=True)
-    for i, leg in enumerate(training_legs):
-        case_id = f"ankle_{i:04d}"
-        ct_img = sitk.ReadImage(leg["ct_path"])
-        sitk.WriteImage(ct_img, f"{dataset_dir}/imagesTr/{case_id}_0000.nii.gz")
-        seg_img = sitk.ReadImage(leg["seg_path"])
-        seg_img = relabel(seg_img, 'binary' if binarise else 'multiclass')
-        sitk.WriteImage(seg_img, f"{dataset_dir}/labelsTr/{case_id}.nii.gz")
 
-        print(f"Processed training case {case_id}: {leg['dir']}")
+def init_worker():
+    # Cases are converted in parallel already, so ITK's own threads would only oversubscribe the CPUs
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
 
-    # Convert and organize testing cases
-    os.makedirs(f"{dataset_dir}/imagesTs", exist_ok=True)
-    for i, leg in enumerate(testing_legs):
-        case_id = f"ankle_{i + len(training_legs):04d}"
-        ct_img = sitk.ReadImage(leg["ct_path"])
-        sitk.WriteImage(ct_img, f"{dataset_dir}/imagesTs/{case_id}_0000.nii.gz")
 
-        print(f"Processed testing case {case_id}: {leg['dir']}")
+def convert_legs(cases, dataset_dirs, num_workers=None, compression_level=compression_level, compression_backend=compression_backend):
+    """
+    Convert legs into every dataset, in parallel.
+
+    Args:
+        cases: dict mapping case id to leg (as from get_legs)
+        dataset_dirs: dict mapping label variant to dataset directory
+
+    Yields:
+        case ids as they're done
+    """
+    for dataset_dir in dataset_dirs.values():
+        for sub_dir in ('imagesTr', 'labelsTr', 'imagesTs'):
+            os.makedirs(f"{dataset_dir}/{sub_dir}", exist_ok=True)
+
+    with ProcessPoolExecutor(num_workers, initializer=init_worker) as executor:
+        futures = {
+            executor.submit(convert_leg, leg, case_id, dataset_dirs, compression_level, compression_backend): case_id
+            for case_id, leg in cases.items()
+        }
+        for future in as_completed(futures):
+            case_id = future.result()
+            leg = cases[case_id]
+            print(f"Processed {'training' if 'seg_path' in leg else 'testing'} case {case_id}: {leg['dir']}")
+            yield case_id
+
+
+def hash_file(path, chunk_size=1024 ** 2):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_file_entry(path, previous_entry=None):
+    # Path, size, mtime and content hash of a source file; only re-hashed if any of the others changed
+    stat = os.stat(path)
+    if previous_entry is not None and (previous_entry.get('path'), previous_entry['size'], previous_entry['mtime_ns']) == (path, stat.st_size, stat.st_mtime_ns):
+        return previous_entry
+    return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': hash_file(path)}
+
+
+def get_conversion_params():
+    # Everything besides the source files that changes the converted cases
+    return {'bone_name_to_label': bone_name_to_label, 'dataset_names': dataset_names}
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {'params': None, 'next_case_idx': 0, 'legs': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def get_output_paths(case_id, annotated, dataset_dirs):
+    images_dir = 'imagesTr' if annotated else 'imagesTs'
+    paths = [f"{dataset_dir}/{images_dir}/{case_id}_0000.nii.gz" for dataset_dir in dataset_dirs.values()]
+    if annotated:
+        paths += [f"{dataset_dir}/labelsTr/{case_id}.nii.gz" for dataset_dir in dataset_dirs.values()]
+    return paths
+
+
+def plan_conversion(legs, manifest, dataset_dirs, force=False):
+    """
+    Compare the legs found with the manifest of the previous conversion.
+
+    Legs already in the manifest keep their case id; new legs get the next ids never used, in the order given
+    (training legs first, as before there was a manifest, so a first run numbers cases as full conversions always
+    did).
+
+    Returns:
+        new manifest entries (dict mapping leg directory to entry), case ids to convert (dict mapping case id to
+        leg), entries of legs no longer present (dict mapping leg directory to entry), and the next unused case index
+    """
+    params_changed = manifest['params'] != get_conversion_params()
+    old_entries = manifest['legs']
+    next_case_idx = manifest['next_case_idx']
+
+    entries = {}
+    to_convert = {}
+    for leg in legs:
+        old_entry = old_entries.get(leg['dir'])
+        entry = {
+            'case_id': old_entry['case_id'] if old_entry is not None else f"ankle_{next_case_idx:04d}",
+            'ct': get_file_entry(leg['ct_path'], old_entry and old_entry['ct']),
+            'seg': get_file_entry(leg['seg_path'], old_entry and old_entry['seg']) if 'seg_path' in leg else None,
+            'converted': True,
+        }
+        if old_entry is None:
+            next_case_idx += 1
+        entries[leg['dir']] = entry
+
+        unchanged = old_entry is not None and old_entry['converted'] and all(
+            (entry[key] and entry[key]['sha256']) == (old_entry[key] and old_entry[key]['sha256']) for key in ('ct', 'seg')
+        )
+        outputs_exist = all(os.path.exists(path) for path in get_output_paths(entry['case_id'], 'seg_path' in leg, dataset_dirs))
+        if force or params_changed or not unchanged or not outputs_exist:
+            to_convert[entry['case_id']] = leg
+
+    removed = {leg_dir: entry for leg_dir, entry in old_entries.items() if leg_dir not in entries}
+    return entries, to_convert, removed, next_case_idx
+
+
+def remove_outputs(entry, dataset_dirs):
+    # Whichever of the case's files exist, as a training or a testing case
+    for annotated in (True, False):
+        for path in get_output_paths(entry['case_id'], annotated, dataset_dirs):
+            if os.path.exists(path):
+                os.remove(path)
 
 
 def create_json(datasets_dir, dataset_name, num_training, num_testing, label_name_to_value):
@@ -148,16 +382,48 @@ def create_json(datasets_dir, dataset_name, num_training, num_testing, label_nam
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Convert the curated NRRD legs into the nnUNet raw datasets (binary and multiclass)')
+    parser.add_argument('--workers', type=int, default=None, help='Cases converted in parallel (default: one per CPU)')
+    parser.add_argument('--compression-level', type=int, default=compression_level, help='gzip level for the NIfTI files')
+    parser.add_argument('--compression-backend', type=str, choices=['itk', 'gzip', 'isal'], default=compression_backend, help='What compresses the NIfTI files')
+    parser.add_argument('--force', action='store_true', help='Convert all legs, not only new or changed ones')
+    args = parser.parse_args()
 
     training_legs, testing_legs = get_legs()
+    dataset_dirs = {binary_or_multiclass: f'{datasets_dir}/{dataset_name}' for binary_or_multiclass, dataset_name in dataset_names.items()}
+
+    manifest_path = f'{datasets_dir}/{manifest_file_name}'
+    manifest = load_manifest(manifest_path)
+    entries, to_convert, removed, next_case_idx = plan_conversion(training_legs + testing_legs, manifest, dataset_dirs, args.force)
+    print(f'{len(to_convert)} legs to convert, {len(entries) - len(to_convert)} unchanged, {len(removed)} removed')
+
+    # Outputs of removed legs, and of converted legs that may have switched between training and testing, go first
+    for leg_dir, entry in removed.items():
+        print(f"Removing case {entry['case_id']}: {leg_dir} is gone")
+        remove_outputs(entry, dataset_dirs)
+    for leg_dir, entry in entries.items():
+        if entry['case_id'] in to_convert:
+            remove_outputs(entry, dataset_dirs)
+
+    # Legs are marked converted as they're done, so an interrupted run picks up where it stopped (with the same ids)
+    manifest = {'params': get_conversion_params(), 'next_case_idx': next_case_idx, 'legs': {
+        leg_dir: {**entry, 'converted': entry['case_id'] not in to_convert} for leg_dir, entry in entries.items()
+    }}
+    case_id_to_leg_dir = {entry['case_id']: leg_dir for leg_dir, entry in entries.items()}
+    try:
+        for case_id in convert_legs(to_convert, dataset_dirs, args.workers, args.compression_level, args.compression_backend):
+            manifest['legs'][case_id_to_leg_dir[case_id]]['converted'] = True
+    finally:
+        save_manifest(manifest_path, manifest)
 
-    binary_dataset_name = "Dataset001_Ankle_Binary"
-    convert_legs(training_legs, testing_legs, f'{datasets_dir}/{binary_dataset_name}', binarise=True)
-    create_json(datasets_dir, binary_dataset_name, len(training_legs), len(testing_legs), {'background': 0, 'bone': 1})
+    create_json(datasets_dir, dataset_names['binary'], len(training_legs), len(testing_legs), {'background': 0, 'bone': 1})
+    create_json(datasets_dir, dataset_names['multiclass'], len(training_legs), len(testing_legs), {'background': 0, **bone_name_to_label})
 
-    multiclass_dataset_name = "Dataset002_Ankle_Multiclass"
-    convert_legs(training_legs, testing_legs, f'{datasets_dir}/{multiclass_dataset_name}', binarise=False)
-    create_json(datasets_dir, multiclass_dataset_name, len(training_legs), len(testing_legs), {'background': 0, **bone_name_to_label})
+    # For limiting nnUNet preprocessing (or checks) to what changed
+    changed_case_ids = sorted(to_convert) + sorted(entry['case_id'] for entry in removed.values())
+    with open(f'{datasets_dir}/changed_cases.txt', 'w') as f:
+        f.writelines(f'{case_id}\n' for case_id in changed_case_ids)
+    print(f"Changed cases: {', '.join(changed_case_ids) or 'none'} (listed in {datasets_dir}/changed_cases.txt)")
 
 
 if __name__ == "__main__":
@@ -1,42 +1,170 @@
-
 import os
+import sys
+import gzip
+import json
+import argparse
 import numpy as np
 import SimpleITK as sitk
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 original_folder = '/home/paul/projects/orthovis/ankle-data/from-annotators-and-daniela'
 converted_folder = f'/home/paul/projects/orthovis/ankle-data/split-and-curated'
+# Default scan list; --scans takes a JSON file of the same form (optionally with z_start and z_end per scan, to
+# override the automatic z-crop)
 scans = {
     'CT1': {'ct_subpath': 'daniela/4 Unnamed Series.nrrd', 'seg_subpath': 'daniela/Segmentation-cortical.nrrd'},
     'CT2': {'ct_subpath': 'daniela/3 Unnamed Series.nrrd', 'seg_subpath': 'daniela/Segmentation-full.nrrd'},
     'CT4': {'ct_subpath': 'daniela-re-fixed/402 Unnamed Series_1.nrrd', 'seg_subpath': 'daniela-re-fixed/Segmentation.nrrd'},
 }
 
+nrrd_type_to_dtype = {
+    **dict.fromkeys(['signed char', 'int8', 'int8_t'], 'i1'),
+    **dict.fromkeys(['uchar', 'unsigned char', 'uint8', 'uint8_t'], 'u1'),
+    **dict.fromkeys(['short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'], 'i2'),
+    **dict.fromkeys(['ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'], 'u2'),
+    **dict.fromkeys(['int', 'signed int', 'int32', 'int32_t'], 'i4'),
+    **dict.fromkeys(['uint', 'unsigned int', 'uint32', 'uint32_t'], 'u4'),
+    **dict.fromkeys(['longlong', 'long long', 'long long int', 'signed long long', 'signed long long int', 'int64', 'int64_t'], 'i8'),
+    **dict.fromkeys(['ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'], 'u8'),
+    'float': 'f4',
+    'double': 'f8',
+}
+
+# Header fields the row reader handles (or that don't change how the data is laid out); files with any other field
+# (e.g. 'line skip', 'byte skip', 'data file') are read with SimpleITK instead
+nrrd_fields_handled = {
+    'type', 'dimension', 'sizes', 'encoding', 'endian', 'kinds', 'space', 'space dimension', 'space directions',
+    'space origin', 'space units', 'spacings', 'thicknesses', 'axis mins', 'axis maxs', 'centerings', 'centers',
+    'labels', 'units', 'content', 'measurement frame', 'sample units', 'min', 'max', 'old min', 'old max',
+}
 
-def load_nrrd_image(filepath):
-    img = sitk.ReadImage(filepath)
-    array = sitk.GetArrayFromImage(img)  # shape: (z, y, x)
-    return img, array
 
+def read_nrrd_header(filepath):
+    # Header fields (lower-cased names), plus 'data_offset': where the attached data starts
+    header = {}
+    with open(filepath, 'rb') as f:
+        assert f.readline().startswith(b'NRRD'), f'{filepath} is not a NRRD file'
+        for line in iter(f.readline, b''):
+            line = line.decode('latin-1').rstrip('\r\n')
+            if line == '':
+                break
+            if line.startswith('#') or ':=' in line:  # comments and key/value pairs
+                continue
+            field, _, value = line.partition(':')
+            header[field.lower()] = value.strip()
+        header['data_offset'] = f.tell()
+    return header
+
+
+def get_unhandled_layout(header):
+    # Why the row reader can't read this file (None if it can)
+    unhandled_fields = sorted(set(header) - nrrd_fields_handled - {'data_offset'})
+    if unhandled_fields:
+        return f"unhandled header fields {', '.join(unhandled_fields)}"
+    if header.get('encoding') not in ('raw', 'gzip', 'gz'):
+        return f"encoding {header.get('encoding')}"
+    if header.get('type') not in nrrd_type_to_dtype:
+        return f"type {header.get('type')}"
+    sizes = header.get('sizes', '').split()
+    if int(header.get('dimension', -1)) != len(sizes):
+        return 'dimension and sizes disagree'
+    # Spatial axes, optionally after one (fastest) axis of components, as SimpleITK reads vector images
+    kinds = header.get('kinds', '').split()
+    if len(sizes) not in (3, 4) or (len(sizes) == 4 and (not kinds or kinds[0] == 'domain')):
+        return f"sizes {header.get('sizes')} (kinds {header.get('kinds')})"
+    return None
+
+
+def iter_nrrd_rows(filepath, start=0, stop=None, chunk_rows=None):
+    """
+    Read a NRRD volume's rows [start, stop) along its slowest axis (z for our scans), chunk_rows at a time (default:
+    all at once), without loading the rest of the volume: raw data is memory-mapped, and gzip data streamed
+    (decompressing the rows before start, but not keeping them). Files it doesn't handle (other encodings, detached
+    data, skipped lines or bytes; see get_unhandled_layout) are read whole with SimpleITK.
+
+    Yields:
+        arrays of rows, shaped like sitk.GetArrayFromImage's: (z, y, x) or (z, y, x, components)
+    """
+    header = read_nrrd_header(filepath)
+    shape = tuple(int(size) for size in reversed(header['sizes'].split()))
+    stop = shape[0] if stop is None else min(stop, shape[0])
+    chunk_rows = chunk_rows or max(stop - start, 1)
+    reason = get_unhandled_layout(header)
+    if reason is not None:
+        print(f'{filepath}: {reason}; reading it whole with SimpleITK')
+        array = sitk.GetArrayFromImage(sitk.ReadImage(filepath))
+        for chunk_start in range(start, stop, chunk_rows):
+            yield array[chunk_start : min(chunk_start + chunk_rows, stop)]
+        return
+
+    dtype = np.dtype(nrrd_type_to_dtype[header['type']])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder('<' if header.get('endian', 'little') == 'little' else '>')
+    row_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+    if header['encoding'] == 'raw':
+        rows = np.memmap(filepath, dtype=dtype, mode='r', offset=header['data_offset'], shape=shape)
+        for chunk_start in range(start, stop, chunk_rows):
+            yield rows[chunk_start : min(chunk_start + chunk_rows, stop)]
+        return
+
+    with open(filepath, 'rb') as f:
+        f.seek(header['data_offset'])
+        with gzip.GzipFile(fileobj=f) as data:
+            data.seek(start * row_bytes)
+            for chunk_start in range(start, stop, chunk_rows):
+                num_rows = min(chunk_rows, stop - chunk_start)
+                yield np.frombuffer(data.read(num_rows * row_bytes), dtype=dtype).reshape(num_rows, *shape[1:])
+
+
+def read_nrrd_rows(filepath, start, stop):
+    return next(iter_nrrd_rows(filepath, start, stop))
+
+
+def read_nrrd_geometry(filepath):
+    # Size (x, y, z), spacing, origin and direction, from the header only
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filepath)
+    reader.ReadImageInformation()
+    return reader.GetSize(), reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection()
+
+
+def get_annotated_slices(seg_path, chunk_rows=32):
+    # Whether each z slice of the segmentation has any annotation, reading a few slices at a time
+    return np.concatenate([
+        np.any(rows.reshape(len(rows), -1) > 0, axis=1) for rows in iter_nrrd_rows(seg_path, chunk_rows=chunk_rows)
+    ])
+
+
+def show_slice(volume, slice_idx=None, title="", save_path=None):
+    # Shown interactively, or written to save_path (e.g. by batch runs)
+    import matplotlib  # only needed for previews
+    if save_path is not None:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
-def show_slice(volume, slice_idx=None, title=""):
     if slice_idx is None:
         slice_idx = volume.shape[0] // 2  # middle slice
+    image = volume[slice_idx]
+    if image.ndim == 3:  # multi-layer segmentation
+        image = image.max(axis=-1)
     plt.figure(figsize=(6, 6))
-    plt.imshow(volume[slice_idx], cmap='gray')
+    plt.imshow(image, cmap='gray')
     plt.title(f"{title} (slice {slice_idx})")
     plt.axis('off')
-    plt.show()
+    if save_path is None:
+        plt.show()
+    else:
+        plt.savefig(save_path, bbox_inches='tight')
+        plt.close()
 
 
-def get_centered_z_crop_pow2(mask, z_start_override=None, z_end_override=None):
+def get_centered_z_crop_pow2(z_nonzero, z_start_override=None, z_end_override=None):
     if z_start_override is not None and z_end_override is not None:
         crop_size = z_end_override - z_start_override
         return z_start_override, z_end_override, crop_size
 
     # Auto-detect bounding box if no manual override
-    z_nonzero = np.any(mask > 0, axis=(1, 2))
     nonzero_indices = np.where(z_nonzero)[0]
 
     if len(nonzero_indices) == 0:
@@ -52,7 +180,7 @@ def get_centered_z_crop_pow2(mask, z_start_override=None, z_end_override=None):
     half_crop = crop_size // 2
 
     z_start = max(center_z - half_crop, 0)
-    z_end = min(z_start + crop_size, mask.shape[0])
+    z_end = min(z_start + crop_size, len(z_nonzero))
     z_start = max(z_end - crop_size, 0)
 
     return z_start, z_end, crop_size
@@ -71,20 +199,19 @@ def split_left_right(ct_array, seg_array):
     return (ct_left, seg_left), (ct_right, seg_right), x_mid
 
 
-def save_half(ct_arr, seg_arr, save_dir, original_img, x_start):
+def save_half(ct_arr, seg_arr, save_dir, spacing, direction, origin, x_start):
     os.makedirs(save_dir, exist_ok=True)  # make sure the output directory exists
 
     # Convert arrays to images
     ct_img = sitk.GetImageFromArray(ct_arr)
-    seg_img = sitk.GetImageFromArray(seg_arr)
+    seg_img = sitk.GetImageFromArray(seg_arr, isVector=seg_arr.ndim == 4)
 
     # Copy spacing & direction
-    ct_img.SetSpacing(original_img.GetSpacing())
-    ct_img.SetDirection(original_img.GetDirection())
+    ct_img.SetSpacing(spacing)
+    ct_img.SetDirection(direction)
 
     # Adjust origin along x-axis
-    origin = list(original_img.GetOrigin())
-    spacing = original_img.GetSpacing()
+    origin = list(origin)
     origin[0] += x_start * spacing[0]  # adjust for x split
     ct_img.SetOrigin(tuple(origin))
     seg_img.CopyInformation(ct_img)
@@ -99,59 +226,102 @@ def save_half(ct_arr, seg_arr, save_dir, original_img, x_start):
     print(f"Saved: {ct_path}\n       {seg_path}")
 
 
-def process_scan(ct_path, seg_path, scan_name):
-
-    ct_img, ct_array = load_nrrd_image(ct_path)
-    seg_img, seg_array = load_nrrd_image(seg_path)
-
-    print("CT shape:", ct_array.shape)
-    print("Segmentation shape:", seg_array.shape)
-
-    show_slice(ct_array, 350, title="Original CT")
-    show_slice(seg_array, 350, title="Segmentation Mask")
-
-    # z_start, z_end, used_crop_size = get_centered_z_crop_pow2(seg_array, 0, 256)
-    z_start, z_end, used_crop_size = get_centered_z_crop_pow2(seg_array)
+def process_scan(ct_path, seg_path, scan_name, converted_folder=converted_folder, preview_dir=None, show=False, z_start_override=None, z_end_override=None):
+    """
+    Crop a whole-body scan to the annotated z-range (rounded up to a power of two slices) and split it into legs.
+    The z-range comes from the segmentation, read a few slices at a time, and then only that slab of the CT and
+    segmentation is read.
 
-    ct_cropped_array = ct_array[z_start : z_end, :, :]
-    seg_cropped_array = seg_array[z_start : z_end, :, :]
-
-    print(f"Auto power-of-2 z-crop from slice {z_start} to {z_end} ({used_crop_size} slices)")
-
-
-    show_slice(ct_cropped_array, title="Cropped CT")
-    show_slice(seg_cropped_array, title="Segmentation Mask")
+    Args:
+        preview_dir: if given, preview slices are written there as PNGs
+        show: show preview slices interactively (blocking) instead
+    """
+    ct_size, spacing, original_origin, direction = read_nrrd_geometry(ct_path)
+    seg_size = read_nrrd_geometry(seg_path)[0]
+    assert tuple(seg_size) == tuple(ct_size), f'CT size {ct_size} differs from segmentation size {seg_size}'
+    print(f"{scan_name}: CT and segmentation size (x, y, z): {ct_size}")
 
+    # The segmentation is only scanned if the z-range isn't given
+    if z_start_override is not None and z_end_override is not None:
+        z_start, z_end, used_crop_size = get_centered_z_crop_pow2(None, z_start_override, z_end_override)
+    else:
+        z_start, z_end, used_crop_size = get_centered_z_crop_pow2(get_annotated_slices(seg_path))
+    print(f"{scan_name}: auto power-of-2 z-crop from slice {z_start} to {z_end} ({used_crop_size} slices)")
 
-    ct_cropped_img = sitk.GetImageFromArray(ct_cropped_array)
-    ct_cropped_img.SetSpacing(ct_img.GetSpacing())
-    ct_cropped_img.SetDirection(ct_img.GetDirection())
+    ct_cropped_array = read_nrrd_rows(ct_path, z_start, z_end)
+    seg_cropped_array = read_nrrd_rows(seg_path, z_start, z_end)
 
-    original_origin = ct_img.GetOrigin()
-    spacing = ct_img.GetSpacing()
     new_origin_z = original_origin[2] + z_start * spacing[2]
     new_origin = (original_origin[0], original_origin[1], new_origin_z)
-    ct_cropped_img.SetOrigin(new_origin)
 
     (left_ct, left_seg), (right_ct, right_seg), x_mid = split_left_right(ct_cropped_array, seg_cropped_array)
 
-    print(f"Split at x={x_mid}, Left shape: {left_ct.shape}, Right shape: {right_ct.shape}")
+    print(f"{scan_name}: split at x={x_mid}, Left shape: {left_ct.shape}, Right shape: {right_ct.shape}")
 
-    show_slice(left_ct, title="Left CT")
-    show_slice(left_seg, title="Segmentation Mask")
+    if preview_dir is not None or show:
+        if preview_dir is not None:
+            os.makedirs(preview_dir, exist_ok=True)
+        for name, volume in [('cropped-ct', ct_cropped_array), ('cropped-seg', seg_cropped_array), ('left-ct', left_ct), ('left-seg', left_seg)]:
+            save_path = None if preview_dir is None else os.path.join(preview_dir, f'{scan_name}_{name}.png')
+            show_slice(volume, title=f'{scan_name} {name}', save_path=save_path)
 
-    save_half(left_ct, left_seg, f'{converted_folder}/{scan_name}_first-leg', ct_cropped_img, x_start=0)
-    save_half(right_ct, right_seg, f'{converted_folder}/{scan_name}_second-leg', ct_cropped_img, x_start=x_mid)
+    save_half(left_ct, left_seg, f'{converted_folder}/{scan_name}_first-leg', spacing, direction, new_origin, x_start=0)
+    save_half(right_ct, right_seg, f'{converted_folder}/{scan_name}_second-leg', spacing, direction, new_origin, x_start=x_mid)
+    return scan_name
+
+
+def init_worker():
+    # Scans are processed in parallel already, so ITK's own threads would only oversubscribe the CPUs
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
 
 
 def main():
-    for scan_name, scan_paths in scans.items():
-        ct_path = os.path.join(original_folder, scan_name, scan_paths['ct_subpath'])
-        seg_path = os.path.join(original_folder, scan_name, scan_paths['seg_subpath'])
-        print(f'processing {scan_name}')
-        process_scan(ct_path, seg_path, scan_name)
+    parser = argparse.ArgumentParser(description='Crop whole-body scans to the annotated z-range and split them into legs')
+    parser.add_argument('--scans', type=str, help='JSON file mapping scan name to ct_subpath and seg_subpath (default: scans in this file)')
+    parser.add_argument('--original-folder', type=str, default=original_folder, help='Folder of scans, one subfolder per scan name')
+    parser.add_argument('--converted-folder', type=str, default=converted_folder, help='Where the split legs go')
+    parser.add_argument('--workers', type=int, default=None, help='Scans processed in parallel (default: one per CPU)')
+    parser.add_argument('--previews', type=str, help='Folder to write preview slices to, as PNGs')
+    parser.add_argument('--show', action='store_true', help='Show preview slices interactively (processes scans one at a time)')
+    args = parser.parse_args()
+
+    scan_list = scans
+    if args.scans is not None:
+        with open(args.scans) as f:
+            scan_list = json.load(f)
+
+    def get_kwargs(scan_name, scan):
+        return {
+            'ct_path': os.path.join(args.original_folder, scan_name, scan['ct_subpath']),
+            'seg_path': os.path.join(args.original_folder, scan_name, scan['seg_subpath']),
+            'scan_name': scan_name,
+            'converted_folder': args.converted_folder,
+            'preview_dir': args.previews,
+            'show': args.show,
+            'z_start_override': scan.get('z_start'),
+            'z_end_override': scan.get('z_end'),
+        }
+
+    failed = {}
+    if args.show:
+        for scan_name, scan in scan_list.items():
+            print(f'processing {scan_name}')
+            process_scan(**get_kwargs(scan_name, scan))
+    else:
+        # One scan failing (e.g. without annotations) doesn't stop the others; failures are listed at the end
+        with ProcessPoolExecutor(args.workers, initializer=init_worker) as executor:
+            futures = {executor.submit(process_scan, **get_kwargs(scan_name, scan)): scan_name for scan_name, scan in scan_list.items()}
+            for future in as_completed(futures):
+                try:
+                    print(f'processed {future.result()}')
+                except Exception as e:
+                    failed[futures[future]] = repr(e)
+                    print(f'failed {futures[future]}: {e!r}')
+
+    print(f'{len(scan_list) - len(failed)} of {len(scan_list)} scans processed')
+    if failed:
+        sys.exit(f"Failed: {', '.join(failed)}")
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import config
+import inference
+import metrics
+import serialization
+
+
+# Output file extension per response content type
+extensions = {
+    serialization.json_content_type: '.json',
+    serialization.container_content_type: '.ovms',
+    serialization.glb_content_type: '.glb',
+}
+
+
+def get_cases(inputs):
+    """
+    A directory of case zips, or a manifest file listing one zip path per line (relative to the manifest). Cases are
+    named by their path relative to the directory or manifest, without '.zip' (e.g. 'site_a/case1'), so zips with the
+    same file name in different folders stay separate cases, and outputs mirror those folders.
+    """
+    if os.path.isdir(inputs):
+        root = inputs
+        paths = [os.path.join(inputs, file_name) for file_name in sorted(os.listdir(inputs)) if file_name.endswith('.zip')]
+    else:
+        root = os.path.dirname(inputs)
+        with open(inputs) as f:
+            paths = [os.path.normpath(os.path.join(root, line.strip())) for line in f if line.strip() and not line.startswith('#')]
+
+    cases = {}
+    for path in paths:
+        relative_path = os.path.relpath(path, root)
+        if relative_path.split(os.sep)[0] == os.pardir:
+            # Its outputs would land outside the output directory
+            raise ValueError(f'{path} is outside {os.path.abspath(root)}; list zips in or below the manifest\'s directory')
+        case = os.path.splitext(relative_path)[0].replace(os.sep, '/')
+        if cases.get(case, path) != path:
+            raise ValueError(f'{cases[case]} and {path} would both be case {case!r}')
+        cases[case] = path
+    return cases
+
+
+def get_run_signature(args):
+    # Everything that changes the output, so a resumed run only skips cases done with the same model and settings;
+    # the model by its checksum, as for the endpoint's cache keys, so touching or moving the model folder doesn't count
+    settings = {
+        'model_checksum': cache.hash_files(config.get_model_files(args.model_dir)),
+        'accept': args.accept,
+        'settings': config.get_settings(args.preset),
+        'localize': config.localize and (config.roi_extent_mm, config.roi_margin_mm),
+        'memory_budget_gb': config.memory_budget_gb,
+        'meshing': [
+            config.voxel_components, config.min_component_voxels, config.max_components_per_label,
+            config.target_edge_length_mm, config.lod_factors,
+        ],
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def read_progress(progress_path, run_signature):
+    done = set()
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['run_signature'] == run_signature and entry['status'] == 'done':
+                    done.add(entry['case'])
+    return done
+
+
+class Progress:
+    # Appends one JSON line per finished case, flushed immediately so a killed run can resume
+    def __init__(self, path, run_signature, num_cases):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+        self.run_signature = run_signature
+        self.num_cases = num_cases
+        self.num_done = 0
+        self.num_failed = 0
+        self.start_time = time.perf_counter()
+
+    def get_rate(self):
+        # Cases done (not failed) per hour
+        return 3600 * self.num_done / (time.perf_counter() - self.start_time)
+
+    def record(self, case, status, **fields):
+        with self.lock:
+            self.file.write(json.dumps({'case': case, 'status': status, 'run_signature': self.run_signature, **fields}) + '\n')
+            self.file.flush()
+            if status == 'done':
+                self.num_done += 1
+            else:
+                self.num_failed += 1
+            print(
+                f"[{self.num_done + self.num_failed}/{self.num_cases}] {case}: {status}; {self.num_done} done, "
+                f"{self.num_failed} failed, {self.get_rate():.1f} cases/hour so far"
+            )
+
+    def close(self):
+        self.file.close()
+
+
+def decode(path):
+    # Runs on the decode thread pool
+    request_metrics = metrics.RequestMetrics()
+    with open(path, 'rb') as f:
+        request_body = f.read()
+    volume_zyx, spacing_xyz_mm, origin_xyz, direction, _ = inference.read_in_memory(request_body, request_metrics)
+    return volume_zyx, spacing_xyz_mm, origin_xyz, direction, request_metrics
+
+
+def mesh_and_write(predictor, case, predicted_labels_zyx, spacing_xyz_mm, settings, args, request_metrics, progress):
+    # Runs on the meshing thread, which farms labels out to meshing's process pool
+    try:
+        label_to_name = {label: name for name, label in predictor.label_manager.label_dict.items()}
+        meshing_timings = {}
+        with request_metrics.span('meshing'):
+            meshes = inference.mesh_labels(
+                predicted_labels_zyx.transpose(2, 1, 0), spacing_xyz_mm, label_to_name, config.get_meshing_options(settings), meshing_timings,
+            )
+        request_metrics.add_timings(meshing_timings, prefix='meshing_')
+
+        with request_metrics.span('serialization'):
+            response, content_type = serialization.serialize_meshes(meshes, args.accept)
+            output_path = os.path.join(args.output, case + extensions[content_type])
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path + '.tmp', 'wb' if isinstance(response, bytes) else 'w') as f:
+                if isinstance(response, bytes):
+                    f.write(response)
+                else:
+                    json.dump(response, f)
+            os.replace(output_path + '.tmp', output_path)
+        progress.record(case, 'done', output=os.path.relpath(output_path, args.output), num_meshes=len(meshes), metrics=request_metrics.to_dict())
+    except Exception as e:
+        progress.record(case, 'failed', error=repr(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Segment and mesh an archive of case zips, as the endpoint would, resuming where a previous run stopped')
+    parser.add_argument('inputs', type=str, help='Directory of case zips, or a file listing zip paths (one per line)')
+    parser.add_argument('--model-dir', type=str, required=True, help="Directory containing the nnUNet model folder as 'model' (as for model_fn)")
+    parser.add_argument('--output', type=str, required=True, help='Output directory, for meshes and progress.jsonl')
+    parser.add_argument('--accept', type=str, default=serialization.container_content_type, help='Output format, as the Accept header for the endpoint')
+    parser.add_argument('--preset', type=str, choices=list(config.presets), help='Speed / quality preset (default: environment settings)')
+    parser.add_argument('--decode-workers', type=int, default=2, help='Cases decoded ahead of the GPU, in parallel')
+    parser.add_argument('--max-pending-meshing', type=int, default=2, help='Cases waiting for meshing before the GPU waits too')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    run_signature = get_run_signature(args)
+    progress_path = os.path.join(args.output, 'progress.jsonl')
+    done = read_progress(progress_path, run_signature)
+    cases = {case: path for case, path in get_cases(args.inputs).items() if case not in done}
+    print(f"{len(cases)} cases to process ({len(done)} already done with run signature {run_signature})")
+    if not cases:
+        return
+
+    predictor = inference.model_fn(args.model_dir)
+    settings = config.get_settings(args.preset)
+    progress = Progress(progress_path, run_signature, len(cases))
+
+    # Three stages overlap across cases: decoding (threads, a few cases ahead), prediction (this thread, one case at
+    # a time on the GPU) and meshing (one thread driving the meshing process pool); both queues are bounded, so
+    # only a few volumes are in memory at once
+    case_names = list(cases)
+    with ThreadPoolExecutor(args.decode_workers) as decode_executor, ThreadPoolExecutor(1) as meshing_executor:
+        decode_futures = {}
+        meshing_futures = []
+        for idx, case in enumerate(case_names):
+            for next_case in case_names[idx : idx + args.decode_workers + 1]:
+                if next_case not in decode_futures:
+                    decode_futures[next_case] = decode_executor.submit(decode, cases[next_case])
+            try:
+                volume_zyx, spacing_xyz_mm, origin_xyz, direction, request_metrics = decode_futures.pop(case).result()
+                predicted_labels_zyx = (inference.predict_localized if config.localize else inference.predict)(
+                    predictor, volume_zyx, spacing_xyz_mm, origin_xyz, direction, None, settings, request_metrics,
+                )
+                del volume_zyx
+            except Exception as e:
+                progress.record(case, 'failed', error=repr(e))
+                continue
+
+            meshing_futures = [future for future in meshing_futures if not future.done()]
+            while len(meshing_futures) >= args.max_pending_meshing:
+                meshing_futures.pop(0).result()
+            meshing_futures.append(meshing_executor.submit(
+                mesh_and_write, predictor, case, predicted_labels_zyx, spacing_xyz_mm, settings, args, request_metrics, progress,
+            ))
+
+    elapsed = time.perf_counter() - progress.start_time
+    progress.close()
+    print(f"{progress.num_done} cases done and {progress.num_failed} failed in {elapsed / 60:.1f} minutes: {progress.get_rate():.1f} cases/hour")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import json
+import time
+import platform
+import argparse
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import numpy as np
+
+import meshing
+import synthetic
+from metrics import get_peak_rss_mb
+
+
+# Stages reported by meshing.convert_array_to_meshes, in pipeline order
+stages = ['crop', 'zmesh', 'simplify', 'split', 'remesh', 'lod', 'reverse_axes', 'meshing_wall', 'recentre']
+
+
+def run_case(case):
+    # Runs in its own process, so peak RSS is for this case alone
+    rss_before_mb = get_peak_rss_mb()
+    labels = synthetic.make_bone_labels((512, 512, case['slices']), case['spacing'], case['labels'], case['specks'])
+    rss_volume_mb = get_peak_rss_mb()
+
+    timings = {}
+    start_time = time.perf_counter()
+    meshes = meshing.convert_array_to_meshes(
+        labels, case['spacing'], {label: f'bone{label}' for label in range(1, case['labels'] + 1)},
+        num_workers=case['workers'], timings=timings, **case['options'],
+    )
+    total = time.perf_counter() - start_time
+
+    return {
+        **case,
+        'total_seconds': total,
+        'stage_seconds': timings,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'volume_rss_mb': rss_volume_mb - rss_before_mb,
+        'num_meshes': len(meshes),
+        'num_vertices': int(sum(len(mesh.vertices) for mesh in meshes.values())),
+        'num_faces': int(sum(len(mesh.faces) for mesh in meshes.values())),
+    }
+
+
+def get_cases(args):
+    cases = []
+    for slices, num_labels, specks in [(200, 1, 0), (300, 4, 50), (300, 4, 500), (600, 4, 500)]:
+        if args.quick and slices > 300:
+            continue
+        # split_lod against split gives the extra cost of levels of detail
+        for mode, options in [
+            ('split', {}),
+            ('split_lod', {'lod_factors': (4, 16)}),
+            ('voxel_components', {'voxel_components': True, 'min_component_voxels': 100}),
+        ]:
+            cases.append({
+                'name': f'{slices}slices_{num_labels}labels_{specks}specks_{mode}',
+                'slices': slices,
+                'spacing': [0.4, 0.4, 1.0],
+                'labels': num_labels,
+                'specks': specks,
+                'workers': args.workers,
+                'options': options,
+            })
+    return cases
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {case['name']: case for case in json.load(f)['cases']}
+    print(f'\ncompared to {baseline_path} (ratio new / old; >1 is slower or bigger)')
+    print(f'{"case":<45} {"total":>7} {"rss":>7} {"faces":>7}')
+    for case in results:
+        old = baseline.get(case['name'])
+        if old is None:
+            continue
+        print(
+            f'{case["name"]:<45} {case["total_seconds"] / old["total_seconds"]:>7.2f} '
+            f'{case["peak_rss_mb"] / old["peak_rss_mb"]:>7.2f} {case["num_faces"] / max(old["num_faces"], 1):>7.2f}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark meshing.convert_array_to_meshes stage by stage on synthetic label volumes')
+    parser.add_argument('--output', type=str, default='bench_meshing.json', help='Where to write results (JSON)')
+    parser.add_argument('--compare', type=str, help='Previous results file to compare against')
+    parser.add_argument('--workers', type=int, default=1, help='Meshing worker processes (1 keeps stage times clean)')
+    parser.add_argument('--quick', action='store_true', help='Skip the largest volumes')
+    args = parser.parse_args()
+
+    results = []
+    for case in get_cases(args):
+        # A fresh process per case, so peak RSS isn't carried over from earlier cases
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_case, case).result()
+        results.append(result)
+        stage_summary = ', '.join(f'{stage} {result["stage_seconds"][stage]:.2f}' for stage in stages if stage in result['stage_seconds'])
+        print(
+            f'{result["name"]:<45} {result["total_seconds"]:>6.2f} s, peak RSS {result["peak_rss_mb"]:>6.0f} MB, '
+            f'{result["num_meshes"]} meshes, {result["num_vertices"]} vertices, {result["num_faces"]} faces  ({stage_summary})'
+        )
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': get_git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': multiprocessing.cpu_count(),
+            'cases': results,
+        }, f, indent=2)
+    print(f'Written {args.output}')
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import time
+import argparse
+
+import numpy as np
+
+import meshing
+import synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time isotropic remeshing per component against zmesh simplification alone')
+    parser.add_argument('--spacings', type=float, nargs='+', default=[0.5, 0.75, 1.0], help='Isotropic voxel spacings (mm) to test')
+    parser.add_argument('--edge-lengths', type=float, nargs='+', default=[1.0, 1.5, 2.0], help='Target edge lengths (mm) to test')
+    parser.add_argument('--iterations', type=int, default=10, help='Remeshing iterations')
+    args = parser.parse_args()
+
+    print(f'{"spacing":>8} {"reduction":>9} {"edge (mm)":>9} {"ms/component":>12} {"faces (min/median/max)":>24} {"total faces":>11}')
+    for spacing in args.spacings:
+        labels = synthetic.make_bone_labels(synthetic.get_shape((120., 160., 220.), (spacing,) * 3), (spacing,) * 3)
+        configs = [(100, None)] + [(reduction_factor, edge_length) for edge_length in args.edge_lengths for reduction_factor in (0, 100)]
+        for reduction_factor, edge_length in configs:
+            # Time each bone on its own (in-process), so we see per-component cost without pool overheads
+            durations, face_counts = [], []
+            for label in synthetic.bones:
+                bbox = tuple(slice(indices.min(), indices.max() + 1) for indices in np.nonzero(labels == label))
+                mask = (labels[bbox] == label).view(np.uint8)
+                start_time = time.perf_counter()
+                components = meshing.mesh_label(
+                    mask, [s.start for s in bbox], (spacing,) * 3,
+                    split=False, reduction_factor=reduction_factor, target_edge_length=edge_length, remesh_iterations=args.iterations,
+                )
+                durations.append(time.perf_counter() - start_time)
+                face_counts.extend(len(mesh.faces) for mesh in components)
+            print(
+                f'{spacing:>8.2f} {reduction_factor:>9} {edge_length or "-":>9} {np.mean(durations) * 1e3:>12.0f} '
+                f'{f"{min(face_counts)} / {int(np.median(face_counts))} / {max(face_counts)}":>24} {sum(face_counts):>11}'
+            )
+
+
+if __name__ == '__main__':
+    main()
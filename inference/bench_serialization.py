@@ -0,0 +1,51 @@
+import json
+import time
+import argparse
+
+import meshing
+import synthetic
+import serialization
+
+
+def time_serialization(meshes, accept, repeats):
+    durations = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        response, _ = serialization.serialize_meshes(meshes, accept)
+        if not isinstance(response, bytes):
+            # What SageMaker/TorchServe does with our list before sending it
+            response = json.dumps(response).encode('utf-8')
+        durations.append(time.perf_counter() - start_time)
+    return min(durations), len(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare mesh response formats for serialization time and size')
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 320, 280], help='Label volume shape (x y z)')
+    parser.add_argument('--spacing', type=float, nargs=3, default=[0.5, 0.5, 0.8], help='Voxel spacing in mm (x y z)')
+    parser.add_argument('--labels', type=int, default=4, choices=range(1, len(synthetic.bones) + 1), help='Number of bone labels')
+    parser.add_argument('--repeats', type=int, default=3, help='Repeats per format (minimum time is reported)')
+    args = parser.parse_args()
+
+    labels = synthetic.make_bone_labels(tuple(args.shape), args.spacing, args.labels)
+    meshes = meshing.convert_array_to_meshes(labels, args.spacing, {label: f'bone{label}' for label in range(1, args.labels + 1)})
+    num_vertices = sum(len(mesh.vertices) for mesh in meshes.values())
+    num_faces = sum(len(mesh.faces) for mesh in meshes.values())
+    print(f'{len(meshes)} meshes, {num_vertices} vertices, {num_faces} faces')
+
+    accepts = [
+        'application/json',
+        'application/x-orthovis-meshes',
+        'application/x-orthovis-meshes; quantize=16',
+        'model/gltf-binary',
+        'model/gltf-binary; quantize=16',
+    ]
+    results = {accept: time_serialization(meshes, accept, args.repeats) for accept in accepts}
+    json_duration, json_size = results['application/json']
+    print(f'{"accept":<45} {"time (ms)":>10} {"size (MB)":>10} {"speedup":>8} {"smaller":>8}')
+    for accept, (duration, size) in results.items():
+        print(f'{accept:<45} {duration * 1e3:>10.1f} {size / 1e6:>10.2f} {json_duration / duration:>7.1f}x {json_size / size:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
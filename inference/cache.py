@@ -0,0 +1,246 @@
+import io
+import os
+import json
+import time
+import hashlib
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def hash_volume(volume, spacing, origin, direction):
+    # Key on what the model actually sees (pixel values and geometry), not the DICOM files, so re-exports of
+    # the same series with different metadata still hit
+    digest = hashlib.sha256()
+    digest.update(json.dumps([volume.shape, volume.dtype.str, list(spacing), list(origin), list(direction)]).encode())
+    digest.update(np.ascontiguousarray(volume).data)
+    return digest.hexdigest()
+
+
+def hash_files(paths, chunk_size=1024 ** 2):
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    # parts must be JSON-serializable; the same parts (in the same order) always give the same key
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def labels_to_bytes(labels):
+    with io.BytesIO() as f:
+        np.savez_compressed(f, labels=labels)
+        return f.getvalue()
+
+
+def labels_from_bytes(data):
+    with np.load(io.BytesIO(data)) as npz:
+        return npz['labels']
+
+
+def get_timestamp(last_modified):
+    # boto3 gives LastModified as a datetime, DirectoryObjectStore as seconds since the epoch
+    return last_modified.timestamp() if hasattr(last_modified, 'timestamp') else last_modified
+
+
+class DirectoryCache:
+    """
+    Cache of byte strings in a local directory (e.g. instance storage), one file per key, evicting the least
+    recently used entries (by file mtime, which reads update) once the total size exceeds max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # evicted by another process since we read it; still a hit
+            pass
+        return data
+
+    def put(self, key, data):
+        # Write to a temporary file first, so concurrent readers never see a partial entry
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, os.path.join(self.directory, key))
+        self.evict()
+
+    def evict(self):
+        # Other processes (model server workers) share the directory, and may remove entries while we look
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda entry: entry[0]):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= size
+            try:
+                os.remove(entry.path)
+                logger.debug(f"Evicted {entry.name} from cache")
+            except FileNotFoundError:
+                pass
+
+
+class ObjectStoreCache:
+    """
+    Cache of byte strings in an S3 bucket (given a boto3 S3 client, or a DirectoryObjectStore standing in for
+    one), one object per key under prefix.
+
+    If max_bytes is set, reads refresh an object's LastModified (by copying it onto itself) if it's older than
+    touch_after_seconds, and every evict_every_puts-th write evicts the least recently used objects under the
+    prefix; so recency is approximate to touch_after_seconds, and the total can exceed max_bytes by a few
+    entries. Otherwise leave expiry to a bucket lifecycle rule.
+    """
+
+    def __init__(self, client, bucket, prefix='', max_bytes=None, touch_after_seconds=3600., evict_every_puts=10):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.touch_after_seconds = touch_after_seconds
+        self.evict_every_puts = evict_every_puts
+        self.num_puts = 0
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        data = response['Body'].read()
+        if self.max_bytes is not None and time.time() - get_timestamp(response['LastModified']) >= self.touch_after_seconds:
+            self.client.copy_object(
+                Bucket=self.bucket, Key=self.prefix + key, CopySource={'Bucket': self.bucket, 'Key': self.prefix + key},
+                MetadataDirective='REPLACE',
+            )
+        return data
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+        self.num_puts += 1
+        if self.max_bytes is not None and self.num_puts % self.evict_every_puts == 0:
+            self.evict()
+
+    def evict(self):
+        objects = []
+        kwargs = {'Bucket': self.bucket, 'Prefix': self.prefix}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            objects.extend(response.get('Contents', []))
+            if not response.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+        total_bytes = sum(obj['Size'] for obj in objects)
+        for obj in sorted(objects, key=lambda obj: get_timestamp(obj['LastModified'])):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= obj['Size']
+            self.client.delete_object(Bucket=self.bucket, Key=obj['Key'])
+            logger.debug(f"Evicted {obj['Key']} from cache")
+
+
+class DirectoryObjectStore:
+    """
+    Stand-in for the few boto3 S3 client methods we use, keeping objects as files under directory/bucket/key;
+    for tests and running locally without AWS.
+    """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, bucket, key):
+        return os.path.join(self.directory, bucket, *key.split('/'))
+
+    def get_object(self, Bucket, Key):
+        path = self.get_path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise self.exceptions.NoSuchKey(Key)
+        with open(path, 'rb') as f:
+            return {'Body': io.BytesIO(f.read()), 'LastModified': os.fstat(f.fileno()).st_mtime}
+
+    def put_object(self, Bucket, Key, Body):
+        path = self.get_path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', delete=False) as f:
+            f.write(Body if isinstance(Body, bytes) else Body.read())
+        os.replace(f.name, path)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key):
+        path = self.get_path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(Filename, 'rb') as src, tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', delete=False) as dst:
+            shutil.copyfileobj(src, dst, 1024 ** 2)
+        os.replace(dst.name, path)
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective='COPY'):
+        data = self.get_object(CopySource['Bucket'], CopySource['Key'])['Body'].read()
+        return self.put_object(Bucket, Key, data)
+
+    def delete_object(self, Bucket, Key):
+        try:
+            os.remove(self.get_path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None):
+        contents = []
+        root = os.path.join(self.directory, Bucket)
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                if file_name.startswith('.'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(path, root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    stat = os.stat(path)
+                    contents.append({'Key': key, 'Size': stat.st_size, 'LastModified': stat.st_mtime})
+        return {'Contents': sorted(contents, key=lambda obj: obj['Key']), 'IsTruncated': False}
+
+
+def get_cache(url, max_bytes):
+    """
+    Cache backend for a URL: a local directory path, 's3://bucket/prefix', or 'file:///directory' for the object
+    store backend on a local directory (bucket 'cache', via DirectoryObjectStore). None or '' disables caching.
+    """
+    if not url:
+        return None
+    if url.startswith('s3://'):
+        import boto3  # only needed for this backend
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        return ObjectStoreCache(boto3.client('s3'), bucket, prefix.rstrip('/') + '/' if prefix else '', max_bytes)
+    if url.startswith('file://'):
+        return ObjectStoreCache(DirectoryObjectStore(url[len('file://'):]), 'cache', '', max_bytes)
+    return DirectoryCache(url, max_bytes)
+
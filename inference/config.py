@@ -0,0 +1,228 @@
+import os
+import math
+
+import errors
+
+
+# Endpoint settings, from the environment (deploy.py sets some; see the README for the rest), and the per-request
+# options that override them. Kept apart from inference.py so they can be imported and tested without torch or nnUNet
+
+# nnUNet fold and checkpoint to load from the model folder; deploy.py packages only these (see model_package.py)
+model_fold = os.environ.get('ORTHOVIS_MODEL_FOLD', 'all')
+checkpoint_name = os.environ.get('ORTHOVIS_CHECKPOINT', 'checkpoint_best.pth')
+
+# Device for nnUNet: 'auto' (CUDA if available, otherwise CPU), or anything torch.device accepts, e.g. 'cpu'
+device_name = os.environ.get('ORTHOVIS_DEVICE', 'auto')
+
+# Threads for torch on CPU; nnUNet otherwise caps prediction at nnUNet_def_n_proc (8 by default)
+torch_threads = int(os.environ.get('ORTHOVIS_TORCH_THREADS', os.cpu_count()))
+
+# On CPU, 'bf16' runs the network under bfloat16 autocast (much faster on CPUs with AVX512-BF16 / AMX); on CUDA,
+# nnUNet always uses float16 autocast
+cpu_autocast = os.environ.get('ORTHOVIS_CPU_AUTOCAST', 'none')
+assert cpu_autocast in ('none', 'bf16'), f"Unknown CPU autocast {cpu_autocast}, expected 'none' or 'bf16'"
+
+# nnUNet sliding-window settings: overlap between tiles (larger step is fewer tiles; 0.5 as nnUNet's default),
+# test-time mirroring (up to 8x the network evaluations), and whether to keep the image and logits on the GPU
+tile_step_size = float(os.environ.get('ORTHOVIS_TILE_STEP_SIZE', 0.5))
+use_mirroring = os.environ.get('ORTHOVIS_USE_MIRRORING', '1') == '1'
+perform_everything_on_device = os.environ.get('ORTHOVIS_PERFORM_EVERYTHING_ON_DEVICE', '1') == '1'
+
+# Localize the ankle(s) with a bone threshold first, and run the full-resolution model only on those regions (from
+# the lowest bone up ORTHOVIS_ROI_EXTENT_MM, with a margin); for whole-body and other large fields of view
+localize = os.environ.get('ORTHOVIS_LOCALIZE', '0') == '1'
+roi_extent_mm = float(os.environ.get('ORTHOVIS_ROI_EXTENT_MM', 200.))
+roi_margin_mm = float(os.environ.get('ORTHOVIS_ROI_MARGIN_MM', 20.))
+
+# Working memory (GB) for prediction beyond the input volume, e.g. for whole-body scans with multiclass models; if the
+# full-volume logits wouldn't fit, the volume is predicted, resampled and reduced to labels in slabs along its first
+# axis (see tiling.py). Unset for nnUNet's one-shot path
+memory_budget_gb = float(os.environ['ORTHOVIS_MEMORY_BUDGET_GB']) if 'ORTHOVIS_MEMORY_BUDGET_GB' in os.environ else None
+
+# Speed / quality presets, chosen per request with a `preset=<name>` CustomAttribute (e.g. a quick preview for the
+# UI, followed by the full-quality run); mirror_axes None means all axes the model was trained to allow.
+# Mirroring costs up to 8x, and a tile step of 1 (no overlap) ~8x fewer tiles than 0.5 for 3D
+presets = {
+    'fast': {'tile_step_size': 1.0, 'mirror_axes': (), 'reduction_factor': 300},
+    'balanced': {'tile_step_size': 0.75, 'mirror_axes': (), 'reduction_factor': 100},
+    'accurate': {'tile_step_size': 0.5, 'mirror_axes': None, 'reduction_factor': 100},
+}
+
+# Preset for requests that don't choose one; if unset, the settings above (and zmesh's default simplification)
+default_preset = os.environ.get('ORTHOVIS_PRESET')
+assert default_preset is None or default_preset in presets, f'Unknown preset {default_preset}'
+
+# Run a synthetic prediction and meshing at load time, so cuDNN autotuning, lazy CUDA initialization and starting
+# the meshing workers happen before the first real request rather than during it
+warm_up_on_load = os.environ.get('ORTHOVIS_WARM_UP', '1') == '1'
+
+# How to get from the uploaded DICOM zip to an nnUNet prediction:
+#  - 'memory': decode the slices with pydicom straight from the zip bytes (no disk round-trip, no NIfTI)
+#  - 'nifti': extract to disk, read with SimpleITK and pass nnUNet a temporary NIfTI file
+dicom_read_mode = os.environ.get('ORTHOVIS_DICOM_READ_MODE', 'memory')
+
+# Model server worker processes on the instance (deploy.py sets this); each has its own meshing pool and CUDA cache
+model_server_workers = int(os.environ.get('SAGEMAKER_MODEL_SERVER_WORKERS', 1))
+
+# Worker processes for meshing labels in parallel; defaults to the CPUs shared out between model server workers
+meshing_workers = int(os.environ.get('ORTHOVIS_MESHING_WORKERS', max(os.cpu_count() // model_server_workers, 1)))
+
+# Release PyTorch's cached CUDA memory after each prediction, so the next model server worker to take the GPU has
+# the VRAM (costs re-allocating it next time); with this off, the GPU needs room for every worker's cache
+release_cuda_cache = os.environ.get('ORTHOVIS_RELEASE_CUDA_CACHE', '1') == '1'
+
+# Voxel-space connected components (rather than splitting meshes), with optional filtering of specks / extra parts
+voxel_components = os.environ.get('ORTHOVIS_VOXEL_COMPONENTS', '0') == '1'
+min_component_voxels = int(os.environ.get('ORTHOVIS_MIN_COMPONENT_VOXELS', 0))
+max_components_per_label = int(os.environ['ORTHOVIS_MAX_COMPONENTS_PER_LABEL']) if 'ORTHOVIS_MAX_COMPONENTS_PER_LABEL' in os.environ else None
+
+# Isotropic remeshing to this edge length (mm), for uniform triangles and predictable face counts; unset to disable
+target_edge_length_mm = float(os.environ['ORTHOVIS_TARGET_EDGE_LENGTH_MM']) if 'ORTHOVIS_TARGET_EDGE_LENGTH_MM' in os.environ else None
+
+# Coarser levels of detail sent ahead of the full meshes, as face count reductions separated by '+' (e.g. '4+16');
+# empty for none
+lod_factors = tuple(int(factor) for factor in os.environ.get('ORTHOVIS_LOD_FACTORS', '').split('+') if factor)
+
+# Dimensions for the per-request metrics, so e.g. dev and prod endpoints can be told apart in CloudWatch
+metrics_dimensions = {'Stack': os.environ.get('ORTHOVIS_STACK', 'local')}
+
+# Lock file the model server worker processes on the instance take turns on the GPU with (see pipeline.GpuWorker;
+# unset for pipeline.get_default_lock_path), and decoded volumes held per process (see inference.py)
+gpu_lock_path = os.environ.get('ORTHOVIS_GPU_LOCK')
+max_volumes_in_flight = int(os.environ.get('ORTHOVIS_MAX_VOLUMES_IN_FLIGHT', 2))
+
+# Cache of predicted labels and meshes, so re-uploads of the same series skip prediction and meshing: a local
+# directory (e.g. instance storage), 's3://bucket/prefix' or 'file:///directory' (see cache.get_cache); unset to disable
+cache_url = os.environ.get('ORTHOVIS_CACHE')
+cache_max_bytes = float(os.environ.get('ORTHOVIS_CACHE_MAX_GB', 20)) * 1024 ** 3
+
+
+def get_model_files(model_dir):
+    # What model_fn loads from the model directory, and so what identifies the model (see cache.hash_files)
+    return [f'{model_dir}/model/{file_name}' for file_name in ('plans.json', 'dataset.json', f'fold_{model_fold}/{checkpoint_name}')]
+
+
+def get_device_name(cuda_available):
+    # What to pass torch.device
+    if device_name == 'auto':
+        return 'cuda' if cuda_available else 'cpu'
+    return device_name
+
+
+def get_num_threads(device_type):
+    # Threads for torch (and nnUNet's cap on them while predicting) on this device; None leaves torch's default
+    return torch_threads if device_type == 'cpu' else None
+
+
+def get_autocast_dtype(device_type):
+    # Name of the torch dtype to run the network under autocast with on this device, if any beyond nnUNet's own
+    if device_type == 'cpu' and cpu_autocast == 'bf16':
+        return 'bfloat16'
+    return None
+
+
+def parse_custom_attributes(custom_attributes):
+    # SageMaker passes CustomAttributes through verbatim; we take 'key=value' pairs separated by ';' or ','
+    if not custom_attributes:
+        return {}
+    pairs = [pair.split('=', 1) for pair in custom_attributes.replace(',', ';').split(';') if '=' in pair]
+    return {key.strip().lower(): value.strip() for key, value in pairs}
+
+
+def get_request_settings(custom_attributes):
+    """
+    Settings for this request: the endpoint's (environment) settings, overridden by the preset named in the
+    request's CustomAttributes or else the endpoint's default preset.
+
+    Returns:
+        preset name (None if no preset applies), dict with tile_step_size, mirror_axes and reduction_factor
+    """
+    preset = custom_attributes.get('preset', default_preset)
+    return preset, get_settings(preset)
+
+
+def get_settings(preset=None):
+    # The environment's settings, overridden by the named preset if any
+    if preset is not None and preset not in presets:
+        raise errors.BadRequestError(f"Unknown preset {preset!r}, expected one of: {', '.join(presets)}")
+    settings = {'tile_step_size': tile_step_size, 'mirror_axes': None if use_mirroring else (), 'reduction_factor': 100}
+    if preset is not None:
+        settings.update(presets[preset])
+    return settings
+
+
+def parse_count(value):
+    count = int(value)
+    if count < 0:
+        raise ValueError(value)
+    return count
+
+
+def parse_flag(value):
+    if value not in ('0', '1'):
+        raise ValueError(value)
+    return value == '1'
+
+
+def parse_length(value):
+    length = float(value)
+    if not (math.isfinite(length) and length > 0):
+        raise ValueError(value)
+    return length
+
+
+def parse_lod_factors(value):
+    factors = tuple(int(factor) for factor in value.split('+'))
+    if any(factor < 1 for factor in factors):
+        raise ValueError(value)
+    return factors
+
+
+# CustomAttributes that override meshing options: the attribute, the convert_array_to_meshes option, how to parse
+# its value, what values are allowed, and whether 'none' unsets the option (only for options that can be unset)
+meshing_overrides = [
+    ('reduction_factor', 'reduction_factor', parse_count, 'a non-negative integer', False),
+    ('voxel_components', 'voxel_components', parse_flag, '0 or 1', False),
+    ('min_component_voxels', 'min_component_voxels', parse_count, 'a non-negative integer', False),
+    ('max_components_per_label', 'max_components_per_label', parse_count, 'a non-negative integer', True),
+    ('target_edge_length_mm', 'target_edge_length', parse_length, 'a positive number', True),
+    ('lod_factors', 'lod_factors', parse_lod_factors, "positive integers separated by '+' (e.g. 4+16)", True),
+]
+
+
+def get_meshing_options(settings, custom_attributes=None):
+    """
+    Keyword arguments for meshing.convert_array_to_meshes: the endpoint's settings and the preset's simplification,
+    overridden by any of meshing_overrides in the request's CustomAttributes ('none' unsets those that can be unset).
+    """
+    options = {
+        'reduction_factor': settings['reduction_factor'],
+        'voxel_components': voxel_components,
+        'min_component_voxels': min_component_voxels,
+        'max_components_per_label': max_components_per_label,
+        'target_edge_length': target_edge_length_mm,
+        'lod_factors': lod_factors,
+    }
+    custom_attributes = custom_attributes or {}
+    for name, option, parse, allowed, nullable in meshing_overrides:
+        if name in custom_attributes:
+            value = custom_attributes[name]
+            try:
+                if value.lower() == 'none' and nullable:
+                    options[option] = None
+                else:
+                    options[option] = parse(value)
+            except ValueError:
+                raise errors.BadRequestError(f"Invalid {name}={value!r}, expected {allowed}" + (" or 'none'" if nullable else '')) from None
+    return options
+
+
+def select_labels(label_to_name, custom_attributes):
+    # CustomAttribute labels=name1+name2 restricts meshing to those labels (others are treated as background)
+    if 'labels' not in custom_attributes:
+        return label_to_name
+    names = custom_attributes['labels'].split('+')
+    unknown = [name for name in names if name not in label_to_name.values()]
+    if unknown:
+        raise errors.BadRequestError(f"Unknown labels {'+'.join(unknown)}, expected some of: {'+'.join(label_to_name.values())}")
+    return {label: name for label, name in label_to_name.items() if name in names}
@@ -1,12 +1,9 @@
-import os
-import shutil
-import tarfile
-import tempfile
 import argparse
 
 import boto3
 import sagemaker
-from sagemaker.s3 import S3Uploader
+
+import model_package
 
 
 role = 'arn:aws:iam::643058308155:role/SageMakerExecutionRole'
@@ -32,64 +29,14 @@ def get_sns_topics(stack):
         'ErrorTopic': f'arn:aws:sns:eu-west-1:643058308155:orthovis-{stack}-meshing-failed',
     }
 
-def create_sagemaker_model_package(model_folder_path):
-    """
-    Create a SageMaker model package with the required folder structure.
-    
-    This function creates a tar.gz file with the following structure:
-    ```
-    model_and_code.tar.gz
-    ├── code/
-    │   ├── requirements.txt
-    │   ├── sagemaker_entrypoint.py
-    │   └── meshing.py
-    └── model/
-        └── [nnUNet model files]
-    ```
-    
-    Args:
-        model_folder_path: Path to the nnUNet model folder
-    
-    Returns:
-        Path to the created tar.gz file
-    """
-    # Create temporary directory for the model package
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Create the SageMaker required folder structure
-        code_dir = os.path.join(temp_dir, 'code')
-        os.makedirs(code_dir, exist_ok=True)
-        
-        # Copy required files from current directory
-        required_files = ['requirements.txt', 'inference.py', 'meshing.py']
-        for src_path in required_files:
-            dst_path = os.path.join(code_dir, src_path)
-            shutil.copy2(src_path, dst_path)
-        
-        # Copy model folder to the model directory
-        # FIXME: only copy the relevant stuff (so not progress.png and similar -- see the nnunet export script; restrict to one fold if relevant!)
-        model_dir = os.path.join(temp_dir, 'model')
-        shutil.copytree(model_folder_path, model_dir)
-
-        assert os.path.exists(f'{model_dir}/fold_all'), 'fold_all does not exist in model folder -- inference script will fail!'
-
-        # Create .tar.gz file
-        filename = 'model_and_code.tar.gz'
-        with tarfile.open(filename, 'w:gz') as tar:
-            # Add the contents of temp_dir directly to the root of the tar
-            for item in os.listdir(temp_dir):
-                item_path = os.path.join(temp_dir, item)
-                tar.add(item_path, arcname=item)
-        
-        return filename
-
-
-def deploy(sm_session, sm_client, autoscaling_client, cw_client, boto_session, stack, nnunet_path):
+def deploy(sm_session, sm_client, autoscaling_client, cw_client, boto_session, stack, nnunet_path, fold='all', checkpoint_name='checkpoint_best.pth'):
 
     sm_bucket = sm_session.default_bucket()
     region = boto_session.region_name
 
-    filename = create_sagemaker_model_package(nnunet_path)
-    model_artifact = S3Uploader.upload(filename, f's3://{sm_bucket}/{stack}/meshing', sagemaker_session=sm_session)
+    # Named by content, so redeploying an unchanged model and code skips the upload
+    filename = model_package.create_sagemaker_model_package(nnunet_path, fold=fold, checkpoint_name=checkpoint_name)
+    model_artifact = model_package.upload_model_package(boto_session.client('s3'), filename, sm_bucket, f'{stack}/meshing')
     print(model_artifact)
 
     instance_type = 'ml.g4dn.2xlarge'
@@ -117,8 +64,14 @@ def deploy(sm_session, sm_client, autoscaling_client, cw_client, boto_session, s
             'ModelDataUrl': model_artifact,
             'Environment': {
                 'TS_MAX_REQUEST_SIZE': str(1024 ** 3),  # default max request size is 6 Mb for torchserve, need to increase
-                'TS_MAX_RESPONSE_SIZE': str(1024 ** 3),
+                'TS_MAX_RESPONSE_SIZE': str(1024 ** 3),  # JSON responses can be large; binary ones (see serialization.py) much less so
                 'TS_DEFAULT_RESPONSE_TIMEOUT': '600',
+                'ORTHOVIS_STACK': stack,  # dimension for the per-request metrics (see metrics.py)
+                'ORTHOVIS_MODEL_FOLD': fold,  # the one fold and checkpoint in the package
+                'ORTHOVIS_CHECKPOINT': checkpoint_name,
+                # One model server worker per concurrent invocation (below), so one request can decode / mesh while
+                # the other predicts; the workers take turns on the GPU (see pipeline.py)
+                'SAGEMAKER_MODEL_SERVER_WORKERS': '2',
             }
         },
     )
@@ -309,6 +262,8 @@ def main():
     parser.add_argument('--region', type=str, default='eu-west-1', help='AWS region name')
     parser.add_argument('--stack', type=str, required=True, choices=['test', 'dev', 'prod'], help='Stack environment')
     parser.add_argument('--nnunet-path', type=str, help='Path to the nnUNet model folder')
+    parser.add_argument('--fold', type=str, default='all', help="nnUNet fold to deploy ('all' or a fold number)")
+    parser.add_argument('--checkpoint', type=str, default='checkpoint_best.pth', help='Checkpoint file of that fold to deploy')
     parser.add_argument('--profile', type=str, help='AWS profile name')
     args = parser.parse_args()
     
@@ -322,7 +277,7 @@ def main():
         undeploy(sm_client, autoscaling_client, cw_client, args.stack)
     else:
         assert args.nnunet_path is not None, "--nnunet-path is required for deployment"
-        deploy(sm_session, sm_client, autoscaling_client, cw_client, boto_session, args.stack, args.nnunet_path)
+        deploy(sm_session, sm_client, autoscaling_client, cw_client, boto_session, args.stack, args.nnunet_path, args.fold, args.checkpoint)
 
 
 if __name__ == "__main__":
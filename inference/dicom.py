@@ -0,0 +1,170 @@
+import io
+import time
+import zipfile
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from metrics import add_duration
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# Minimum |cosine| between the slice normal and the patient z-axis for a series to count as axial
+axial_tolerance = 0.9
+
+
+def get_slice_normal(orientation):
+    # ImageOrientationPatient holds the row (x) direction cosines followed by the column (y) ones
+    row_cosines = np.asarray(orientation[:3], dtype=np.float64)
+    col_cosines = np.asarray(orientation[3:], dtype=np.float64)
+    return np.cross(row_cosines, col_cosines)
+
+
+def is_axial(orientation):
+    return abs(get_slice_normal(orientation)[2]) >= axial_tolerance
+
+
+def sort_slices(datasets):
+    # Same ordering as GDCM's IPP sorter (used by sitk.ImageSeriesReader.GetGDCMSeriesFileNames), i.e.
+    # ascending by the projection of ImagePositionPatient onto the slice normal
+    normal = get_slice_normal(datasets[0].ImageOrientationPatient)
+    return sorted(datasets, key=lambda ds: float(np.dot(normal, np.asarray(ds.ImagePositionPatient, dtype=np.float64))))
+
+
+def get_geometry(sorted_datasets):
+    """
+    Compute spacing, origin and direction as sitk.ImageSeriesReader would for the given sorted slices.
+
+    Returns:
+        spacing_xyz, origin_xyz, direction (row-major 3x3 flattened, columns are the x/y/z axes)
+    """
+    first, last = sorted_datasets[0], sorted_datasets[-1]
+    orientation = np.asarray(first.ImageOrientationPatient, dtype=np.float64)
+    normal = get_slice_normal(orientation)
+    pixel_spacing = [float(value) for value in first.PixelSpacing]  # row spacing (y), column spacing (x)
+
+    # As ITK, take the slice spacing as the mean distance between slice positions
+    origin = np.asarray(first.ImagePositionPatient, dtype=np.float64)
+    if len(sorted_datasets) > 1:
+        span = np.asarray(last.ImagePositionPatient, dtype=np.float64) - origin
+        z_spacing = float(np.linalg.norm(span)) / (len(sorted_datasets) - 1)
+    else:
+        z_spacing = float(getattr(first, 'SliceThickness', 1.))
+
+    spacing_xyz = (pixel_spacing[1], pixel_spacing[0], z_spacing)
+    direction = tuple(np.stack([orientation[:3], orientation[3:], normal], axis=1).flatten().tolist())
+    return spacing_xyz, tuple(origin.tolist()), direction
+
+
+def read_header(zip_file, file_name):
+    # Parse only up to the pixel data; for deflated members only the header bytes get decompressed
+    with zip_file.open(file_name) as f:
+        try:
+            header = pydicom.dcmread(f, stop_before_pixels=True)
+        except InvalidDicomError:
+            logger.warning(f"Skipping non-DICOM file {file_name}")
+            return None
+    if 'SeriesInstanceUID' not in header or 'ImagePositionPatient' not in header or 'ImageOrientationPatient' not in header:
+        logger.warning(f"Skipping DICOM file without series UID or image position/orientation: {file_name}")
+        return None
+    header.filename = file_name
+    return header
+
+
+def index_series(zip_file, num_workers=None):
+    """
+    Read just the DICOM headers of every file in the zip, grouped by series.
+
+    Returns:
+        dict mapping SeriesInstanceUID to the list of headers (pydicom datasets without pixel data) for its
+        files; each header's `filename` is the name of its member in the zip
+    """
+    file_names = [info.filename for info in zip_file.infolist() if not info.is_dir()]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        headers = list(executor.map(lambda file_name: read_header(zip_file, file_name), file_names))
+
+    series_uid_to_headers = defaultdict(list)
+    for header in headers:
+        if header is not None:
+            series_uid_to_headers[str(header.SeriesInstanceUID)].append(header)
+    return dict(series_uid_to_headers)
+
+
+def select_series(series_uid_to_headers):
+    """
+    Choose the series to segment: the axial one with most slices (so not scouts or sagittal/coronal
+    reformats), falling back to the largest series of any orientation.
+    """
+    assert len(series_uid_to_headers) > 0, 'No DICOM series found in zip'
+
+    for series_uid, headers in series_uid_to_headers.items():
+        description = getattr(headers[0], 'SeriesDescription', '')
+        axial = is_axial(headers[0].ImageOrientationPatient)
+        logger.info(f"Found series {series_uid} ({description}): {len(headers)} slices, {'axial' if axial else 'not axial'}")
+
+    def priority(series_uid):
+        headers = series_uid_to_headers[series_uid]
+        return is_axial(headers[0].ImageOrientationPatient), len(headers)
+
+    series_uid = max(series_uid_to_headers, key=priority)
+    logger.info(f"Selected series {series_uid}")
+    return series_uid
+
+
+def decode_slice(zip_file, file_name):
+    dataset = pydicom.dcmread(io.BytesIO(zip_file.read(file_name)))
+    pixels = dataset.pixel_array.astype(np.float32)
+    slope = float(getattr(dataset, 'RescaleSlope', 1.))
+    intercept = float(getattr(dataset, 'RescaleIntercept', 0.))
+    if slope != 1.:
+        pixels *= slope
+    if intercept != 0.:
+        pixels += intercept
+    return pixels
+
+
+def decode_series(zip_file, sorted_headers, num_workers=None):
+    # Each worker decodes one slice and writes it into its place in the preallocated volume
+    volume_zyx = np.empty((len(sorted_headers), int(sorted_headers[0].Rows), int(sorted_headers[0].Columns)), dtype=np.float32)
+
+    def decode_into_volume(z):
+        volume_zyx[z] = decode_slice(zip_file, sorted_headers[z].filename)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(decode_into_volume, range(len(sorted_headers))))
+
+    return volume_zyx
+
+
+def read_series_from_zip(zip_bytes, num_workers=None, timings=None):
+    """
+    Decode the DICOM slices in a zip archive straight into a numpy volume, without touching the disk.
+
+    Only headers are read for all files; pixel data is decoded (in parallel) just for the selected series.
+
+    Args:
+        zip_bytes: Raw bytes of the zip file
+        num_workers: Number of threads for header parsing and decoding (None for the executor default)
+        timings: optional dict, to which seconds spent indexing headers ('unzip') and decoding pixel data
+            ('dicom_read') are added
+
+    Returns:
+        volume_zyx (float32, indexed as sitk.GetArrayFromImage would be), spacing_xyz, origin_xyz, direction
+    """
+    start_time = time.perf_counter()
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as zip_file:
+        series_uid_to_headers = index_series(zip_file, num_workers)
+        headers = sort_slices(series_uid_to_headers[select_series(series_uid_to_headers)])
+        spacing_xyz, origin_xyz, direction = get_geometry(headers)
+        start_time = add_duration(timings, 'unzip', start_time)
+        volume_zyx = decode_series(zip_file, headers, num_workers)
+        add_duration(timings, 'dicom_read', start_time)
+
+    return volume_zyx, spacing_xyz, origin_xyz, direction
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import uuid
+import queue
+import argparse
+import threading
+
+import numpy as np
+
+import cache
+
+
+class Context:
+    # Stands in for the (torchserve) context transform_fn gets, with the request's CustomAttributes header
+    def __init__(self, custom_attributes):
+        self.custom_attributes = custom_attributes
+
+    def get_request_header(self, idx, name):
+        return self.custom_attributes if name == 'X-Amzn-SageMaker-Custom-Attributes' else None
+
+
+def split_s3_url(url):
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class AsyncEndpoint:
+    """
+    Local stand-in for a SageMaker asynchronous endpoint as deploy.py sets it up: invocations name an input
+    object, wait in a queue, and are processed at most max_concurrent_invocations at a time per instance; the
+    response is written to output_path/<inference id>.out (or the error to failure_path/<inference id>-error.out)
+    and a notification goes to on_success or on_error, shaped like the SNS messages.
+
+    Objects live in a cache.DirectoryObjectStore (or anything with the same boto3-like methods). Invocations run
+    on threads of this process, sharing one predictor, where the endpoint runs model server worker processes;
+    the handler's GPU worker (see pipeline.py) serializes prediction either way.
+    """
+
+    def __init__(
+        self, transform_fn, predictor, store, output_path, failure_path=None, max_concurrent_invocations=2,
+        num_instances=1, on_success=None, on_error=None, endpoint_name='local',
+    ):
+        self.transform_fn = transform_fn
+        self.predictor = predictor
+        self.store = store
+        self.output_path = output_path.rstrip('/')
+        self.failure_path = (failure_path or output_path).rstrip('/')
+        self.num_instances = num_instances
+        self.on_success = on_success
+        self.on_error = on_error
+        self.endpoint_name = endpoint_name
+        self.invocations = queue.Queue()
+        self.lock = threading.Lock()
+        self.num_in_flight = 0
+        self.records = []
+        self.threads = [
+            threading.Thread(target=self.run, name=f'invocation-{idx}', daemon=True)
+            for idx in range(max_concurrent_invocations * num_instances)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def invoke_endpoint_async(self, InputLocation, ContentType='application/zip', Accept='application/json', CustomAttributes=None, InferenceId=None):
+        # Same arguments and response as the sagemaker-runtime client's method
+        inference_id = InferenceId or str(uuid.uuid4())
+        output_location = f'{self.output_path}/{inference_id}.out'
+        invocation = {
+            'inference_id': inference_id,
+            'input_location': InputLocation,
+            'output_location': output_location,
+            'content_type': ContentType,
+            'accept': Accept,
+            'custom_attributes': CustomAttributes,
+            'received_time': time.time(),
+        }
+        with self.lock:
+            self.num_in_flight += 1
+        self.invocations.put(invocation)
+        return {'InferenceId': inference_id, 'OutputLocation': output_location}
+
+    def get_backlog_size(self):
+        # As CloudWatch's ApproximateBacklogSize: invocations queued or being processed
+        with self.lock:
+            return self.num_in_flight
+
+    def run(self):
+        while True:
+            invocation = self.invocations.get()
+            start_time = time.time()
+            try:
+                bucket, key = split_s3_url(invocation['input_location'])
+                request_body = self.store.get_object(Bucket=bucket, Key=key)['Body'].read()
+                response, content_type = self.transform_fn(
+                    self.predictor, request_body, invocation['content_type'], invocation['accept'], Context(invocation['custom_attributes']),
+                )
+                body = response if isinstance(response, bytes) else json.dumps(response).encode()
+                bucket, key = split_s3_url(invocation['output_location'])
+                self.store.put_object(Bucket=bucket, Key=key, Body=body)
+                status, error = 'Completed', None
+            except Exception as e:
+                bucket, key = split_s3_url(f"{self.failure_path}/{invocation['inference_id']}-error.out")
+                self.store.put_object(Bucket=bucket, Key=key, Body=repr(e).encode())
+                status, error, content_type = 'Failed', repr(e), None
+            end_time = time.time()
+
+            notification = self.get_notification(invocation, status, content_type, error)
+            with self.lock:
+                self.num_in_flight -= 1
+                self.records.append({
+                    'inference_id': invocation['inference_id'],
+                    'status': status,
+                    'queue_seconds': start_time - invocation['received_time'],
+                    'latency_seconds': end_time - invocation['received_time'],
+                    'end_time': end_time,
+                })
+            callback = self.on_success if status == 'Completed' else self.on_error
+            if callback is not None:
+                callback(notification)
+
+    def get_notification(self, invocation, status, content_type, error):
+        # The fields of SageMaker's async notification messages that clients use
+        notification = {
+            'eventVersion': '1.0',
+            'eventSource': 'aws:sagemaker',
+            'eventName': 'InferenceResult' if status == 'Completed' else 'InferenceFailure',
+            'receivedTime': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(invocation['received_time'])),
+            'invocationStatus': status,
+            'inferenceId': invocation['inference_id'],
+            'requestParameters': {
+                'endpointName': self.endpoint_name,
+                'inputLocation': invocation['input_location'],
+                'contentType': invocation['content_type'],
+                'accept': invocation['accept'],
+                'customAttributes': invocation['custom_attributes'],
+            },
+        }
+        if status == 'Completed':
+            notification['responseParameters'] = {'outputLocation': invocation['output_location'], 'contentType': content_type}
+        else:
+            notification['failureReason'] = error
+            notification['responseParameters'] = {'failureLocation': f"{self.failure_path}/{invocation['inference_id']}-error.out"}
+        return notification
+
+    def wait(self, num_invocations, timeout=None):
+        # Until num_invocations have finished (completed or failed)
+        deadline = None if timeout is None else time.time() + timeout
+        while len(self.records) < num_invocations:
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError(f'{len(self.records)} of {num_invocations} invocations finished')
+            time.sleep(0.01)
+
+
+def get_arrival_times(num_requests, rate_per_minute, arrival='poisson', seed=0):
+    # Seconds from the start at which each request arrives
+    interval = 60. / rate_per_minute
+    if arrival == 'constant':
+        return np.arange(num_requests) * interval
+    return np.concatenate([[0.], np.cumsum(np.random.default_rng(seed).exponential(interval, size=num_requests - 1))])
+
+
+def summarize(records, backlog_samples, num_instances, elapsed_seconds):
+    latencies = np.asarray([record['latency_seconds'] for record in records if record['status'] == 'Completed'])
+    queue_times = np.asarray([record['queue_seconds'] for record in records])
+    backlog = np.asarray([size for _, size in backlog_samples]) / num_instances
+    summary = {
+        'num_completed': int(len(latencies)),
+        'num_failed': sum(record['status'] == 'Failed' for record in records),
+        'elapsed_seconds': elapsed_seconds,
+        'throughput_per_hour': 3600 * len(latencies) / elapsed_seconds,
+        'throughput_per_hour_per_instance': 3600 * len(latencies) / elapsed_seconds / num_instances,
+        'backlog_per_instance_mean': float(backlog.mean()) if len(backlog) else 0.,
+        'backlog_per_instance_max': float(backlog.max()) if len(backlog) else 0.,
+    }
+    for name, values in [('latency', latencies), ('queue', queue_times)]:
+        for percentile in (50, 95, 99):
+            summary[f'{name}_p{percentile}_seconds'] = float(np.percentile(values, percentile)) if len(values) else None
+    return summary
+
+
+def run_load(endpoint, input_locations, arrival_times, invoke_kwargs, sample_interval=1.):
+    """
+    Invoke the endpoint for each input location at its arrival time (cycling through the inputs), sampling the
+    backlog meanwhile, and wait for all invocations to finish.
+
+    Returns:
+        summary dict (see summarize), list of (seconds since start, backlog size) samples
+    """
+    start_time = time.time()
+    num_earlier = len(endpoint.records)
+    backlog_samples = []
+    stop = threading.Event()
+
+    def sample_backlog():
+        while not stop.is_set():
+            backlog_samples.append((time.time() - start_time, endpoint.get_backlog_size()))
+            stop.wait(sample_interval)
+
+    sampler = threading.Thread(target=sample_backlog, daemon=True)
+    sampler.start()
+    for idx, arrival_time in enumerate(arrival_times):
+        time.sleep(max(arrival_time - (time.time() - start_time), 0))
+        endpoint.invoke_endpoint_async(InputLocation=input_locations[idx % len(input_locations)], **invoke_kwargs)
+    endpoint.wait(num_earlier + len(arrival_times))
+    stop.set()
+    sampler.join()
+
+    summary = summarize(endpoint.records[num_earlier:], backlog_samples, endpoint.num_instances, time.time() - start_time)
+    return summary, backlog_samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the handler locally, as deploy.py's asynchronous endpoint would run it")
+    parser.add_argument('bucket_dir', type=str, help="Directory standing in for S3: one subdirectory per bucket, inputs in 'uploads'")
+    parser.add_argument('--model-dir', type=str, required=True, help="Directory containing the nnUNet model folder as 'model' (as for model_fn)")
+    parser.add_argument('--requests', type=int, default=20, help='Number of invocations (cycling through the inputs)')
+    parser.add_argument('--rate', type=float, default=2., help='Arrivals per minute')
+    parser.add_argument('--arrival', type=str, choices=['poisson', 'constant'], default='poisson', help='Arrival process')
+    parser.add_argument('--max-concurrent-invocations', type=int, default=2, help="MaxConcurrentInvocationsPerInstance, as in deploy.py")
+    parser.add_argument('--accept', type=str, default='application/x-orthovis-meshes', help='Accept header for each invocation')
+    parser.add_argument('--custom-attributes', type=str, help='CustomAttributes for each invocation, e.g. preset=fast')
+    parser.add_argument('--target-latency', type=float, default=600., help='Latency (seconds) to size the autoscaling TargetValue for')
+    parser.add_argument('--output', type=str, default='emulate_async.json', help='Where to write the summary and samples (JSON)')
+    args = parser.parse_args()
+
+    # Imported here, so the emulator itself (and its test) don't need torch and nnUNet
+    import inference
+
+    store = cache.DirectoryObjectStore(args.bucket_dir)
+    input_locations = [f"s3://uploads/{obj['Key']}" for obj in store.list_objects_v2(Bucket='uploads')['Contents']]
+    assert input_locations, f"No inputs in {os.path.join(args.bucket_dir, 'uploads')}"
+    notifications = []
+
+    predictor = inference.model_fn(args.model_dir)
+    endpoint = AsyncEndpoint(
+        inference.transform_fn, predictor, store, 's3://results', 's3://failures', args.max_concurrent_invocations,
+        on_success=notifications.append, on_error=notifications.append,
+    )
+    arrival_times = get_arrival_times(args.requests, args.rate, args.arrival)
+    print(f"{args.requests} invocations over {arrival_times[-1] / 60:.1f} minutes ({args.arrival}, {args.rate}/minute)")
+    summary, backlog_samples = run_load(
+        endpoint, input_locations, arrival_times, {'Accept': args.accept, 'CustomAttributes': args.custom_attributes},
+    )
+
+    # An instance drains its backlog at its throughput, so this backlog per instance is cleared within the target
+    # latency; TargetValue (for ApproximateBacklogSizePerInstance) should be at most that
+    summary['target_value_for_target_latency'] = summary['throughput_per_hour_per_instance'] * args.target_latency / 3600
+    for name, value in summary.items():
+        print(f'{name:<40} {value:.2f}' if isinstance(value, float) else f'{name:<40} {value}')
+    with open(args.output, 'w') as f:
+        json.dump({'args': vars(args), 'summary': summary, 'backlog': backlog_samples, 'notifications': notifications}, f, indent=2)
+    print(f'Written {args.output}')
+
+
+if __name__ == '__main__':
+    main()
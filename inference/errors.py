@@ -0,0 +1,21 @@
+try:
+    # The SageMaker inference toolkit (in the serving container) responds to its errors with their status code and
+    # message; any other exception is a 500
+    from sagemaker_inference.errors import BaseInferenceToolkitError
+except ImportError:  # e.g. batch.py and tests, outside the container
+    class BaseInferenceToolkitError(Exception):
+        def __init__(self, status_code, message, phrase):
+            self.status_code = status_code
+            self.message = message
+            self.phrase = phrase
+            super().__init__(status_code, message, phrase)
+
+
+class BadRequestError(BaseInferenceToolkitError):
+    """A request we can't serve as asked, e.g. an unknown preset: a 400 with the message (which lists what's allowed)."""
+
+    def __init__(self, message):
+        super().__init__(400, message, 'Bad Request')
+
+    def __str__(self):
+        return self.message
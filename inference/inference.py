@@ -1,86 +1,484 @@
+import time
+# Module imports are the first phase of loading the model (see model_fn)
+import_start_time = time.perf_counter()
+
 import io
 import os
 import zipfile
 import logging
 import tempfile
+import contextlib
 
 import torch
+import numpy as np
 import SimpleITK as sitk
+import nnunetv2.inference.predict_from_raw_data
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
 
+import cache
+import config
+import dicom
 import meshing
+import localization
+import metrics
+import pipeline
+import serialization
+import tiling
 
+import_seconds = time.perf_counter() - import_start_time
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+# Endpoint settings (ORTHOVIS_* environment variables) are in config.py
+
+# Requests in flight in this process share one GPU worker thread, which runs predictions in arrival order while
+# other requests decode, mesh and serialize; the lock file makes model server worker processes on the instance take
+# turns too. On the endpoint each process only has one request at a time, so the lock file is what coordinates
+# them, and ORTHOVIS_MAX_VOLUMES_IN_FLIGHT (decoded volumes held per process) only limits callers that run
+# requests on several threads of one process (batch.py, emulate_async.py)
+gpu_worker = pipeline.GpuWorker(config.gpu_lock_path or pipeline.get_default_lock_path())
+volume_slots = pipeline.VolumeSlots(config.max_volumes_in_flight)
+
+# Cache of predicted labels and meshes (see config.cache_url); None if disabled
+result_cache = cache.get_cache(config.cache_url, config.cache_max_bytes)
+
+
+def get_device():
+    return torch.device(config.get_device_name(torch.cuda.is_available()))
+
+
+def get_autocast(device):
+    dtype = config.get_autocast_dtype(device.type)
+    return torch.autocast(device.type, dtype=getattr(torch, dtype)) if dtype is not None else contextlib.nullcontext()
+
+
 def model_fn(model_dir):
-    predictor = nnUNetPredictor(
-        device=torch.device('cuda'),
-        verbose=True,
-        verbose_preprocessing=True,
-        allow_tqdm=False,
-    )
-    files = [os.path.relpath(os.path.join(dp, f), model_dir) for dp, dn, filenames in os.walk(model_dir) for f in filenames]
-    logger.debug(f'model_dir: {model_dir}, files: {files}')
-    predictor.initialize_from_trained_model_folder(f'{model_dir}/model', use_folds=['all'], checkpoint_name='checkpoint_best.pth')
+    # Report each phase of loading, so we can see where cold starts go
+    load_metrics = metrics.RequestMetrics(dimensions=config.metrics_dimensions)
+    load_metrics.add_timings({'imports': import_seconds}, prefix='load_')
+
+    device = get_device()
+    num_threads = config.get_num_threads(device.type)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+        # predict_logits_from_preprocessed_data limits torch to this many threads while predicting
+        nnunetv2.inference.predict_from_raw_data.default_num_processes = num_threads
+    logger.info(f'Using device {device}' + (f' with {num_threads} threads, autocast {config.get_autocast_dtype(device.type)}' if num_threads is not None else ''))
+
+    with load_metrics.span('load_initialize'):
+        predictor = nnUNetPredictor(
+            tile_step_size=config.tile_step_size,
+            use_mirroring=config.use_mirroring,
+            perform_everything_on_device=config.perform_everything_on_device and device.type == 'cuda',
+            device=device,
+            verbose=True,
+            verbose_preprocessing=True,
+            allow_tqdm=False,
+        )
+        files = [os.path.relpath(os.path.join(dp, f), model_dir) for dp, dn, filenames in os.walk(model_dir) for f in filenames]
+        logger.debug(f'model_dir: {model_dir}, files: {files}')
+        predictor.initialize_from_trained_model_folder(f'{model_dir}/model', use_folds=[config.model_fold], checkpoint_name=config.checkpoint_name)
+
+    # Part of cache keys, so a new model never serves results of an old one
+    predictor.model_checksum = None
+    if result_cache is not None:
+        with load_metrics.span('load_checksum'):
+            predictor.model_checksum = cache.hash_files(config.get_model_files(model_dir))
+
+    if config.warm_up_on_load:
+        warm_up(predictor, load_metrics)
+
+    load_metrics.emit()
     return predictor
 
 
-def transform_fn(predictor, request_body, content_type, accept):
+def warm_up(predictor, load_metrics):
+    # One patch of air at the network's target spacing: a single sliding-window tile at the same shape as real
+    # requests use (so cuDNN's autotuned kernels carry over). It goes through preprocessing and resampling back as
+    # requests do, though at target spacing neither changes its shape. Not zeros, which nnUNet would crop away as empty.
+    # Patch size and target spacing are in the network's (transposed) axis order, and preprocessing transposes the
+    # image forward, so the image is given in the original order
+    plans_manager, configuration_manager = predictor.plans_manager, predictor.configuration_manager
+    volume_zyx = np.full(configuration_manager.patch_size, -1000., dtype=np.float32).transpose(plans_manager.transpose_backward)
+    image_properties = {'spacing': [configuration_manager.spacing[i] for i in plans_manager.transpose_backward]}
+    warm_up_metrics = metrics.RequestMetrics()
+    start_time = time.perf_counter()
+    data, properties = preprocess_npy(predictor, volume_zyx, image_properties, warm_up_metrics)
+    assert tuple(data.shape[1:]) == tuple(configuration_manager.patch_size), f'Warm-up patch preprocessed to {data.shape[1:]}, not the patch size {configuration_manager.patch_size}'
+    predict_preprocessed(predictor, data, properties, config.get_settings(config.default_preset), warm_up_metrics)
+    load_metrics.add_nested('load_warm_up_prediction', time.perf_counter() - start_time, warm_up_metrics)
+
+    # All meshing worker processes, started explicitly (a binary model's one ball below is meshed in-process), then a
+    # ball per label with the same options as requests
+    label_to_name = {label: name for name, label in predictor.label_manager.label_dict.items() if label != 0}
+    labels_xyz = np.zeros((24 * max(len(label_to_name), 1), 24, 24), dtype=np.uint8)
+    x, y, z = np.ogrid[:24, :24, :24]
+    ball = (x - 12) ** 2 + (y - 12) ** 2 + (z - 12) ** 2 < 8 ** 2
+    for idx, label in enumerate(sorted(label_to_name)):
+        labels_xyz[24 * idx : 24 * (idx + 1)][ball] = label
+    with load_metrics.span('load_warm_up_meshing'):
+        meshing.start_workers(config.meshing_workers)
+        mesh_labels(labels_xyz, (1., 1., 1.), label_to_name, config.get_meshing_options(config.get_settings(config.default_preset)))
+
+
+def preprocess_npy(predictor, volume_zyx, image_properties, request_metrics):
+    with request_metrics.span('preprocessing'):
+        preprocessor = predictor.configuration_manager.preprocessor_class(verbose=predictor.verbose)
+        data, _, properties = preprocessor.run_case_npy(
+            volume_zyx[None], None, image_properties,
+            predictor.plans_manager, predictor.configuration_manager, predictor.dataset_json,
+        )
+    return data, properties
+
 
-    with tempfile.TemporaryDirectory(prefix='case_') as temp_dir:
+def predict_logits(predictor, data, settings):
+    # Runs on the GPU worker thread, one request at a time, so the shared predictor's settings can be swapped
+    start_time = time.perf_counter()
+    with predictor_settings(predictor, settings), get_autocast(predictor.device):
+        predicted_logits = predictor.predict_logits_from_preprocessed_data(torch.from_numpy(data)).cpu()
+    if config.release_cuda_cache and predictor.device.type == 'cuda':
+        # Still holding the GPU lock, so the next process to take it finds the memory free
+        torch.cuda.empty_cache()
+    return predicted_logits, start_time
 
-        # Assuming request body is a zip, extract all files to temporary directory
+
+def predict_preprocessed(predictor, data, properties, settings, request_metrics):
+    # What nnUNetPredictor.predict_single_npy_array / predict_from_files do after preprocessing, split into
+    # separately timed spans; only the network runs on the GPU worker, while resampling (like preprocessing) stays
+    # on the request's thread
+    if config.memory_budget_gb is not None:
+        rows_per_slab, margin = get_slab_rows(predictor, data, properties)
+        if rows_per_slab < data.shape[1]:
+            return predict_preprocessed_in_slabs(predictor, data, properties, settings, rows_per_slab, margin, request_metrics)
+
+    submit_time = time.perf_counter()
+    with request_metrics.span('prediction'):
+        predicted_logits, start_time = gpu_worker.submit(predict_logits, predictor, data, settings).result()
+    request_metrics.add_timings({'gpu_queue_wait': start_time - submit_time})
+    with request_metrics.span('resampling'):
+        predicted_labels_zyx = convert_predicted_logits_to_segmentation_with_correct_shape(
+            predicted_logits, predictor.plans_manager, predictor.configuration_manager, predictor.label_manager,
+            properties, return_probabilities=False,
+        )
+    return predicted_labels_zyx
+
+
+def get_slab_rows(predictor, data, properties):
+    """
+    Rows (along the first axis of the preprocessed volume) per slab that keep prediction within the memory budget,
+    and rows of context to predict either side of each slab (half a patch, as sliding window tiles overlap).
+    """
+    num_classes = predictor.label_manager.num_segmentation_heads
+    shape_out = properties['shape_after_cropping_and_before_resampling']
+    rows_out_per_row = shape_out[0] / data.shape[1]
+    # Per row: the input, the network's float16 logits, and resampled logits (with float32 and float64 temporaries)
+    bytes_per_row = (
+        data.shape[0] * np.prod(data.shape[2:]) * 4
+        + num_classes * np.prod(data.shape[2:]) * 2
+        + num_classes * np.prod(shape_out[1:]) * rows_out_per_row * 12
+    )
+    patch_rows = predictor.configuration_manager.patch_size[0]
+    margin = patch_rows // 2
+    return tiling.get_rows_per_slab(config.memory_budget_gb * 1024 ** 3, bytes_per_row, margin, patch_rows), margin
+
+
+def predict_preprocessed_in_slabs(predictor, data, properties, settings, rows_per_slab, margin, request_metrics):
+    # As predict_preprocessed and convert_predicted_logits_to_segmentation_with_correct_shape, a slab at a time,
+    # so only a slab's logits are ever held; each slab goes through the GPU worker separately, so other requests'
+    # predictions can run in between
+    plans_manager, configuration_manager, label_manager = predictor.plans_manager, predictor.configuration_manager, predictor.label_manager
+    spacing_transposed = [properties['spacing'][i] for i in plans_manager.transpose_forward]
+    current_spacing = configuration_manager.spacing if len(configuration_manager.spacing) == len(
+        properties['shape_after_cropping_and_before_resampling']
+    ) else [spacing_transposed[0], *configuration_manager.spacing]
+    num_slabs = len(tiling.plan_slabs(data.shape[1], rows_per_slab, margin))
+    logger.info(f"Predicting in {num_slabs} slabs of {rows_per_slab} rows, to stay within {config.memory_budget_gb} GB")
+    request_metrics.set('prediction_slabs', num_slabs, 'Count')
+
+    queue_waits = []
+
+    def predict_slab(slab):
+        submit_time = time.perf_counter()
+        with request_metrics.span('prediction'):
+            predicted_logits, start_time = gpu_worker.submit(predict_logits, predictor, slab, settings).result()
+        queue_waits.append(start_time - submit_time)
+        return predicted_logits
+
+    def resample(predicted_logits, shape):
+        with request_metrics.span('resampling'):
+            return configuration_manager.resampling_fn_probabilities(predicted_logits, shape, current_spacing, spacing_transposed)
+
+    def to_labels(predicted_logits):
+        with request_metrics.span('resampling'):
+            segmentation = label_manager.convert_logits_to_segmentation(predicted_logits)
+        return segmentation.cpu().numpy() if isinstance(segmentation, torch.Tensor) else segmentation
+
+    segmentation = tiling.predict_in_slabs(
+        data, properties['shape_after_cropping_and_before_resampling'], rows_per_slab, margin, predict_slab, resample, to_labels,
+        dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16,
+    )
+    request_metrics.add_timings({'gpu_queue_wait': sum(queue_waits)})
+
+    # Revert cropping and transposition, as nnUNet does
+    predicted_labels = np.zeros(properties['shape_before_cropping'], dtype=segmentation.dtype)
+    predicted_labels[tuple(slice(start, stop) for start, stop in properties['bbox_used_for_cropping'])] = segmentation
+    return predicted_labels.transpose(plans_manager.transpose_backward)
+
+
+def read_via_nifti(request_body, temp_dir, request_metrics):
+
+    # Assuming request body is a zip, extract just the files of the selected series to temporary directory
+    with request_metrics.span('unzip'):
         with zipfile.ZipFile(io.BytesIO(request_body), 'r') as zip_file:
-            file_list = zip_file.namelist()
-            logger.info(f"Files in zip: {file_list}")
+            series_uid_to_headers = dicom.index_series(zip_file)
+            series_uid = dicom.select_series(series_uid_to_headers)
             dicom_dir = os.path.join(temp_dir, 'dicom')
             os.makedirs(dicom_dir, exist_ok=True)
-            for file_name in file_list:
-                try:
-                    zip_file.extract(file_name, dicom_dir)
-                except Exception as e:
-                    logger.warning(f"Failed to extract {file_name}: {e}")
-        
-        # Read the DICOM series
+            for idx, header in enumerate(series_uid_to_headers[series_uid]):
+                with open(os.path.join(dicom_dir, f'{idx:05d}.dcm'), 'wb') as f:
+                    f.write(zip_file.read(header.filename))
+
+    # Read the DICOM series
+    with request_metrics.span('dicom_read'):
         reader = sitk.ImageSeriesReader()
-        dicom_names = reader.GetGDCMSeriesFileNames(dicom_dir)
+        dicom_names = reader.GetGDCMSeriesFileNames(dicom_dir, series_uid)
         reader.SetFileNames(dicom_names)
         image = reader.Execute()
-        size_xyz = image.GetSize()
-        logger.info(f"Image size: {size_xyz[0]} x {size_xyz[1]} x {size_xyz[2]}")
-        spacing_xyz_mm = image.GetSpacing()  # x, y, z
-        logger.info(f"Image spacing: {spacing_xyz_mm[0]:.1f} x {spacing_xyz_mm[1]:.1f} x {spacing_xyz_mm[2]:.1f} mm")
-        
-        # Write the image as NIfTI format to temporary directory
+
+    # Write the image as NIfTI format to temporary directory
+    with request_metrics.span('nifti_write'):
         nifti_path = os.path.join(temp_dir, 'volume.nii.gz')
         sitk.WriteImage(image, nifti_path)
-        logger.info(f"Written NIfTI image: {nifti_path}")
+    logger.info(f"Written NIfTI image: {nifti_path}")
+
+    return sitk.GetArrayFromImage(image), image.GetSpacing(), image.GetOrigin(), image.GetDirection(), nifti_path
+
+
+def read_in_memory(request_body, request_metrics):
+
+    # Slices are ordered as GDCM would (see dicom.sort_slices), so this agrees with the above / training
+    dicom_timings = {}
+    volume_zyx, spacing_xyz_mm, origin_xyz, direction = dicom.read_series_from_zip(request_body, timings=dicom_timings)
+    request_metrics.add_timings(dicom_timings)
+    return volume_zyx, spacing_xyz_mm, origin_xyz, direction, None
+
+
+def predict(predictor, volume_zyx, spacing_xyz_mm, origin_xyz, direction, nifti_path, settings, request_metrics):
+
+    if nifti_path is not None:
+        # Run nnUNet preprocessing on the NIfTI file, as predict_from_files would
+        with request_metrics.span('preprocessing'):
+            preprocessor = predictor.configuration_manager.preprocessor_class(verbose=predictor.verbose)
+            data, _, properties = preprocessor.run_case(
+                [nifti_path], None, predictor.plans_manager, predictor.configuration_manager, predictor.dataset_json,
+            )
+    else:
+        # Same properties as nnUNet's SimpleITKIO would give for the NIfTI, i.e. spacing reversed to zyx
+        image_properties = {
+            'sitk_stuff': {'spacing': spacing_xyz_mm, 'origin': origin_xyz, 'direction': direction},
+            'spacing': [abs(s) for s in spacing_xyz_mm[::-1]],
+        }
+        data, properties = preprocess_npy(predictor, volume_zyx, image_properties, request_metrics)
+
+    return predict_preprocessed(predictor, data, properties, settings, request_metrics)
+
+
+def predict_localized(predictor, volume_zyx, spacing_xyz_mm, origin_xyz, direction, nifti_path, settings, request_metrics):
+
+    with request_metrics.span('localization'):
+        rois = localization.find_rois(volume_zyx, spacing_xyz_mm, direction, config.roi_extent_mm, config.roi_margin_mm)
+    if rois == [tuple(slice(0, size) for size in volume_zyx.shape)]:
+        return predict(predictor, volume_zyx, spacing_xyz_mm, origin_xyz, direction, nifti_path, settings, request_metrics)
+    request_metrics.set('roi_voxels', int(sum(np.prod([s.stop - s.start for s in roi]) for roi in rois)), 'Count')
+
+    # Predict each region on its own (in memory, whichever the read mode), then paste the labels back into the
+    # full volume; regions don't overlap
+    predicted_labels_zyx = None
+    for roi in rois:
+        roi_origin_xyz = localization.get_roi_origin(origin_xyz, spacing_xyz_mm, direction, roi)
+        roi_labels_zyx = predict(predictor, volume_zyx[roi], spacing_xyz_mm, roi_origin_xyz, direction, None, settings, request_metrics)
+        if predicted_labels_zyx is None:
+            predicted_labels_zyx = np.zeros(volume_zyx.shape, dtype=roi_labels_zyx.dtype)
+        predicted_labels_zyx[roi] = roi_labels_zyx
+    return predicted_labels_zyx
+
+
+def get_custom_attributes(context):
+    # The toolkit passes the (torchserve) context, with the request headers, as transform_fn takes a fifth argument
+    custom_attributes = context.get_request_header(0, 'X-Amzn-SageMaker-Custom-Attributes') if context is not None else None
+    return config.parse_custom_attributes(custom_attributes)
+
+
+@contextlib.contextmanager
+def predictor_settings(predictor, settings):
+    # The predictor is shared between requests, so this is only used on the GPU worker thread, and restored afterwards
+    original = predictor.tile_step_size, predictor.use_mirroring, predictor.allowed_mirroring_axes
+    mirror_axes = original[2] if settings['mirror_axes'] is None else tuple(
+        axis for axis in settings['mirror_axes'] if axis in (original[2] or ())
+    )
+    predictor.tile_step_size = settings['tile_step_size']
+    predictor.use_mirroring = len(mirror_axes or ()) > 0
+    predictor.allowed_mirroring_axes = mirror_axes
+    try:
+        yield
+    finally:
+        predictor.tile_step_size, predictor.use_mirroring, predictor.allowed_mirroring_axes = original
 
-        # TODO: instead of the above, to remove SimpleITK dependency and avoid disk round-trip, could 
-        #  read into memory with pydicom then use predictor.predict_single_npy_array
-        #  That'd require our own logic for slice ordering (and ensuring it agrees with that used for training!)
 
-        # Run nnUNet prediction, without writing to disk
-        predicted_labels_zyx = predictor.predict_from_files_sequential(
-            [[nifti_path]],
-            None,  # i.e. return in memory, not on disk
-        )[0]
+def mesh_labels(labels_xyz, spacing_xyz_mm, label_to_name, meshing_options, timings=None):
+    # Predicted labels are a transposed view of nnUNet's zyx array; meshing that array directly (with xyz vertices)
+    # avoids strided copies of each label's crop
+    if labels_xyz.T.flags.c_contiguous and not labels_xyz.flags.c_contiguous:
+        return meshing.convert_array_to_meshes(
+            labels_xyz.T, tuple(spacing_xyz_mm)[::-1], label_to_name, num_workers=config.meshing_workers, reverse_axes=True,
+            timings=timings, **meshing_options,
+        )
+    return meshing.convert_array_to_meshes(
+        labels_xyz, spacing_xyz_mm, label_to_name, num_workers=config.meshing_workers, timings=timings, **meshing_options,
+    )
+
+
+def segment(predictor, request_body, settings, request_metrics):
+    """
+    Read the DICOM zip and predict labels (or take them from the cache).
+
+    Returns:
+        predicted labels (indexed xyz), spacing_xyz_mm, cache key of the labels (None without a cache)
+    """
+
+    # Volumes are only held within a slot, of which there are a few per process; the temporary directory is only
+    # needed for the NIfTI path
+    slot_start_time = time.perf_counter()
+    with volume_slots.slot(), tempfile.TemporaryDirectory(prefix='case_') if config.dicom_read_mode == 'nifti' else contextlib.nullcontext() as temp_dir:
+        request_metrics.add_timings({'volume_slot_wait': time.perf_counter() - slot_start_time})
+        if config.dicom_read_mode == 'nifti':
+            volume_zyx, spacing_xyz_mm, origin_xyz, direction, nifti_path = read_via_nifti(request_body, temp_dir, request_metrics)
+        else:
+            volume_zyx, spacing_xyz_mm, origin_xyz, direction, nifti_path = read_in_memory(request_body, request_metrics)
+        size_xyz = volume_zyx.shape[::-1]
+        logger.info(f"Image size: {size_xyz[0]} x {size_xyz[1]} x {size_xyz[2]}")
+        logger.info(f"Image spacing: {spacing_xyz_mm[0]:.1f} x {spacing_xyz_mm[1]:.1f} x {spacing_xyz_mm[2]:.1f} mm")
+
+        # The same series, model and prediction settings always give the same labels
+        predicted_labels_zyx = None
+        labels_key = None
+        if result_cache is not None:
+            with request_metrics.span('labels_cache_get'):
+                labels_key = cache.make_key(
+                    'labels', cache.hash_volume(volume_zyx, spacing_xyz_mm, origin_xyz, direction), predictor.model_checksum,
+                    settings['tile_step_size'], settings['mirror_axes'], config.cpu_autocast if predictor.device.type == 'cpu' else None,
+                    (config.roi_extent_mm, config.roi_margin_mm) if config.localize else None, config.memory_budget_gb,
+                )
+                cached_labels = result_cache.get(labels_key)
+                if cached_labels is not None:
+                    predicted_labels_zyx = cache.labels_from_bytes(cached_labels)
+            request_metrics.set_property('labels_cache_hit', predicted_labels_zyx is not None)
+
+        if predicted_labels_zyx is None:
+            predicted_labels_zyx = (predict_localized if config.localize else predict)(
+                predictor, volume_zyx, spacing_xyz_mm, origin_xyz, direction, nifti_path, settings, request_metrics,
+            )
+            if result_cache is not None:
+                with request_metrics.span('labels_cache_put'):
+                    result_cache.put(labels_key, cache.labels_to_bytes(predicted_labels_zyx))
+        del volume_zyx
+
+    with request_metrics.span('transpose'):
         predicted_labels_xyz = predicted_labels_zyx.transpose(2, 1, 0)
 
-    assert predicted_labels_xyz.shape == size_xyz, f"Predicted labels shape {predicted_labels_xyz.shape} does not match image size {size_xyz}"
+    assert predicted_labels_xyz.shape == tuple(size_xyz), f"Predicted labels shape {predicted_labels_xyz.shape} does not match image size {size_xyz}"
+    return predicted_labels_xyz, spacing_xyz_mm, labels_key
+
+
+def transform_fn(predictor, request_body, content_type, accept, context=None):
+    """
+    Two kinds of request:
+     - a DICOM zip (any content type but the one below): segment, then mesh
+     - a label volume as returned for `Accept: application/x-orthovis-labels`: mesh only, e.g. with other
+       simplification or filters (see config.get_meshing_options) than a previous request
+
+    Responses are meshes in the format chosen by the accept header (see serialization.serialize_meshes), or the
+    compressed label volume for `Accept: application/x-orthovis-labels` (without meshing).
+    """
+
+    # One set of spans per request, emitted as a CloudWatch EMF line (and returned too if the accept header has
+    # a `metrics=1` parameter)
+    request_metrics = metrics.RequestMetrics(dimensions=config.metrics_dimensions)
+    request_metrics.set('request_mb', len(request_body) / 1024 ** 2, 'Megabytes')
+    start_time = time.perf_counter()
 
-    label_to_name = {label: name for name, label in predictor.label_manager.label_dict.items()}
+    # Request options are checked before any work, so a bad one is a 400 (listing the allowed values) straight away
+    custom_attributes = get_custom_attributes(context)
+    preset, settings = config.get_request_settings(custom_attributes)
+    meshing_options = config.get_meshing_options(settings, custom_attributes)
+    accept_content_type, accept_params = serialization.parse_accept(accept)
+    logger.info(f"Preset {preset}: {settings}")
+    request_metrics.set_property('preset', preset)
+    if config.memory_budget_gb is not None:
+        # To check peak_rss_mb against
+        request_metrics.set_property('memory_budget_gb', config.memory_budget_gb)
+
+    if serialization.parse_accept(content_type)[0] == serialization.labels_content_type:
+        with request_metrics.span('labels_read'):
+            predicted_labels_xyz, spacing_xyz_mm, label_to_name = serialization.deserialize_labels(request_body)
+        labels_key = None
+        request_metrics.set_property('request_type', 'remesh')
+    else:
+        predicted_labels_xyz, spacing_xyz_mm, labels_key = segment(predictor, request_body, settings, request_metrics)
+        label_to_name = {label: name for name, label in predictor.label_manager.label_dict.items()}
+        request_metrics.set_property('request_type', 'segment')
+    request_metrics.set('volume_voxels', int(predicted_labels_xyz.size), 'Count')
+    request_metrics.set_property('size_xyz', [int(size) for size in predicted_labels_xyz.shape])
+    request_metrics.set_property('spacing_xyz_mm', [float(spacing) for spacing in spacing_xyz_mm])
+
+    if accept_content_type == serialization.labels_content_type:
+        with request_metrics.span('serialization'):
+            response = serialization.serialize_labels(predicted_labels_xyz, spacing_xyz_mm, label_to_name), serialization.labels_content_type
+        request_metrics.add_timings({'total': time.perf_counter() - start_time})
+        request_metrics.emit()
+        return response
 
     # Apply zmesh to convert segmentation voxels to meshes
     # Mesh vertices will be indexed xyz, with z still the inter-slice axis
-    meshes = meshing.convert_array_to_meshes(predicted_labels_xyz, spacing_xyz_mm, label_to_name)
+    label_to_name = config.select_labels(label_to_name, custom_attributes)
+
+    # Cached as an (unquantized) container, so each accept format can be served from it
+    meshes = None
+    if labels_key is not None:
+        with request_metrics.span('meshes_cache_get'):
+            meshes_key = cache.make_key('meshes', labels_key, sorted(label_to_name.items()), meshing_options)
+            cached_meshes = result_cache.get(meshes_key)
+            if cached_meshes is not None:
+                meshes = {
+                    mesh_id: meshing.Mesh(vertices, faces)
+                    for mesh_id, (vertices, faces) in serialization.deserialize_container(cached_meshes).items()
+                }
+        request_metrics.set_property('meshes_cache_hit', meshes is not None)
+
+    if meshes is None:
+        meshing_timings = {}
+        with request_metrics.span('meshing'):
+            meshes = mesh_labels(predicted_labels_xyz, spacing_xyz_mm, label_to_name, meshing_options, meshing_timings)
+        request_metrics.add_timings(meshing_timings, prefix='meshing_')
+        if labels_key is not None:
+            with request_metrics.span('meshes_cache_put'):
+                result_cache.put(meshes_key, serialization.serialize_as_container(meshes))
+    request_metrics.set('num_meshes', len(meshes), 'Count')
+    request_metrics.set('num_vertices', sum(len(mesh.vertices) for mesh in meshes.values()), 'Count')
+    request_metrics.set('num_faces', sum(len(mesh.faces) for mesh in meshes.values()), 'Count')
 
-    # TODO: isotropic remeshing (and then disable reduction_factor in zmesh)
+    # Binary (float32/uint32 buffers or GLB) if the caller accepts it, otherwise the original JSON lists
+    metadata = None
+    if accept_params.get('metrics') == '1':
+        # Serialization itself can only be covered up to this point
+        request_metrics.add_timings({'total': time.perf_counter() - start_time})
+        metadata = {'metrics': request_metrics.to_dict()}
+    with request_metrics.span('serialization'):
+        response = serialization.serialize_meshes(meshes, accept, metadata)
+    request_metrics.add_timings({'total': time.perf_counter() - start_time})
 
-    return [
-        {'id': mesh_id, 'vertices': mesh.vertices.tolist(), 'faces': mesh.faces.tolist()}
-        for mesh_id, mesh in meshes.items()
-    ]
+    request_metrics.emit()
+    return response
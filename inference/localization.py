@@ -0,0 +1,126 @@
+import logging
+
+import numpy as np
+from scipy import ndimage
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def get_bone_mask(volume_zyx, spacing_xyz, step_mm=3., threshold_hu=200., min_component_ml=2.):
+    """
+    Coarse bone mask, from thresholding every few voxels (so roughly step_mm apart) and dropping small
+    components (noise, table rails, contrast).
+
+    Returns:
+        mask (bool, zyx), strides (zyx) between its voxels in the full volume
+    """
+    strides = tuple(max(int(round(step_mm / spacing)), 1) for spacing in spacing_xyz[::-1])
+    mask = volume_zyx[::strides[0], ::strides[1], ::strides[2]] > threshold_hu
+    components, num_components = ndimage.label(mask)
+    if num_components > 0:
+        voxel_ml = np.prod([stride * spacing for stride, spacing in zip(strides, spacing_xyz[::-1])]) / 1000
+        sizes = np.bincount(components.ravel(), minlength=num_components + 1) * voxel_ml
+        mask = (sizes >= min_component_ml)[components]
+        mask[components == 0] = False
+    return mask, strides
+
+
+def split_legs(mask):
+    # The widest bone-free run of x columns around the middle separates the legs, as split_left_right in
+    # crop_whole_body.py does with the image midline for training data; None if there's bone across the middle
+    occupied = np.any(mask, axis=(0, 1))
+    nonzero = np.nonzero(occupied)[0]
+    if len(nonzero) == 0:
+        return None
+    lo, hi = nonzero[0], nonzero[-1]
+    middle = (lo + hi) / 2
+    gaps = []
+    start = None
+    for x in range(lo, hi + 1):
+        if not occupied[x] and start is None:
+            start = x
+        elif occupied[x] and start is not None:
+            gaps.append((start, x))
+            start = None
+    # Only gaps in the middle half of the bone extent count, so we don't split e.g. fibula from tibia
+    gaps = [(start, stop) for start, stop in gaps if abs((start + stop) / 2 - middle) < (hi - lo) / 4]
+    if len(gaps) == 0:
+        return None
+    start, stop = max(gaps, key=lambda gap: gap[1] - gap[0])
+    return (start + stop) // 2
+
+
+def find_rois(volume_zyx, spacing_xyz, direction, extent_mm=200., margin_mm=20., threshold_hu=200.):
+    """
+    Find the ankle region(s) of a CT volume with a threshold-based bone detector, so the full-resolution model only
+    needs to run there: per leg, from the most inferior bone up extent_mm, within the bone's in-plane extent, all
+    with margin_mm around.
+
+    Falls back to the whole volume if there's no bone or the series isn't axial.
+
+    Args:
+        volume_zyx: CT volume in HU
+        spacing_xyz: voxel spacing (mm)
+        direction: flattened 3x3 direction matrix, columns being the x/y/z axes (as sitk.Image.GetDirection)
+
+    Returns:
+        list of tuples of slices (zyx) into volume_zyx, not overlapping
+    """
+    full_volume = [tuple(slice(0, size) for size in volume_zyx.shape)]
+    superior_component = direction[8]  # of the slice axis; LPS, so +z is superior
+    if abs(superior_component) < 0.5:
+        logger.info('Not localizing: series is not axial')
+        return full_volume
+
+    mask, strides = get_bone_mask(volume_zyx, spacing_xyz, threshold_hu=threshold_hu)
+    if not np.any(mask):
+        logger.info('Not localizing: no bone found')
+        return full_volume
+
+    split_x = split_legs(mask)
+    halves = [slice(0, mask.shape[2])] if split_x is None else [slice(0, split_x), slice(split_x, mask.shape[2])]
+
+    spacing_zyx = np.asarray(spacing_xyz[::-1])
+    margin = np.ceil(margin_mm / spacing_zyx).astype(int)
+    rois = []
+    for x_slice in halves:
+        half = mask[:, :, x_slice]
+        z_indices = np.nonzero(np.any(half, axis=(1, 2)))[0]
+        if len(z_indices) == 0:
+            continue
+
+        # Slice indices increase towards the head if the slice axis points superior
+        extent_slices = int(np.ceil(extent_mm / spacing_zyx[0]))
+        if superior_component > 0:
+            z_start = z_indices[0] * strides[0] - margin[0]
+            z_stop = z_indices[0] * strides[0] + extent_slices + margin[0]
+        else:
+            z_stop = (z_indices[-1] + 1) * strides[0] + margin[0]
+            z_start = (z_indices[-1] + 1) * strides[0] - extent_slices - margin[0]
+        z_slice = slice(max(z_start, 0), min(z_stop, volume_zyx.shape[0]))
+
+        # In-plane, the extent of bone within that z range
+        in_range = half[z_slice.start // strides[0] : -(-z_slice.stop // strides[0])]
+        y_indices = np.nonzero(np.any(in_range, axis=(0, 2)))[0]
+        x_indices = np.nonzero(np.any(in_range, axis=(0, 1)))[0] + x_slice.start
+        y_slice = slice(max(y_indices[0] * strides[1] - margin[1], 0), min((y_indices[-1] + 1) * strides[1] + margin[1], volume_zyx.shape[1]))
+        x_slice_full = slice(max(x_indices[0] * strides[2] - margin[2], 0), min((x_indices[-1] + 1) * strides[2] + margin[2], volume_zyx.shape[2]))
+        rois.append((z_slice, y_slice, x_slice_full))
+
+    # Margins must not make the legs' regions overlap, or pasting labels back would be ambiguous
+    if len(rois) == 2 and rois[0][2].stop > rois[1][2].start:
+        split = split_x * strides[2]
+        rois[0] = (*rois[0][:2], slice(rois[0][2].start, split))
+        rois[1] = (*rois[1][:2], slice(split, rois[1][2].stop))
+
+    fraction = sum(np.prod([s.stop - s.start for s in roi]) for roi in rois) / volume_zyx.size
+    logger.info(f"Localized {len(rois)} region(s), {100 * fraction:.0f}% of the volume: {rois}")
+    return rois
+
+
+def get_roi_origin(origin_xyz, spacing_xyz, direction, roi):
+    # Physical position of the ROI's first voxel, for the cropped image's geometry
+    offset_xyz = np.asarray([roi[2].start, roi[1].start, roi[0].start]) * np.asarray(spacing_xyz)
+    return tuple((np.asarray(origin_xyz) + np.asarray(direction).reshape(3, 3) @ offset_xyz).tolist())
@@ -1,35 +1,346 @@
+import os
+import time
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import zmesh
 import trimesh
 import numpy as np
+from scipy import ndimage
+
+from metrics import add_duration
+
+
+# Worker processes for per-label meshing, created once (at the size first asked for) and shared by all later
+# requests, including concurrent ones; never shut down or resized, as other threads may be submitting to it
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(num_workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # forkserver rather than fork, so workers don't inherit CUDA state or locks held by other threads; the
+            # server imports this module once, so each worker starts with zmesh and trimesh already loaded
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['meshing'])
+            _executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=context)
+        return _executor
+
+
+def start_workers(num_workers):
+    # Start all the pool's worker processes now (e.g. at model load) rather than during a request; the pool only
+    # starts a process when a job finds none idle, so this submits one no-op per worker at once
+    if num_workers > 1:
+        executor = get_executor(num_workers)
+        for future in [executor.submit(os.getpid) for _ in range(num_workers)]:
+            future.result()
+
+
+class Mesh:
+    """
+    Bare vertex and face arrays for one mesh, without trimesh's validation and caching.
+
+    Vertices are float32 (N x 3) and faces uint32 (M x 3), which is also what we serialize, so arrays are
+    allocated once and then modified in place. lods holds coarser versions of the same mesh, if requested,
+    finest first.
+    """
+    __slots__ = ('vertices', 'faces', 'lods')
+
+    def __init__(self, vertices, faces, lods=()):
+        self.vertices = np.asarray(vertices, dtype=np.float32)
+        self.faces = np.asarray(faces, dtype=np.uint32)
+        self.lods = list(lods)
+
+
+def remesh_isotropic(vertices, faces, target_edge_length, iterations=10):
+    """
+    Remesh so all edges are close to the target length (Botsch & Kobbelt), giving uniform triangles and a
+    face count that depends only on surface area.
+
+    Uses gpytoolbox's compiled implementation; vertices are projected back onto the input surface.
+    """
+    # Imported here as only this (optional) path needs it, to keep worker start-up and cold starts short
+    import gpytoolbox
+    vertices, faces = gpytoolbox.remesh_botsch(
+        np.asarray(vertices, dtype=np.float64),
+        np.asarray(faces, dtype=np.int32),
+        i=iterations,
+        h=target_edge_length,
+        project=True,
+    )
+    return vertices, faces
+
+
+def get_lods(vertices, faces, lod_factors):
+    """
+    Coarser levels of detail of a mesh, each simplified from the one before to a face count target, so they
+    cost a fraction of marching cubes and the first simplification.
+
+    Uses zmesh's fast quadric mesh reduction rather than Mesher.get's simplifier: the latter bounds the error
+    to about a voxel (so can't get this coarse) and produces NaN vertices when pushed much further.
+
+    Args:
+        vertices, faces: the finest level
+        lod_factors: increasing face count reductions relative to the finest level, e.g. (4, 16)
+
+    Returns:
+        list of (vertices, faces) per level, finest first; levels that would have fewer than 4 faces are left out
+    """
+    lods = []
+    num_faces = len(faces)
+    for factor in lod_factors:
+        target_count = num_faces // factor
+        if target_count < 4:
+            break
+        mesh = zmesh.simplify_fqmr(zmesh.Mesh(vertices, faces, None), target_count=target_count)
+        vertices, faces = mesh.vertices, mesh.faces
+        lods.append((vertices, faces))
+    return lods
+
+
+def split_components(vertices, faces):
+    """
+    Split a mesh into its connected components (faces joined by shared edges), as trimesh.Trimesh.split does, but
+    indexing into the given float32 / uint32 arrays rather than building a Trimesh and float64 copies of each part.
+    Like trimesh, components of fewer than 4 faces (which can't be closed) are dropped; unlike it, other
+    non-watertight components are kept rather than repaired or dropped (zmesh's closed meshes have none).
+
+    Returns:
+        list of (vertices, faces) per component
+    """
+    adjacency = trimesh.graph.face_adjacency(faces=faces)
+    components = []
+    for face_indices in trimesh.graph.connected_components(adjacency, min_len=4, nodes=np.arange(len(faces))):
+        vertex_indices, component_faces = np.unique(faces[face_indices], return_inverse=True)
+        components.append((vertices[vertex_indices], component_faces.reshape(-1, 3).astype(np.uint32)))
+    return components
 
 
-def convert_array_to_meshes(segmentation, spacing, label_to_name):
+def mesh_label(
+    mask, offset, spacing, split=True, reduction_factor=100, target_edge_length=None, remesh_iterations=10,
+    lod_factors=(), reverse_axes=False, timings=None,
+):
+    """
+    Mesh one label, given as a binary mask cropped to its bounding box, and split it into connected components.
 
-    # Note zmesh assumes the index ordering of the segmentation volume is the same as the axis
-    # ordering of spacing; vertices then have that ordering too
+    Args:
+        mask: uint8 array, nonzero inside the label
+        offset: index of mask[0, 0, 0] in the full volume, used to place vertices correctly
+        spacing: voxel spacing, in the same axis order as the mask indices
+        split: whether to split the mesh into connected components; not needed if the mask is already a
+            single (voxel-space) component
+        reduction_factor: zmesh simplification factor (0 to disable); zmesh bounds the error to a voxel
+        target_edge_length: if set, isotropically remesh each component to this edge length (in the units
+            of spacing, i.e. mm)
+        remesh_iterations: number of remeshing iterations
+        lod_factors: if given, also produce coarser levels of detail of each component (in Mesh.lods) with
+            these face count reductions relative to the regular mesh, e.g. (4, 16)
+        reverse_axes: reverse the vertex coordinates (and so the face winding), e.g. to get xyz vertices from
+            a zyx mask
+        timings: optional dict, to which seconds spent in each stage are added
 
+    Returns:
+        list of Mesh per connected component
+    """
+    start_time = time.perf_counter()
     mesher = zmesh.Mesher(tuple(spacing))
-    mesher.mesh(segmentation, close=True)
-    meshed_labels = mesher.ids()
-    
-    print(f"Generating meshes for labels: {meshed_labels}")
-
-    meshes = {}    
-    for label in meshed_labels:
-        print(f"Processing label {label}...")
-        mesh = mesher.get(
-            label,
-            normals=False,
-            reduction_factor=100,  # TODO: use isotropic remeshing instead; set this to zero!
-        )
-        for cc_idx, cc_mesh in enumerate(trimesh.Trimesh(vertices=mesh.vertices, faces=mesh.faces).split()):
-            meshes[f'{label_to_name[label]}_{cc_idx}'] = cc_mesh
-
-    # Translate vertices so the overall centroid (across all CC's) is at the origin
-    centroid = np.mean(np.concatenate([mesh.vertices for mesh in meshes.values()], axis=0), axis=0)
-    meshes = {
-        mesh_id: trimesh.Trimesh(vertices=mesh.vertices - centroid, faces=mesh.faces)
-        for mesh_id, mesh in meshes.items()
-    }
+    mesher.mesh(mask, close=True)
+    start_time = add_duration(timings, 'zmesh', start_time)
+    # If we remesh, zmesh's simplification still serves as a cheap pre-pass: it roughly halves remeshing
+    # time without changing the result much (see bench_remeshing.py)
+    mesh = mesher.get(1, normals=False, reduction_factor=reduction_factor)
+    mesher.clear()
+    vertices = np.asarray(mesh.vertices, dtype=np.float32)
+    vertices += (np.asarray(offset) * np.asarray(spacing)).astype(np.float32)
+    start_time = add_duration(timings, 'simplify', start_time)
+    if split:
+        components = split_components(vertices, mesh.faces)
+        start_time = add_duration(timings, 'split', start_time)
+    else:
+        components = [(vertices, mesh.faces)]
+    if target_edge_length is not None:
+        components = [
+            remesh_isotropic(vertices, faces, target_edge_length, remesh_iterations)
+            for vertices, faces in components
+        ]
+        start_time = add_duration(timings, 'remesh', start_time)
+    # Converting here means the (smaller) final arrays are what gets sent back from worker processes
+    meshes = [Mesh(vertices, faces) for vertices, faces in components]
+    if lod_factors:
+        for mesh in meshes:
+            mesh.lods = [Mesh(vertices, faces) for vertices, faces in get_lods(mesh.vertices, mesh.faces, lod_factors)]
+        start_time = add_duration(timings, 'lod', start_time)
+    if reverse_axes:
+        # Reversing the axes mirrors the mesh, so faces are reversed too to keep them facing outwards
+        for mesh in meshes:
+            for level in [mesh, *mesh.lods]:
+                level.vertices = np.ascontiguousarray(level.vertices[:, ::-1])
+                level.faces = np.ascontiguousarray(level.faces[:, ::-1])
+        add_duration(timings, 'reverse_axes', start_time)
+    return meshes
+
+
+def mesh_label_with_timings(mask, offset, **kwargs):
+    # For worker processes, which can't add to the caller's timings dict
+    timings = {}
+    return mesh_label(mask, offset, timings=timings, **kwargs), timings
+
+
+def pad_bbox(bbox, shape):
+    # Add a voxel of margin so surfaces are closed as they would be in the full volume
+    return tuple(
+        slice(max(axis_slice.start - 1, 0), min(axis_slice.stop + 1, axis_size))
+        for axis_slice, axis_size in zip(bbox, shape)
+    )
+
+
+def get_label_jobs(segmentation, labels):
+    # One job per label (of those given), cropped to its bounding box
+    jobs = []
+    for label_idx, bbox in enumerate(ndimage.find_objects(segmentation)):
+        label = label_idx + 1
+        if bbox is None or label not in labels:
+            continue
+        bbox = pad_bbox(bbox, segmentation.shape)
+        mask = (segmentation[bbox] == label).view(np.uint8)
+        jobs.append((label, mask, tuple(axis_slice.start for axis_slice in bbox)))
+    return jobs
+
+
+def get_component_jobs(segmentation, labels, min_component_voxels, max_components_per_label, connectivity):
+    # One job per voxel-space connected component (of the labels given) that survives the filters, cropped to its
+    # bounding box; components of each label are ordered largest first
+    import cc3d  # only needed on this (optional) path
+    import fastremap
+    components, num_components = cc3d.connected_components(segmentation, connectivity=connectivity, return_N=True)
+    if num_components == 0:
+        return []
+    stats = cc3d.statistics(components)
+    component_to_label = fastremap.component_map(components, segmentation)
+
+    label_to_components = {}
+    for component in range(1, num_components + 1):
+        if stats['voxel_counts'][component] >= min_component_voxels and int(component_to_label[component]) in labels:
+            label_to_components.setdefault(int(component_to_label[component]), []).append(component)
+
+    jobs = []
+    for label in sorted(label_to_components):
+        label_components = sorted(label_to_components[label], key=lambda component: stats['voxel_counts'][component], reverse=True)
+        num_dropped = len(label_components) - len(label_components[:max_components_per_label])
+        if num_dropped > 0:
+            print(f"Dropping {num_dropped} smallest components of label {label}")
+        for component in label_components[:max_components_per_label]:
+            bbox = pad_bbox(stats['bounding_boxes'][component], segmentation.shape)
+            mask = (components[bbox] == component).view(np.uint8)
+            jobs.append((label, mask, tuple(axis_slice.start for axis_slice in bbox)))
+    return jobs
+
+
+def convert_array_to_meshes(
+    segmentation, spacing, label_to_name, num_workers=None,
+    voxel_components=False, min_component_voxels=0, max_components_per_label=None, connectivity=26,
+    reduction_factor=100, target_edge_length=None, remesh_iterations=10, lod_factors=(), reverse_axes=False, timings=None,
+):
+    """
+    Convert a label volume to meshes, one per connected component of each label, with ids '{name}_{index}'.
+
+    With lod_factors, each component also gets coarser levels of detail with ids '{name}_{index}_lod{level}'
+    (level 1 being the finest of those); these come first, coarsest level first, so clients reading the
+    response in order can show something before the full-resolution meshes arrive.
+
+    Args:
+        segmentation: integer label volume, zero for background
+        spacing: voxel spacing; zmesh assumes this has the same axis ordering as the segmentation indices, and
+            vertices then have that ordering too (or the reverse, with reverse_axes)
+        label_to_name: dict mapping label values to names used in mesh ids; other labels aren't meshed
+        num_workers: size of the meshing worker pool (None for one per CPU; 1 to mesh in-process); the pool is
+            created on first use and kept, and a single job is always meshed in-process
+        voxel_components: if True, find connected components in the label volume (with cc3d) and mesh each
+            directly, rather than splitting each label's mesh; this enables the filters below
+        min_component_voxels: drop components with fewer voxels than this (e.g. false-positive specks)
+        max_components_per_label: if set, keep only this many of the largest components of each label
+        connectivity: voxel connectivity (6, 18 or 26) used to define components
+        reduction_factor: zmesh simplification factor (0 to disable)
+        target_edge_length: if set, isotropically remesh each component to roughly this edge length (in mm,
+            or whatever units spacing is in)
+        remesh_iterations: number of remeshing iterations
+        lod_factors: face count reductions of the coarser levels of detail relative to the regular meshes,
+            e.g. (4, 16); each level is simplified from the one before. Levels are left out for components
+            too small to simplify that far
+        reverse_axes: give vertices in the reverse of the segmentation's axis order, e.g. xyz vertices for a
+            zyx volume, so a C-ordered zyx volume can be meshed as is rather than through a transposed view
+        timings: optional dict, to which seconds spent in each stage are added: crop (bounding boxes, and
+            connected components if enabled), meshing_wall, recentre, and the per-component stages zmesh,
+            simplify, split, remesh, lod and reverse_axes; the latter are summed over workers, so are CPU rather than wall time
+
+    Returns:
+        dict mapping mesh id to mesh, with vertices translated so their overall centroid is at the origin
+    """
+
+    # Each label (or component) is meshed separately, within its own bounding box; this lets us farm them out
+    # to worker processes without each needing the full volume
+    start_time = time.perf_counter()
+    if voxel_components:
+        jobs = get_component_jobs(segmentation, label_to_name, min_component_voxels, max_components_per_label, connectivity)
+    else:
+        jobs = get_label_jobs(segmentation, label_to_name)
+    start_time = add_duration(timings, 'crop', start_time)
+
+    print(f"Generating meshes for labels: {sorted(set(label for label, _, _ in jobs))} ({len(jobs)} jobs)")
+
+    mesh_job = functools.partial(
+        mesh_label_with_timings,
+        spacing=spacing,
+        split=not voxel_components,
+        reduction_factor=reduction_factor,
+        target_edge_length=target_edge_length,
+        remesh_iterations=remesh_iterations,
+        lod_factors=tuple(sorted(lod_factors or ())),
+        reverse_axes=reverse_axes,
+    )
+    num_workers = num_workers or os.cpu_count()
+    if num_workers > 1 and len(jobs) > 1:
+        executor = get_executor(num_workers)
+        futures = [executor.submit(mesh_job, mask, offset) for _, mask, offset in jobs]
+        job_results = [future.result() for future in futures]
+    else:
+        job_results = [mesh_job(mask, offset) for _, mask, offset in jobs]
+    start_time = add_duration(timings, 'meshing_wall', start_time)
+    if timings is not None:
+        for _, job_timings in job_results:
+            for stage, duration in job_timings.items():
+                timings[stage] = timings.get(stage, 0.) + duration
+
+    meshes = {}
+    label_to_num_components = {}
+    vertex_sum = np.zeros(3, dtype=np.float64)
+    num_vertices = 0
+    for (label, _, _), (components, _) in zip(jobs, job_results):
+        for mesh in components:
+            cc_idx = label_to_num_components.get(label, 0)
+            meshes[f'{label_to_name[label]}_{cc_idx}'] = mesh
+            label_to_num_components[label] = cc_idx + 1
+            vertex_sum += mesh.vertices.sum(axis=0, dtype=np.float64)
+            num_vertices += len(mesh.vertices)
+    print(f"Meshed components per label: {label_to_num_components}")
+
+    # Translate vertices (in place) so the overall centroid (across all CC's, at full detail) is at the origin
+    centroid = (vertex_sum / max(num_vertices, 1)).astype(np.float32)
+    for mesh in meshes.values():
+        for level in [mesh, *mesh.lods]:
+            level.vertices -= centroid
+    add_duration(timings, 'recentre', start_time)
+
+    if lod_factors:
+        lod_meshes = {}
+        for level in range(len(lod_factors), 0, -1):
+            for mesh_id, mesh in meshes.items():
+                if len(mesh.lods) >= level:
+                    lod_meshes[f'{mesh_id}_lod{level}'] = mesh.lods[level - 1]
+        meshes = {**lod_meshes, **meshes}
 
     return meshes
@@ -0,0 +1,188 @@
+import sys
+import json
+import time
+import resource
+import itertools
+import threading
+import contextlib
+
+
+def add_duration(timings, stage, start_time):
+    # Accumulate seconds since start_time into timings[stage] (if we're collecting timings), returning the time now
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.) + now - start_time
+    return now
+
+
+def reset_peak_rss():
+    # Writing 5 to clear_refs resets the kernel's peak RSS (VmHWM) for this process, so we can get a peak per
+    # span; returns False where that isn't possible, in which case peaks are since process start
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024  # reported in kB
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+# Spans running in this process, across requests (token -> whether another span overlapped it). Peak RSS and CUDA
+# memory are process-wide, and resetting them for one span would lose another's peak (and a concurrent request's
+# allocations would count towards it), so only spans that run alone get their own peaks
+active_spans = {}
+active_spans_lock = threading.Lock()
+span_tokens = itertools.count()
+
+
+def get_cuda():
+    # Only look at CUDA if torch is already loaded and has a device; metrics shouldn't pull torch in
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda
+    return None
+
+
+class RequestMetrics:
+    """
+    Timing spans and other values for one request, emitted as a single CloudWatch embedded metric format
+    (EMF) JSON line.
+
+    Each span records wall time, and if it ran alone in the process, peak host RSS and (if CUDA is in use) peak
+    CUDA memory allocated during it. If any span overlapped another (concurrent requests in one process, e.g.
+    batch.py), the request has no peak of its own, and reports the process's peak RSS instead.
+    """
+
+    def __init__(self, namespace='Orthovis/Meshing', dimensions=None):
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+        self.spans = {}
+        self.values = {}
+        self.properties = {}
+        self.overlapped = False
+
+    @contextlib.contextmanager
+    def span(self, name):
+        token = next(span_tokens)
+        cuda = get_cuda()
+        rss_was_reset = False
+        with active_spans_lock:
+            if active_spans:
+                # Leave the peaks alone, and mark this and the running spans as not having peaks of their own
+                active_spans.update({other: True for other in active_spans})
+                active_spans[token] = True
+            else:
+                if cuda is not None:
+                    cuda.reset_peak_memory_stats()
+                rss_was_reset = reset_peak_rss()
+                active_spans[token] = False
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            span = {'seconds': time.perf_counter() - start_time}
+            with active_spans_lock:
+                overlapped = active_spans.pop(token)
+                if not overlapped:
+                    span['peak_rss_mb'] = get_peak_rss_mb()
+                    if not rss_was_reset:
+                        span['peak_rss_since_start'] = True
+                    if cuda is not None:
+                        span['peak_cuda_mb'] = cuda.max_memory_allocated() / 1024 ** 2
+            self.overlapped = self.overlapped or overlapped
+            # Repeated spans (e.g. per region) accumulate time, keeping the highest peaks
+            previous = self.spans.get(name, {})
+            for key, value in previous.items():
+                span[key] = span.get(key, 0.) + value if key == 'seconds' else max(span.get(key, value), value)
+            self.spans[name] = span
+
+    def add_timings(self, timings, prefix=''):
+        # Stage timings collected by the lower-level modules (see metrics.add_duration), recorded as time-only spans
+        for stage, seconds in timings.items():
+            self.spans[f'{prefix}{stage}'] = {'seconds': seconds}
+
+    def add_nested(self, name, seconds, nested):
+        # A phase that ran another RequestMetrics' spans (e.g. warm-up's), which a span here would overlap and so
+        # lose the peaks of: recorded as a span with the highest of their peaks
+        span = {'seconds': seconds}
+        for key in ('peak_rss_mb', 'peak_cuda_mb'):
+            peaks = [nested_span[key] for nested_span in nested.spans.values() if key in nested_span]
+            if peaks and not nested.overlapped:
+                span[key] = max(peaks)
+        self.spans[name] = span
+        self.overlapped = self.overlapped or nested.overlapped
+
+    def set(self, name, value, unit='None'):
+        # A value to report as a metric, with a CloudWatch unit such as 'Count' or 'Megabytes'
+        self.values[name] = (value, unit)
+
+    def set_property(self, name, value):
+        # Logged alongside the metrics, but not a metric itself (e.g. case id, volume shape)
+        self.properties[name] = value
+
+    def get_peak_rss_mb(self):
+        # Highest peak RSS across spans, i.e. for the request as a whole (None if no span recorded one, or some
+        # overlapped another, so the spans' peaks don't cover the request)
+        peaks = [span['peak_rss_mb'] for span in self.spans.values() if 'peak_rss_mb' in span]
+        return max(peaks) if peaks and not self.overlapped else None
+
+    def get_process_peak_rss_mb(self):
+        # Instead of the request's peak, if its spans overlapped others: the process's peak RSS since it last had
+        # no spans running (when peaks are reset), which covers the overlapping requests
+        return get_peak_rss_mb() if self.overlapped else None
+
+    def to_dict(self):
+        return {
+            'spans': self.spans,
+            'peak_rss_mb': self.get_peak_rss_mb(),
+            'process_peak_rss_mb': self.get_process_peak_rss_mb(),
+            'values': {name: value for name, (value, _) in self.values.items()},
+            **self.properties,
+        }
+
+    def to_emf(self):
+        metrics = {}
+        units = {}
+        for name, span in self.spans.items():
+            metrics[f'{name}_ms'] = span['seconds'] * 1e3
+            units[f'{name}_ms'] = 'Milliseconds'
+            for key in ('peak_rss_mb', 'peak_cuda_mb'):
+                if key in span:
+                    metrics[f'{name}_{key}'] = span[key]
+                    units[f'{name}_{key}'] = 'Megabytes'
+        for name, (value, unit) in self.values.items():
+            metrics[name] = value
+            units[name] = unit
+        for name, value in [('peak_rss_mb', self.get_peak_rss_mb()), ('process_peak_rss_mb', self.get_process_peak_rss_mb())]:
+            if value is not None:
+                metrics[name] = value
+                units[name] = 'Megabytes'
+
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()],
+                }],
+            },
+            **self.dimensions,
+            **self.properties,
+            **metrics,
+        }
+
+    def emit(self):
+        # One line on stdout, which the CloudWatch agent / log ingestion turns into metrics
+        print(json.dumps(self.to_emf()), flush=True)
@@ -0,0 +1,150 @@
+import io
+import os
+import zlib
+import hashlib
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Endpoint code, packaged as code/ (inference.py is the handler; the rest are its modules)
+required_files = ['requirements.txt', 'inference.py', 'cache.py', 'config.py', 'dicom.py', 'errors.py', 'localization.py', 'meshing.py', 'metrics.py', 'pipeline.py', 'serialization.py', 'tiling.py']
+
+# Each block of the tar stream is compressed on its own (as a gzip member) so blocks compress in parallel; gzip
+# readers (tar, SageMaker's model download) read concatenated members as one stream
+block_size = 4 * 1024 ** 2
+
+
+def get_package_files(model_folder_path, fold='all', checkpoint_name='checkpoint_best.pth', code_dir=os.path.dirname(os.path.abspath(__file__))):
+    """
+    Files that go into the model package, and where: the code, and the parts of the nnUNet model folder that
+    inference loads (plans, dataset json and the one checkpoint), not logs, progress plots or other folds.
+
+    Returns:
+        list of (archive name, path), sorted by archive name
+    """
+    files = [(f'code/{file_name}', os.path.join(code_dir, file_name)) for file_name in required_files]
+    files += [(f'model/{file_name}', os.path.join(model_folder_path, file_name)) for file_name in ('plans.json', 'dataset.json')]
+    files.append((f'model/fold_{fold}/{checkpoint_name}', os.path.join(model_folder_path, f'fold_{fold}', checkpoint_name)))
+    for _, path in files:
+        assert os.path.isfile(path), f'{path} does not exist -- inference script will fail!'
+    return sorted(files)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    File-like sink for a stream (e.g. tarfile's), gzip-compressing it block by block on a thread pool (zlib releases
+    the GIL) and writing the members to f in order, so the output only depends on the input and level.
+    Also hashes the uncompressed stream.
+    """
+
+    def __init__(self, f, compression_level=6, num_threads=None):
+        self.f = f
+        self.compression_level = compression_level
+        num_threads = num_threads or os.cpu_count()
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.max_pending = 2 * num_threads
+        self.pending = []
+        self.buffer = bytearray()
+        self.digest = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def compress(self, block):
+        # wbits 31: gzip header and trailer, with mtime 0
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(self.compress, block))
+        # Bounded, so memory stays at a few blocks per thread however large the stream
+        while len(self.pending) > self.max_pending:
+            self.f.write(self.pending.pop(0).result())
+
+    def write(self, data):
+        self.digest.update(data)
+        self.buffer += data
+        while len(self.buffer) >= block_size:
+            self.submit(bytes(self.buffer[:block_size]))
+            del self.buffer[:block_size]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self.buffer or not self.pending:
+                self.submit(bytes(self.buffer))
+            for future in self.pending:
+                self.f.write(future.result())
+            self.executor.shutdown()
+        super().close()
+
+
+def add_file(tar, arcname, path):
+    # Deterministic entries: no timestamps, owners or local permissions
+    info = tarfile.TarInfo(arcname)
+    info.size = os.path.getsize(path)
+    info.mode = 0o644
+    info.mtime = 0
+    with open(path, 'rb') as f:
+        tar.addfile(info, f)
+
+
+def create_sagemaker_model_package(model_folder_path, output_dir='.', fold='all', checkpoint_name='checkpoint_best.pth', compression_level=1, num_threads=None):
+    """
+    Create a SageMaker model package with the required folder structure, streaming the files straight into a
+    parallel-compressed tar.gz (see get_package_files for what goes in):
+    ```
+    model_and_code-<hash>.tar.gz
+    ├── code/
+    │   ├── requirements.txt
+    │   ├── inference.py
+    │   └── [inference.py's modules, see required_files]
+    └── model/
+        ├── dataset.json
+        ├── plans.json
+        └── fold_<fold>/<checkpoint_name>
+    ```
+
+    The tar stream is deterministic, and <hash> is the start of its sha256, so an unchanged model and code give
+    the same file name (see upload_model_package).
+
+    Returns:
+        path to the created tar.gz file
+    """
+    files = get_package_files(model_folder_path, fold, checkpoint_name)
+    with tempfile.NamedTemporaryFile(dir=output_dir, prefix='.model_and_code-', suffix='.tar.gz', delete=False) as f:
+        try:
+            writer = ParallelGzipWriter(f, compression_level, num_threads)
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                for arcname, path in files:
+                    add_file(tar, arcname, path)
+            writer.close()
+        except BaseException:
+            os.remove(f.name)
+            raise
+    filename = os.path.join(output_dir, f'model_and_code-{writer.digest.hexdigest()[:16]}.tar.gz')
+    os.replace(f.name, filename)
+    return filename
+
+
+def upload_model_package(s3_client, filename, bucket, prefix):
+    """
+    Upload a model package (as named by create_sagemaker_model_package) unless an object of that name is already
+    there, e.g. from deploying the same model and code before.
+
+    Args:
+        s3_client: boto3 S3 client, or cache.DirectoryObjectStore (locally)
+
+    Returns:
+        S3 URL of the model package
+    """
+    key = f"{prefix.strip('/')}/{os.path.basename(filename)}"
+    url = f's3://{bucket}/{key}'
+    existing = s3_client.list_objects_v2(Bucket=bucket, Prefix=key).get('Contents', [])
+    if any(obj['Key'] == key for obj in existing):
+        print(f'{url} exists already; not uploading')
+        return url
+    s3_client.upload_file(filename, bucket, key)
+    print(f'Uploaded {url}')
+    return url
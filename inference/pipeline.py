@@ -0,0 +1,80 @@
+import os
+import queue
+import fcntl
+import logging
+import threading
+import contextlib
+from concurrent.futures import Future
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class GpuWorker:
+    """
+    Runs GPU work (prediction) for all requests on a single thread, one job at a time and in arrival order, so
+    requests in flight can decode, mesh and serialize on their own threads meanwhile.
+
+    If lock_path is given, each job also holds an exclusive lock on that file, so that separate model server worker
+    processes on the instance take turns on the GPU the same way.
+    """
+
+    def __init__(self, lock_path=None):
+        self.lock_path = lock_path
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='gpu-worker', daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.jobs.put((future, fn, args, kwargs))
+        return future
+
+    @contextlib.contextmanager
+    def process_lock(self):
+        if self.lock_path is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def run(self):
+        while True:
+            future, fn, args, kwargs = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.process_lock():
+                    result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class VolumeSlots:
+    """
+    Bounds the number of decoded volumes (and their predictions) held in memory by requests in this process; a
+    request takes a slot before decoding and gives it back once it only holds labels and meshes.
+    """
+
+    def __init__(self, num_slots):
+        self.semaphore = threading.BoundedSemaphore(num_slots)
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.semaphore.acquire()
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+
+def get_default_lock_path():
+    # Same path for all worker processes on the instance
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'), 'orthovis-gpu.lock')
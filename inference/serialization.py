@@ -0,0 +1,257 @@
+import io
+import json
+import struct
+
+import numpy as np
+
+import errors
+
+
+# Content types we can respond with; anything else gets the original JSON lists
+json_content_type = 'application/json'
+container_content_type = 'application/x-orthovis-meshes'
+glb_content_type = 'model/gltf-binary'
+labels_content_type = 'application/x-orthovis-labels'
+
+container_magic = b'OVMS'
+container_version = 1
+
+
+def parse_accept(accept):
+    """
+    Split an accept header such as 'application/x-orthovis-meshes; quantize=16' into the first content type
+    and a dict of its parameters; an unsupported quantize is a BadRequestError.
+    """
+    if not accept:
+        return json_content_type, {}
+    content_type, *params = [part.strip() for part in accept.split(',')[0].split(';')]
+    params = dict(param.split('=', 1) for param in params if '=' in param)
+    params = {key.strip().lower(): value.strip() for key, value in params.items()}
+    if params.get('quantize', '8') not in ('8', '16'):
+        raise errors.BadRequestError(f"Invalid quantize={params['quantize']!r}, expected 8 or 16")
+    return content_type.lower(), params
+
+
+def quantize_vertices(vertices, bits):
+    # Map each axis of the mesh's bounding box onto [0, 2^bits - 1]; dequantize as q * scale + offset
+    assert bits in (8, 16), 'Only 8- or 16-bit quantization is supported'
+    offset = vertices.min(axis=0)
+    extent = vertices.max(axis=0) - offset
+    max_value = 2 ** bits - 1
+    scale = np.where(extent > 0, extent / max_value, 1.)
+    quantized = np.rint((vertices - offset) / scale).astype(np.uint8 if bits == 8 else np.uint16)
+    return quantized, offset, scale
+
+
+def pad_to_4(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+def serialize_as_json(meshes, metadata=None):
+    # SageMaker coerces this to JSON text for us; with metadata, the list moves under 'meshes'
+    mesh_list = [
+        {'id': mesh_id, 'vertices': mesh.vertices.tolist(), 'faces': mesh.faces.tolist()}
+        for mesh_id, mesh in meshes.items()
+    ]
+    if metadata is None:
+        return mesh_list
+    return {'meshes': mesh_list, **metadata}
+
+
+def serialize_as_container(meshes, quantize_bits=None, metadata=None):
+    """
+    Pack meshes into a simple length-prefixed binary container:
+    ```
+    b'OVMS' | version (uint32) | header length (uint32) | header (utf-8 JSON, space-padded to 4 bytes)
+    then for each mesh in header order: vertex buffer | face buffer (each padded to 4 bytes)
+    ```
+    All integers are little-endian. Vertices are float32 xyz, or uint8/uint16 if quantized (in which case
+    the header gives per-mesh `offset` and `scale` to dequantize); faces are uint32 vertex index triples.
+    Any metadata is added to the header.
+    """
+    header = {'meshes': [], **(metadata or {})}
+    buffers = []
+    for mesh_id, mesh in meshes.items():
+        vertices = np.asarray(mesh.vertices)
+        entry = {
+            'id': mesh_id,
+            'vertex_count': len(vertices),
+            'face_count': len(mesh.faces),
+        }
+        if quantize_bits is not None:
+            vertices, offset, scale = quantize_vertices(vertices, quantize_bits)
+            entry['offset'] = offset.tolist()
+            entry['scale'] = scale.tolist()
+        else:
+            vertices = vertices.astype('<f4', copy=False)
+        entry['vertex_dtype'] = vertices.dtype.str
+        vertex_bytes = np.ascontiguousarray(vertices).tobytes()
+        face_bytes = np.ascontiguousarray(mesh.faces, dtype='<u4').tobytes()
+        entry['vertex_bytes'] = len(vertex_bytes)
+        entry['face_bytes'] = len(face_bytes)
+        header['meshes'].append(entry)
+        buffers.extend([pad_to_4(vertex_bytes), pad_to_4(face_bytes)])
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 4)
+    return b''.join([container_magic, struct.pack('<II', container_version, len(header_bytes)), header_bytes, *buffers])
+
+
+def read_container_header(data):
+    # Returns the header dict and the position of the first buffer
+    assert data[:4] == container_magic, 'Not a mesh container'
+    version, header_length = struct.unpack_from('<II', data, 4)
+    assert version == container_version, f'Unsupported container version {version}'
+    header = json.loads(data[12 : 12 + header_length].decode('utf-8'))
+    return header, 12 + header_length
+
+
+def deserialize_container(data):
+    """
+    Inverse of serialize_as_container, for clients and tests.
+
+    Returns:
+        dict mapping mesh id to (vertices, faces), with vertices dequantized to float32 if necessary
+    """
+    header, position = read_container_header(data)
+
+    meshes = {}
+    for entry in header['meshes']:
+        vertices = np.frombuffer(data, dtype=entry['vertex_dtype'], count=entry['vertex_count'] * 3, offset=position).reshape(-1, 3)
+        position += entry['vertex_bytes'] + (-entry['vertex_bytes'] % 4)
+        faces = np.frombuffer(data, dtype='<u4', count=entry['face_count'] * 3, offset=position).reshape(-1, 3)
+        position += entry['face_bytes'] + (-entry['face_bytes'] % 4)
+        if 'scale' in entry:
+            vertices = (vertices * np.asarray(entry['scale']) + np.asarray(entry['offset'])).astype(np.float32)
+        meshes[entry['id']] = (vertices, faces)
+    return meshes
+
+
+def serialize_as_glb(meshes, quantize_bits=None, metadata=None):
+    """
+    Write meshes as a binary glTF, one named node/mesh per mesh id. With quantize_bits, positions are stored as
+    unsigned integers and dequantized by the node transform (KHR_mesh_quantization). Any metadata goes in the
+    asset's extras.
+    """
+    gltf = {
+        'asset': {'version': '2.0', 'generator': 'orthovis-meshing', **({'extras': metadata} if metadata else {})},
+        'scene': 0,
+        'scenes': [{'nodes': list(range(len(meshes)))}],
+        'nodes': [],
+        'meshes': [],
+        'accessors': [],
+        'bufferViews': [],
+        'buffers': [],
+    }
+    if quantize_bits is not None:
+        gltf['extensionsUsed'] = gltf['extensionsRequired'] = ['KHR_mesh_quantization']
+
+    chunks = []
+    byte_offset = 0
+
+    def add_buffer_view(data, target):
+        nonlocal byte_offset
+        gltf['bufferViews'].append({'buffer': 0, 'byteOffset': byte_offset, 'byteLength': len(data), 'target': target})
+        chunks.append(pad_to_4(data))
+        byte_offset += len(chunks[-1])
+        return len(gltf['bufferViews']) - 1
+
+    for mesh_idx, (mesh_id, mesh) in enumerate(meshes.items()):
+        vertices = np.asarray(mesh.vertices)
+        node = {'mesh': mesh_idx, 'name': mesh_id}
+        if quantize_bits is not None:
+            vertices, offset, scale = quantize_vertices(vertices, quantize_bits)
+            node['translation'] = offset.tolist()
+            node['scale'] = scale.tolist()
+            component_type = 5121 if quantize_bits == 8 else 5123  # UNSIGNED_BYTE / UNSIGNED_SHORT
+            # Vertex attribute elements must start on 4-byte boundaries, so pad each xyz with a zero fourth
+            # component (to 4 bytes for 8-bit, 8 bytes for 16-bit)
+            vertices = np.concatenate([vertices, np.zeros((len(vertices), 1), dtype=vertices.dtype)], axis=1).astype(
+                vertices.dtype.newbyteorder('<'), copy=False
+            )
+        else:
+            vertices = vertices.astype('<f4', copy=False)
+            component_type = 5126  # FLOAT
+        position_view = add_buffer_view(np.ascontiguousarray(vertices).tobytes(), 34962)  # ARRAY_BUFFER
+        if quantize_bits is not None:
+            gltf['bufferViews'][position_view]['byteStride'] = vertices.strides[0]
+            vertices = vertices[:, :3]
+        gltf['accessors'].append({
+            'bufferView': position_view,
+            'componentType': component_type,
+            'count': len(vertices),
+            'type': 'VEC3',
+            'min': vertices.min(axis=0).tolist(),
+            'max': vertices.max(axis=0).tolist(),
+        })
+        index_view = add_buffer_view(np.ascontiguousarray(mesh.faces, dtype='<u4').tobytes(), 34963)  # ELEMENT_ARRAY_BUFFER
+        gltf['accessors'].append({
+            'bufferView': index_view,
+            'componentType': 5125,  # UNSIGNED_INT
+            'count': int(np.size(mesh.faces)),
+            'type': 'SCALAR',
+        })
+        gltf['meshes'].append({'name': mesh_id, 'primitives': [{
+            'attributes': {'POSITION': len(gltf['accessors']) - 2},
+            'indices': len(gltf['accessors']) - 1,
+            'mode': 4,  # TRIANGLES
+        }]})
+        gltf['nodes'].append(node)
+
+    binary_chunk = b''.join(chunks)
+    gltf['buffers'].append({'byteLength': len(binary_chunk)})
+    json_chunk = json.dumps(gltf).encode('utf-8')
+    json_chunk += b' ' * (-len(json_chunk) % 4)  # JSON chunk is padded with spaces
+
+    total_length = 12 + 8 + len(json_chunk) + 8 + len(binary_chunk)
+    return b''.join([
+        struct.pack('<4sII', b'glTF', 2, total_length),
+        struct.pack('<I4s', len(json_chunk), b'JSON'), json_chunk,
+        struct.pack('<I4s', len(binary_chunk), b'BIN\0'), binary_chunk,
+    ])
+
+
+def serialize_labels(labels_xyz, spacing_xyz, label_to_name):
+    """
+    Compressed label volume (a numpy .npz) with what's needed to mesh it again: `labels` (indexed xyz, usually
+    uint8), `spacing` (xyz, mm) and `label_names` (JSON object mapping label values to names).
+    """
+    with io.BytesIO() as f:
+        np.savez_compressed(
+            f,
+            labels=labels_xyz,
+            spacing=np.asarray(spacing_xyz, dtype=np.float64),
+            label_names=np.array(json.dumps({int(label): name for label, name in label_to_name.items()})),
+        )
+        return f.getvalue()
+
+
+def deserialize_labels(data):
+    # Inverse of serialize_labels; returns labels_xyz, spacing_xyz, label_to_name
+    with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+        label_to_name = {int(label): name for label, name in json.loads(str(npz['label_names'])).items()}
+        return npz['labels'], tuple(npz['spacing'].tolist()), label_to_name
+
+
+def serialize_meshes(meshes, accept, metadata=None):
+    """
+    Serialize meshes according to the request's accept header.
+
+    Args:
+        meshes: dict mapping mesh id to an object with `vertices` (N x 3) and `faces` (M x 3) arrays
+        accept: accept header; `application/x-orthovis-meshes` and `model/gltf-binary` give binary
+            responses, optionally with a `quantize=8|16` parameter; anything else gives JSON
+        metadata: optional JSON-serializable dict to include in the response (e.g. request metrics); in the
+            container header, the GLB asset extras, or alongside 'meshes' in a JSON object
+
+    Returns:
+        (response, content_type) as expected from transform_fn
+    """
+    content_type, params = parse_accept(accept)
+    quantize_bits = int(params['quantize']) if 'quantize' in params else None
+    if content_type == container_content_type:
+        return serialize_as_container(meshes, quantize_bits, metadata), container_content_type
+    elif content_type == glb_content_type:
+        return serialize_as_glb(meshes, quantize_bits, metadata), glb_content_type
+    else:
+        return serialize_as_json(meshes, metadata), json_content_type
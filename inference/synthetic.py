@@ -0,0 +1,46 @@
+import numpy as np
+
+
+# Bone-like ellipsoids for up to four labels (tibia, fibula, talus, calcaneus): semi-axes and centre in mm (x, y, z),
+# relative to the volume centre. They fit in a volume of about 120 x 160 x 220 mm
+bones = {
+    1: ((20., 18., 60.), (-20., 0., 10.)),
+    2: ((8., 8., 60.), (15., 5., 15.)),
+    3: ((25., 20., 15.), (-20., 5., -55.)),
+    4: ((20., 40., 18.), (-20., 25., -80.)),
+}
+
+
+def get_shape(extent_mm, spacing):
+    # Volume shape covering extent_mm at this spacing
+    return tuple(int(round(extent / s)) for extent, s in zip(extent_mm, spacing))
+
+
+def make_bone_labels(shape, spacing, num_labels=len(bones), num_specks=0, seed=0):
+    """
+    Synthetic label volume (x, y, z) for benchmarks: the first num_labels bones, and num_specks small
+    false-positive blobs of random labels scattered around.
+    """
+    assert 1 <= num_labels <= len(bones), f'Up to {len(bones)} labels'
+    rng = np.random.default_rng(seed)
+    spacing = np.asarray(spacing, dtype=np.float64)
+    centre_mm = np.asarray(shape) * spacing / 2
+    labels = np.zeros(shape, dtype=np.uint8)
+
+    def paint_ellipsoid(label, radii_mm, centre):
+        # Only evaluate within the ellipsoid's bounding box
+        lo = np.maximum(np.floor((centre - radii_mm) / spacing).astype(int), 0)
+        hi = np.minimum(np.ceil((centre + radii_mm) / spacing).astype(int) + 1, shape)
+        if np.any(hi <= lo):
+            return
+        x, y, z = np.meshgrid(*[np.arange(l, h) * s for l, h, s in zip(lo, hi, spacing)], indexing='ij', sparse=True)
+        inside = ((x - centre[0]) / radii_mm[0]) ** 2 + ((y - centre[1]) / radii_mm[1]) ** 2 + ((z - centre[2]) / radii_mm[2]) ** 2 < 1
+        labels[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]][inside] = label
+
+    for label in range(1, num_labels + 1):
+        radii_mm, offset_mm = bones[label]
+        paint_ellipsoid(label, np.asarray(radii_mm), centre_mm + np.asarray(offset_mm))
+    for _ in range(num_specks):
+        label = rng.integers(1, num_labels + 1)
+        paint_ellipsoid(label, rng.uniform(0.5, 3., size=3), rng.uniform(0, 1, size=3) * np.asarray(shape) * spacing)
+    return labels
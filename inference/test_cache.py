@@ -0,0 +1,116 @@
+import os
+import time
+import tempfile
+
+import numpy as np
+
+import cache
+
+
+def check_lru(result_cache):
+    # Each entry is 400 bytes and the limit 1000, so only two fit; reading 'a' makes 'b' the least recently used
+    result_cache.put('a', b'a' * 400)
+    time.sleep(0.01)
+    result_cache.put('b', b'b' * 400)
+    time.sleep(0.01)
+    assert result_cache.get('a') == b'a' * 400
+    time.sleep(0.01)
+    result_cache.put('c', b'c' * 400)
+    assert result_cache.get('b') is None
+    assert result_cache.get('a') == b'a' * 400
+    assert result_cache.get('c') == b'c' * 400
+    assert result_cache.get('missing') is None
+
+
+def test_directory_cache_lru():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        check_lru(cache.get_cache(os.path.join(temp_dir, 'cache'), 1000))
+
+
+def test_object_store_cache_lru():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        assert isinstance(cache.get_cache(f'file://{temp_dir}', 1000), cache.ObjectStoreCache)
+        # Touching on every read and evicting on every write, to check the order exactly
+        store = cache.DirectoryObjectStore(temp_dir)
+        check_lru(cache.ObjectStoreCache(store, 'cache', '', 1000, touch_after_seconds=0., evict_every_puts=1))
+
+
+def test_object_store_cache_rate_limits_touch_and_evict():
+    class CountingStore(cache.DirectoryObjectStore):
+        def __init__(self, directory):
+            super().__init__(directory)
+            self.calls = []
+
+        def copy_object(self, **kwargs):
+            self.calls.append('copy_object')
+            return super().copy_object(**kwargs)
+
+        def list_objects_v2(self, **kwargs):
+            self.calls.append('list_objects_v2')
+            return super().list_objects_v2(**kwargs)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = CountingStore(temp_dir)
+        result_cache = cache.ObjectStoreCache(store, 'cache', '', 1000, touch_after_seconds=3600., evict_every_puts=3)
+        for key in 'abcd':
+            result_cache.put(key, key.encode() * 400)
+        assert result_cache.get('d') == b'd' * 400
+        # Recently written, so not touched; evicted once (at the third write), leaving two entries and one more
+        assert store.calls == ['list_objects_v2']
+        assert len(store.list_objects_v2(Bucket='cache')['Contents']) == 3
+        old = time.time() - 7200
+        os.utime(store.get_path('cache', 'd'), (old, old))
+        result_cache.get('d')
+        assert store.calls[-1] == 'copy_object'
+
+
+def test_directory_cache_with_concurrent_eviction():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        result_cache = cache.get_cache(temp_dir, 1000)
+        result_cache.put('a', b'a' * 400)
+        result_cache.put('b', b'b' * 400)
+        # Another process removes entries after this one listed them
+        entries = list(os.scandir(temp_dir))
+        os.remove(os.path.join(temp_dir, 'a'))
+        scandir = cache.os.scandir
+        cache.os.scandir = lambda directory: iter(entries)
+        try:
+            result_cache.max_bytes = 0
+            result_cache.evict()
+        finally:
+            cache.os.scandir = scandir
+        assert os.listdir(temp_dir) == []
+
+        # Read, then evicted by another process before the read refreshes its mtime: still a hit
+        result_cache.max_bytes = 1000
+        result_cache.put('c', b'c')
+        utime = cache.os.utime
+        cache.os.utime = lambda path: (os.remove(path), utime(path))
+        try:
+            assert result_cache.get('c') == b'c'
+        finally:
+            cache.os.utime = utime
+
+
+def test_keys_and_labels():
+    volume = np.random.default_rng(0).normal(size=(4, 5, 6)).astype(np.float32)
+    geometry = ((0.5, 0.5, 1.), (0., 0., 0.), (1., 0., 0., 0., 1., 0., 0., 0., 1.))
+    volume_hash = cache.hash_volume(volume, *geometry)
+    assert volume_hash == cache.hash_volume(volume.copy(), *geometry)
+    assert volume_hash != cache.hash_volume(volume, (0.5, 0.5, 2.), *geometry[1:])
+    changed = volume.copy()
+    changed[0, 0, 0] += 1
+    assert volume_hash != cache.hash_volume(changed, *geometry)
+    assert cache.make_key('labels', volume_hash, 0.5) != cache.make_key('labels', volume_hash, 1.0)
+
+    labels = (volume > 0).astype(np.uint8)
+    assert np.array_equal(cache.labels_from_bytes(cache.labels_to_bytes(labels)), labels)
+
+
+if __name__ == '__main__':
+    test_directory_cache_lru()
+    test_object_store_cache_lru()
+    test_object_store_cache_rate_limits_touch_and_evict()
+    test_directory_cache_with_concurrent_eviction()
+    test_keys_and_labels()
+    print('ok')
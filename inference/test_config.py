@@ -0,0 +1,135 @@
+import os
+import importlib
+import contextlib
+
+import config
+import errors
+
+
+@contextlib.contextmanager
+def environment(**variables):
+    # config as loaded with these environment variables, restored afterwards
+    original = dict(os.environ)
+    os.environ.update(variables)
+    try:
+        yield importlib.reload(config)
+    finally:
+        os.environ.clear()
+        os.environ.update(original)
+        importlib.reload(config)
+
+
+def test_device():
+    with environment() as loaded:
+        assert loaded.get_device_name(cuda_available=True) == 'cuda'
+        assert loaded.get_device_name(cuda_available=False) == 'cpu'
+    with environment(ORTHOVIS_DEVICE='cpu') as loaded:
+        assert loaded.get_device_name(cuda_available=True) == 'cpu'
+    with environment(ORTHOVIS_DEVICE='cuda:1') as loaded:
+        assert loaded.get_device_name(cuda_available=True) == 'cuda:1'
+
+
+def test_threads():
+    # torch threads only set on CPU, one per CPU unless configured
+    with environment() as loaded:
+        assert loaded.get_num_threads('cpu') == os.cpu_count()
+        assert loaded.get_num_threads('cuda') is None
+    with environment(ORTHOVIS_TORCH_THREADS='3') as loaded:
+        assert loaded.get_num_threads('cpu') == 3
+
+    # Meshing workers share the CPUs out between model server workers, at least one each
+    with environment(SAGEMAKER_MODEL_SERVER_WORKERS='1') as loaded:
+        assert loaded.meshing_workers == os.cpu_count()
+    with environment(SAGEMAKER_MODEL_SERVER_WORKERS=str(2 * os.cpu_count())) as loaded:
+        assert loaded.meshing_workers == 1
+    with environment(SAGEMAKER_MODEL_SERVER_WORKERS='4', ORTHOVIS_MESHING_WORKERS='6') as loaded:
+        assert loaded.meshing_workers == 6
+
+
+def test_autocast():
+    with environment() as loaded:
+        assert loaded.get_autocast_dtype('cpu') is None
+    with environment(ORTHOVIS_CPU_AUTOCAST='bf16') as loaded:
+        assert loaded.get_autocast_dtype('cpu') == 'bfloat16'
+        assert loaded.get_autocast_dtype('cuda') is None  # nnUNet's own float16 autocast
+    try:
+        with environment(ORTHOVIS_CPU_AUTOCAST='fp16'):
+            assert False, 'unknown autocast should fail at load'
+    except AssertionError as e:
+        assert 'Unknown CPU autocast' in str(e)
+
+
+def assert_bad_request(function, *args, expected):
+    # A 400 whose message lists what's allowed
+    try:
+        function(*args)
+    except errors.BadRequestError as e:
+        assert e.status_code == 400 and expected in str(e), str(e)
+    else:
+        assert False, f'{args} should be rejected'
+
+
+def test_request_settings():
+    custom_attributes = config.parse_custom_attributes('Preset=fast; reduction_factor = 50,lod_factors=4+16;junk')
+    assert custom_attributes == {'preset': 'fast', 'reduction_factor': '50', 'lod_factors': '4+16'}
+    assert config.parse_custom_attributes(None) == {}
+
+    preset, settings = config.get_request_settings(custom_attributes)
+    assert preset == 'fast' and settings == config.presets['fast']
+    with environment(ORTHOVIS_PRESET='balanced', ORTHOVIS_USE_MIRRORING='0') as loaded:
+        assert loaded.get_request_settings({}) == ('balanced', loaded.presets['balanced'])
+        assert loaded.get_settings() == {'tile_step_size': 0.5, 'mirror_axes': (), 'reduction_factor': 100}
+    assert_bad_request(config.get_request_settings, {'preset': 'fastest'}, expected='fast, balanced, accurate')
+
+
+def test_meshing_options():
+    settings = config.get_settings('fast')
+    assert config.get_meshing_options(settings) == {
+        'reduction_factor': 300, 'voxel_components': False, 'min_component_voxels': 0, 'max_components_per_label': None,
+        'target_edge_length': None, 'lod_factors': (),
+    }
+    options = config.get_meshing_options(settings, config.parse_custom_attributes(
+        'reduction_factor=50;voxel_components=1;max_components_per_label=2;target_edge_length_mm=1.5;lod_factors=4+16'
+    ))
+    assert options == {
+        'reduction_factor': 50, 'voxel_components': True, 'min_component_voxels': 0, 'max_components_per_label': 2,
+        'target_edge_length': 1.5, 'lod_factors': (4, 16),
+    }
+    with environment(ORTHOVIS_TARGET_EDGE_LENGTH_MM='2', ORTHOVIS_LOD_FACTORS='4') as loaded:
+        options = loaded.get_meshing_options(settings, {'target_edge_length_mm': 'none', 'lod_factors': 'None'})
+        assert options['target_edge_length'] is None and options['lod_factors'] is None
+
+    for name, value, expected in [
+        ('reduction_factor', 'high', 'a non-negative integer'), ('reduction_factor', '-1', 'a non-negative integer'),
+        ('voxel_components', 'yes', '0 or 1'), ('min_component_voxels', '1.5', 'a non-negative integer'),
+        ('target_edge_length_mm', 'nan', 'a positive number'), ('target_edge_length_mm', '0', 'a positive number'),
+        ('lod_factors', '4,16', "positive integers separated by '+' (e.g. 4+16) or 'none'"),
+        ('lod_factors', '4+0', "positive integers separated by '+' (e.g. 4+16) or 'none'"),
+        # Only options that can be unset take 'none'
+        ('reduction_factor', 'none', 'a non-negative integer'), ('min_component_voxels', 'None', 'a non-negative integer'),
+        ('voxel_components', 'none', '0 or 1'),
+    ]:
+        assert_bad_request(config.get_meshing_options, settings, {name: value}, expected=f"{name}='{value}', expected {expected}")
+    for name in ('reduction_factor', 'min_component_voxels', 'voxel_components'):
+        try:
+            config.get_meshing_options(settings, {name: 'none'})
+        except errors.BadRequestError as e:
+            assert "'none'" not in str(e).split('expected')[1], str(e)
+    assert_bad_request(config.get_meshing_options, settings, {'max_components_per_label': '-2'}, expected="integer or 'none'")
+
+
+def test_select_labels():
+    label_to_name = {0: 'background', 1: 'tibia', 2: 'talus'}
+    assert config.select_labels(label_to_name, {}) == label_to_name
+    assert config.select_labels(label_to_name, {'labels': 'talus'}) == {2: 'talus'}
+    assert_bad_request(config.select_labels, label_to_name, {'labels': 'talus+fibula'}, expected='fibula, expected some of: background+tibia+talus')
+
+
+if __name__ == '__main__':
+    test_device()
+    test_threads()
+    test_autocast()
+    test_request_settings()
+    test_meshing_options()
+    test_select_labels()
+    print('ok')
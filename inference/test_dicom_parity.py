@@ -0,0 +1,99 @@
+import io
+import os
+import random
+import zipfile
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+import dicom
+
+
+study_uid = '1.2.826.0.1.3680043.2.1125.1'
+axial_series_uid = f'{study_uid}.1'
+
+
+def write_series(zip_file, temp_dir, series_uid, size_xyz, spacing_xyz, origin_xyz, direction=(1, 0, 0, 0, 1, 0, 0, 0, 1)):
+    # Write a synthetic CT series slice-by-slice (as a scanner would), shuffling the file order in the zip
+    # so that we rely on the slice ordering logic, not the file names
+    rng = np.random.default_rng(0)
+    volume_zyx = rng.integers(0, 3000, size=size_xyz[::-1], dtype=np.int16)
+    image = sitk.GetImageFromArray(volume_zyx)
+    image.SetSpacing(spacing_xyz)
+    image.SetOrigin(origin_xyz)
+    image.SetDirection(direction)
+
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    slice_indices = list(range(size_xyz[2]))
+    random.Random(0).shuffle(slice_indices)
+    for file_idx, z in enumerate(slice_indices):
+        slice_image = image[:, :, z]
+        tags = {
+            '0008|0060': 'CT',
+            '0020|000d': study_uid,
+            '0020|000e': series_uid,
+            '0008|0018': f'{series_uid}.{z}',
+            '0020|0037': '\\'.join(map(str, (*direction[0:7:3], *direction[1:8:3]))),
+            '0020|0032': '\\'.join(map(str, image.TransformIndexToPhysicalPoint((0, 0, z)))),
+            '0020|0013': str(file_idx),  # deliberately not the spatial order
+            '0028|0030': f'{spacing_xyz[1]}\\{spacing_xyz[0]}',
+            '0028|1052': '-1024',
+            '0028|1053': '1',
+        }
+        for tag, value in tags.items():
+            slice_image.SetMetaData(tag, value)
+        path = os.path.join(temp_dir, f'{series_uid}_{file_idx:03d}.dcm')
+        writer.SetFileName(path)
+        writer.Execute(slice_image)
+        zip_file.write(path, f'series/{series_uid[-1]}_IM{file_idx:03d}')
+
+
+def make_dicom_zip():
+    # The axial series we want, plus a single-slice scout and a sagittal reformat with more slices
+    zip_buffer = io.BytesIO()
+    with tempfile.TemporaryDirectory() as temp_dir, zipfile.ZipFile(zip_buffer, 'w') as zip_file:
+        write_series(zip_file, temp_dir, axial_series_uid, (48, 40, 24), (0.7, 0.8, 1.25), (-12.5, 30., 101.))
+        write_series(zip_file, temp_dir, f'{study_uid}.2', (64, 64, 1), (1.5, 1.5, 1.), (-50., -50., 100.))
+        write_series(zip_file, temp_dir, f'{study_uid}.3', (24, 30, 48), (1., 1., 0.7), (-12.5, 30., 130.),
+                     direction=(0, 0, -1, 1, 0, 0, 0, -1, 0))
+    return zip_buffer.getvalue()
+
+
+def read_with_sitk(zip_bytes):
+    # The original path in transform_fn: extract to disk, then let GDCM find and order the series
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as zip_file:
+            zip_file.extractall(temp_dir)
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(os.path.join(temp_dir, 'series'), axial_series_uid))
+        return reader.Execute()
+
+
+def test_selects_axial_series():
+    with zipfile.ZipFile(io.BytesIO(make_dicom_zip()), 'r') as zip_file:
+        series_uid_to_headers = dicom.index_series(zip_file)
+    assert len(series_uid_to_headers) == 3
+    assert all('PixelData' not in header for headers in series_uid_to_headers.values() for header in headers)
+    assert dicom.select_series(series_uid_to_headers) == axial_series_uid
+
+
+def test_in_memory_read_matches_sitk():
+    zip_bytes = make_dicom_zip()
+
+    image = read_with_sitk(zip_bytes)
+    volume_zyx, spacing_xyz, origin_xyz, direction = dicom.read_series_from_zip(zip_bytes)
+
+    # nnUNet casts to float32 on reading, so that is the precision that matters
+    assert volume_zyx.shape == sitk.GetArrayViewFromImage(image).shape
+    assert np.array_equal(volume_zyx, sitk.GetArrayFromImage(image).astype(np.float32))
+    assert spacing_xyz == image.GetSpacing()
+    assert np.allclose(origin_xyz, image.GetOrigin(), rtol=0, atol=1e-6)
+    assert np.allclose(direction, image.GetDirection(), rtol=0, atol=1e-6)
+
+
+if __name__ == '__main__':
+    test_selects_axial_series()
+    test_in_memory_read_matches_sitk()
+    print('ok')
@@ -0,0 +1,67 @@
+import json
+import time
+import tempfile
+import threading
+
+import cache
+import emulate_async
+
+
+class Handler:
+    # Stands in for inference.transform_fn, tracking the most invocations running at once
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def transform_fn(self, predictor, request_body, content_type, accept, context):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        if request_body == b'bad':
+            raise ValueError('not a DICOM zip')
+        return {'body': request_body.decode(), 'attributes': context.get_request_header(0, 'X-Amzn-SageMaker-Custom-Attributes')}, 'application/json'
+
+
+def test_async_contract_and_summary():
+    with tempfile.TemporaryDirectory() as directory:
+        store = cache.DirectoryObjectStore(directory)
+        store.put_object(Bucket='uploads', Key='case/a.zip', Body=b'good')
+        store.put_object(Bucket='uploads', Key='case/b.zip', Body=b'bad')
+        successes, errors = [], []
+        handler = Handler()
+        endpoint = emulate_async.AsyncEndpoint(
+            handler.transform_fn, None, store, 's3://results', 's3://failures', max_concurrent_invocations=2,
+            on_success=successes.append, on_error=errors.append,
+        )
+
+        response = endpoint.invoke_endpoint_async(InputLocation='s3://uploads/case/a.zip', CustomAttributes='preset=fast', InferenceId='first')
+        assert response['OutputLocation'] == 's3://results/first.out'
+        endpoint.invoke_endpoint_async(InputLocation='s3://uploads/case/b.zip', InferenceId='second')
+        endpoint.wait(2, timeout=10)
+        assert json.loads(store.get_object(Bucket='results', Key='first.out')['Body'].read()) == {'body': 'good', 'attributes': 'preset=fast'}
+        assert b'not a DICOM zip' in store.get_object(Bucket='failures', Key='second-error.out')['Body'].read()
+        assert successes[0]['inferenceId'] == 'first' and successes[0]['responseParameters']['outputLocation'] == 's3://results/first.out'
+        assert errors[0]['invocationStatus'] == 'Failed' and errors[0]['requestParameters']['inputLocation'] == 's3://uploads/case/b.zip'
+
+        # A burst queues behind the concurrency limit, and the backlog drains
+        summary, backlog_samples = emulate_async.run_load(
+            endpoint, ['s3://uploads/case/a.zip'], [0.] * 10, {'Accept': 'application/json'}, sample_interval=0.01,
+        )
+        assert handler.max_running == 2
+        assert summary['num_completed'] == 10 and summary['num_failed'] == 0
+        assert summary['latency_p50_seconds'] <= summary['latency_p95_seconds'] <= summary['latency_p99_seconds']
+        assert summary['backlog_per_instance_max'] > 2
+        assert endpoint.get_backlog_size() == 0
+
+    arrival_times = emulate_async.get_arrival_times(1000, 60.)
+    assert arrival_times[0] == 0 and len(arrival_times) == 1000
+    assert abs(arrival_times[-1] / 1000 - 1.) < 0.1
+
+
+if __name__ == '__main__':
+    test_async_contract_and_summary()
+    print('ok')
@@ -0,0 +1,65 @@
+import numpy as np
+
+import localization
+
+
+identity = (1., 0., 0., 0., 1., 0., 0., 0., 1.)
+
+
+def make_legs(spacing_xyz=(1.5, 1.5, 2.)):
+    # 600 mm of two legs (soft tissue with a bone cylinder each), feet at the bottom (low z, as LPS is superior +z)
+    shape_zyx = (300, 120, 160)
+    z, y, x = np.ogrid[:shape_zyx[0], :shape_zyx[1], :shape_zyx[2]]
+    volume = np.full(shape_zyx, -1000., dtype=np.float32)
+    bone = np.zeros(shape_zyx, dtype=bool)
+    for centre_x in (45, 115):
+        volume[((x - centre_x) ** 2 + (y - 60) ** 2 < 30 ** 2) & (z >= 5)] = 40.
+        bone |= ((x - centre_x) ** 2 + (y - 60) ** 2 < 10 ** 2) & (z >= 10)
+        # Foot, sticking out in y
+        bone |= (np.abs(x - centre_x) < 12) & (y >= 50) & (y < 110) & (z >= 10) & (z < 25)
+    volume[bone] = 700.
+    return volume, spacing_xyz
+
+
+def test_finds_each_ankle():
+    volume, spacing_xyz = make_legs()
+    rois = localization.find_rois(volume, spacing_xyz, identity, extent_mm=200., margin_mm=20.)
+    assert len(rois) == 2
+    (z0, y0, x0), (z1, y1, x1) = sorted(rois, key=lambda roi: roi[2].start)
+    assert x0.stop <= x1.start
+    assert x0.start <= 45 - 10 and x0.stop >= 45 + 12 and x1.start <= 115 - 12 and x1.stop >= 115 + 10
+    for z_slice, y_slice, _ in rois:
+        # From below the foot, up 200 mm plus margins (at 2 mm slices)
+        assert z_slice.start <= 10 and 100 <= z_slice.stop - 10 <= 125
+        assert y_slice.start <= 50 and y_slice.stop >= 110
+    assert sum(np.prod([s.stop - s.start for s in roi]) for roi in rois) < volume.size / 3
+
+
+def test_feet_at_the_end():
+    # Slice axis pointing inferior, so the feet are at the last slices
+    volume, spacing_xyz = make_legs()
+    rois = localization.find_rois(volume[::-1], spacing_xyz, (1., 0., 0., 0., 1., 0., 0., 0., -1.))
+    for z_slice, _, _ in rois:
+        assert z_slice.stop >= 290 and z_slice.start > 150
+
+
+def test_falls_back_to_full_volume():
+    volume, spacing_xyz = make_legs()
+    full = [tuple(slice(0, size) for size in volume.shape)]
+    sagittal = (0., 0., 1., 1., 0., 0., 0., 1., 0.)
+    assert localization.find_rois(volume, spacing_xyz, sagittal) == full
+    assert localization.find_rois(np.full_like(volume, -1000.), spacing_xyz, identity) == full
+
+
+def test_roi_origin():
+    roi = (slice(10, 20), slice(5, 15), slice(2, 30))
+    origin = localization.get_roi_origin((100., 50., -20.), (0.5, 0.5, 2.), identity, roi)
+    assert np.allclose(origin, (101., 52.5, 0.))
+
+
+if __name__ == '__main__':
+    test_finds_each_ankle()
+    test_feet_at_the_end()
+    test_falls_back_to_full_volume()
+    test_roi_origin()
+    print('ok')
@@ -0,0 +1,166 @@
+import threading
+
+import numpy as np
+import zmesh
+import trimesh
+
+import meshing
+
+
+def make_labels():
+    labels = np.zeros((40, 30, 20), dtype=np.uint8)
+    labels[5:15, 5:25, 2:18] = 1
+    labels[0:3, 0:3, 0:3] = 1  # a second component, flush with the volume edge
+    labels[20:35, 10:20, 5:20] = 2  # flush with the far z edge
+    return labels
+
+
+def test_parallel_matches_serial():
+    labels = make_labels()
+    serial = meshing.convert_array_to_meshes(labels, (0.5, 0.5, 1.2), {1: 'tibia', 2: 'talus'}, num_workers=1)
+    parallel = meshing.convert_array_to_meshes(labels, (0.5, 0.5, 1.2), {1: 'tibia', 2: 'talus'}, num_workers=2)
+    assert sorted(serial) == sorted(parallel) == ['talus_0', 'tibia_0', 'tibia_1']
+    for mesh_id, mesh in serial.items():
+        assert np.allclose(mesh.vertices, parallel[mesh_id].vertices)
+        assert np.array_equal(mesh.faces, parallel[mesh_id].faces)
+
+
+def test_pool_is_shared_across_job_counts_and_threads():
+    # One pool however many jobs a request has, which concurrent requests can submit to
+    labels = make_labels()
+    meshing.convert_array_to_meshes(labels, (0.5, 0.5, 1.2), {1: 'tibia', 2: 'talus'}, num_workers=2, voxel_components=True)
+    executor = meshing.get_executor(2)
+    meshing.start_workers(2)
+    assert len(executor._processes) == 2
+    results = []
+    threads = [
+        threading.Thread(target=lambda label_to_name: results.append(sorted(meshing.convert_array_to_meshes(
+            labels, (0.5, 0.5, 1.2), label_to_name, num_workers=2, voxel_components=True,
+        ))), args=(label_to_name,))
+        for label_to_name in [{1: 'tibia', 2: 'talus'}, {1: 'tibia'}, {2: 'talus'}] * 2
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == sorted([['talus_0', 'tibia_0', 'tibia_1'], ['tibia_0', 'tibia_1'], ['talus_0']] * 2)
+    assert meshing.get_executor(3) is executor
+
+
+def test_split_components_matches_trimesh():
+    labels = make_labels()
+    labels[30:32, 0:2, 0:2] = 1  # a speck
+    mesher = zmesh.Mesher((0.5, 0.5, 1.2))
+    mesher.mesh((labels == 1).astype(np.uint8), close=True)
+    mesh = mesher.get(1, normals=False, reduction_factor=100)
+    vertices = mesh.vertices.astype(np.float32)
+    components = meshing.split_components(vertices, mesh.faces)
+    expected = trimesh.Trimesh(vertices=vertices, faces=mesh.faces).split()
+    assert len(components) == len(expected) == 3
+    for (component_vertices, component_faces), cc_mesh in zip(components, expected):
+        assert component_vertices.dtype == np.float32 and component_faces.dtype == np.uint32
+        assert np.array_equal(component_vertices, cc_mesh.vertices.astype(np.float32))
+        assert np.array_equal(component_faces, cc_mesh.faces)
+
+
+def test_meshes_are_compact_and_centred():
+    meshes = meshing.convert_array_to_meshes(make_labels(), (0.5, 0.5, 1.2), {1: 'tibia', 2: 'talus'}, num_workers=1)
+    assert all(mesh.vertices.dtype == np.float32 and mesh.faces.dtype == np.uint32 for mesh in meshes.values())
+    all_vertices = np.concatenate([mesh.vertices for mesh in meshes.values()])
+    assert np.allclose(all_vertices.mean(axis=0), 0, atol=1e-4)
+
+
+def test_cropped_label_placement():
+    # Meshing a label within its bounding box should place it where meshing the full volume would
+    # (up to simplification, which is sensitive to vertex order, so allow a voxel of slack)
+    labels = make_labels()
+    spacing = (0.5, 0.5, 1.2)
+    mesher = zmesh.Mesher(spacing)
+    mesher.mesh(labels, close=True)
+    for label in (1, 2):
+        full_vertices = mesher.get(label, normals=False, reduction_factor=0).vertices
+        bbox = tuple(slice(indices.min(), indices.max() + 1) for indices in np.nonzero(labels == label))
+        crop_vertices = np.concatenate([
+            mesh.vertices for mesh in meshing.mesh_label(labels[bbox] == label, [s.start for s in bbox], spacing)
+        ])
+        assert np.allclose(full_vertices.min(axis=0), crop_vertices.min(axis=0), atol=max(spacing))
+        assert np.allclose(full_vertices.max(axis=0), crop_vertices.max(axis=0), atol=max(spacing))
+
+
+def test_voxel_components_with_dust_filtering():
+    labels = make_labels()
+    labels[30:32, 0:2, 0:2] = 2  # a speck of 8 voxels
+    labels[36:40, 25:30, 0:5] = 2  # a bigger fragment
+    meshes = meshing.convert_array_to_meshes(labels, (0.5, 0.5, 1.2), {1: 'tibia', 2: 'talus'}, num_workers=1, voxel_components=True)
+    assert sorted(meshes) == ['talus_0', 'talus_1', 'talus_2', 'tibia_0', 'tibia_1']
+    assert len(meshes['talus_0'].vertices) > len(meshes['talus_1'].vertices) > len(meshes['talus_2'].vertices)
+
+    meshes = meshing.convert_array_to_meshes(
+        labels, (0.5, 0.5, 1.2), {1: 'tibia', 2: 'talus'}, num_workers=1,
+        voxel_components=True, min_component_voxels=10, max_components_per_label=1,
+    )
+    assert sorted(meshes) == ['talus_0', 'tibia_0']
+
+
+def test_isotropic_remeshing():
+    labels = np.zeros((60, 60, 40), dtype=np.uint8)
+    x, y, z = np.meshgrid(*[np.arange(n) * 0.5 for n in labels.shape], indexing='ij', sparse=True)
+    labels[((x - 15) / 12) ** 2 + ((y - 15) / 10) ** 2 + ((z - 10) / 8) ** 2 < 1] = 1
+    meshes = meshing.convert_array_to_meshes(labels, (0.5, 0.5, 0.5), {1: 'talus'}, num_workers=1, target_edge_length=1.5)
+    mesh = trimesh.Trimesh(meshes['talus_0'].vertices, meshes['talus_0'].faces)
+    edge_lengths = np.linalg.norm(np.diff(mesh.vertices[mesh.edges_unique], axis=1)[:, 0], axis=1)
+    assert abs(np.median(edge_lengths) - 1.5) < 0.3
+    assert mesh.is_watertight
+
+
+def test_lod_pyramid():
+    labels = np.zeros((80, 80, 40), dtype=np.uint8)
+    x, y, z = np.meshgrid(*[np.arange(n) * 0.5 for n in labels.shape], indexing='ij', sparse=True)
+    labels[((x - 20) / 15) ** 2 + ((y - 20) / 12) ** 2 + ((z - 10) / 8) ** 2 < 1] = 1
+    spacing = (0.5, 0.5, 0.5)
+    single = meshing.convert_array_to_meshes(labels, spacing, {1: 'talus'}, num_workers=1)
+    meshes = meshing.convert_array_to_meshes(labels, spacing, {1: 'talus'}, num_workers=1, lod_factors=(4, 16))
+    # Coarsest first, and the full-detail mesh is as without levels of detail
+    assert list(meshes) == ['talus_0_lod2', 'talus_0_lod1', 'talus_0']
+    assert np.allclose(meshes['talus_0'].vertices, single['talus_0'].vertices)
+    face_counts = [len(meshes[mesh_id].faces) for mesh_id in ['talus_0', 'talus_0_lod1', 'talus_0_lod2']]
+    assert face_counts[0] > 2 * face_counts[1] > 4 * face_counts[2] > 0
+    # All levels are placed alike
+    for mesh_id in ['talus_0_lod1', 'talus_0_lod2']:
+        assert np.allclose(meshes[mesh_id].vertices.mean(axis=0), meshes['talus_0'].vertices.mean(axis=0), atol=max(spacing))
+        assert trimesh.Trimesh(meshes[mesh_id].vertices, meshes[mesh_id].faces).is_watertight
+
+
+def test_reversed_axes():
+    # Meshing the zyx volume with reversed axes gives the xyz meshes, facing outwards
+    labels_xyz = make_labels()
+    labels_zyx = np.ascontiguousarray(labels_xyz.transpose(2, 1, 0))
+    spacing = (0.5, 0.5, 1.2)
+    label_to_name = {1: 'tibia', 2: 'talus'}
+    meshes = meshing.convert_array_to_meshes(labels_xyz, spacing, label_to_name, num_workers=1)
+    reversed_meshes = meshing.convert_array_to_meshes(labels_zyx, spacing[::-1], label_to_name, num_workers=1, reverse_axes=True)
+    assert sorted(meshes) == sorted(reversed_meshes)
+    # Components may come out in another order, so compare each label's as a whole
+    for name in label_to_name.values():
+        parts = [trimesh.Trimesh(mesh.vertices, mesh.faces) for mesh_id, mesh in meshes.items() if mesh_id.startswith(name)]
+        reversed_parts = [trimesh.Trimesh(mesh.vertices, mesh.faces) for mesh_id, mesh in reversed_meshes.items() if mesh_id.startswith(name)]
+        assert np.allclose(trimesh.util.concatenate(parts).bounds, trimesh.util.concatenate(reversed_parts).bounds, atol=max(spacing))
+        volume = sum(part.volume for part in parts)
+        assert volume > 0 and abs(sum(part.volume for part in reversed_parts) - volume) < 0.05 * volume
+    assert all(mesh.vertices.flags.c_contiguous and mesh.faces.flags.c_contiguous for mesh in reversed_meshes.values())
+
+    # Labels without a name aren't meshed
+    assert sorted(meshing.convert_array_to_meshes(labels_xyz, spacing, {2: 'talus'}, num_workers=1)) == ['talus_0']
+
+
+if __name__ == '__main__':
+    test_parallel_matches_serial()
+    test_pool_is_shared_across_job_counts_and_threads()
+    test_split_components_matches_trimesh()
+    test_meshes_are_compact_and_centred()
+    test_cropped_label_placement()
+    test_voxel_components_with_dust_filtering()
+    test_lod_pyramid()
+    test_reversed_axes()
+    test_isotropic_remeshing()
+    print('ok')
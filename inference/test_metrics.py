@@ -0,0 +1,101 @@
+import json
+import threading
+
+import numpy as np
+
+import metrics
+import serialization
+from meshing import Mesh
+
+
+def test_spans_and_emf():
+    request_metrics = metrics.RequestMetrics(dimensions={'Stack': 'test'})
+    with request_metrics.span('allocate'):
+        data = np.ones(32 * 1024 ** 2 // 8)  # 32 MB
+    del data
+    request_metrics.add_timings({'zmesh': 0.5}, prefix='meshing_')
+    request_metrics.set('num_meshes', 3, 'Count')
+    request_metrics.set_property('size_xyz', [512, 512, 300])
+
+    span = request_metrics.spans['allocate']
+    assert span['seconds'] >= 0
+    assert span['peak_rss_mb'] >= 32
+
+    emf = json.loads(json.dumps(request_metrics.to_emf()))
+    definition = emf['_aws']['CloudWatchMetrics'][0]
+    assert definition['Namespace'] == 'Orthovis/Meshing'
+    assert definition['Dimensions'] == [['Stack']]
+    assert emf['Stack'] == 'test'
+    assert emf['size_xyz'] == [512, 512, 300]
+    # Every declared metric has a top-level value
+    for metric in definition['Metrics']:
+        assert metric['Name'] in emf
+    assert emf['meshing_zmesh_ms'] == 500.
+    assert {'Name': 'allocate_peak_rss_mb', 'Unit': 'Megabytes'} in definition['Metrics']
+    assert {'Name': 'num_meshes', 'Unit': 'Count'} in definition['Metrics']
+    assert emf['peak_rss_mb'] == request_metrics.to_dict()['peak_rss_mb'] == span['peak_rss_mb']
+
+
+def test_overlapping_requests_have_no_peaks_of_their_own():
+    # Two requests in one process, one span starting while the other's runs: neither gets per-span peaks (the
+    # process-wide peak can't be reset for one without the other), and both report the process's peak instead
+    first, second = metrics.RequestMetrics(), metrics.RequestMetrics()
+    first_started, second_done = threading.Event(), threading.Event()
+
+    def run_first():
+        with first.span('prediction'):
+            first_started.set()
+            second_done.wait()
+
+    thread = threading.Thread(target=run_first)
+    thread.start()
+    first_started.wait()
+    with second.span('meshing'):
+        data = np.ones(16 * 1024 ** 2 // 8)
+    del data
+    second_done.set()
+    thread.join()
+
+    for request_metrics, name in [(first, 'prediction'), (second, 'meshing')]:
+        assert request_metrics.spans[name]['seconds'] >= 0 and 'peak_rss_mb' not in request_metrics.spans[name]
+        assert request_metrics.get_peak_rss_mb() is None
+        emf = request_metrics.to_emf()
+        assert 'peak_rss_mb' not in emf and emf['process_peak_rss_mb'] >= 16
+        assert {'Name': 'process_peak_rss_mb', 'Unit': 'Megabytes'} in emf['_aws']['CloudWatchMetrics'][0]['Metrics']
+
+    # Once the process runs one request at a time again, requests have their own peaks
+    alone = metrics.RequestMetrics()
+    with alone.span('meshing'):
+        pass
+    with alone.span('serialization'):
+        pass
+    assert alone.get_peak_rss_mb() is not None and alone.get_process_peak_rss_mb() is None
+    assert 'process_peak_rss_mb' not in alone.to_emf()
+
+    # A phase around another RequestMetrics' spans takes their peaks, rather than overlapping them
+    alone.add_nested('warm_up', 1., first)
+    assert alone.get_peak_rss_mb() is None and 'peak_rss_mb' not in alone.spans['warm_up']
+    nested = metrics.RequestMetrics()
+    with nested.span('prediction'):
+        pass
+    loaded = metrics.RequestMetrics()
+    loaded.add_nested('warm_up', 1., nested)
+    assert loaded.spans['warm_up']['peak_rss_mb'] == loaded.get_peak_rss_mb() == nested.get_peak_rss_mb()
+
+
+def test_metrics_in_response():
+    meshes = {'bone_0': Mesh(np.eye(3), [[0, 1, 2]])}
+    metadata = {'metrics': {'spans': {'meshing': {'seconds': 1.}}}}
+    response, _ = serialization.serialize_meshes(meshes, 'application/x-orthovis-meshes; metrics=1', metadata)
+    header, _ = serialization.read_container_header(response)
+    assert header['metrics'] == metadata['metrics']
+    assert list(serialization.deserialize_container(response)) == ['bone_0']
+    response, _ = serialization.serialize_meshes(meshes, 'application/json', metadata)
+    assert response['metrics'] == metadata['metrics'] and response['meshes'][0]['id'] == 'bone_0'
+
+
+if __name__ == '__main__':
+    test_spans_and_emf()
+    test_overlapping_requests_have_no_peaks_of_their_own()
+    test_metrics_in_response()
+    print('ok')
@@ -0,0 +1,62 @@
+import os
+import gzip
+import tarfile
+import tempfile
+
+import numpy as np
+
+import cache
+import model_package
+
+
+def make_model_folder(directory):
+    # An nnUNet results folder as training leaves it, with more than inference needs
+    for name, data in [
+        ('plans.json', b'{"plans": 1}'), ('dataset.json', b'{"labels": {}}'), ('progress.png', b'png'),
+        ('fold_all/checkpoint_best.pth', np.random.default_rng(0).bytes(3 * model_package.block_size + 123)),
+        ('fold_all/checkpoint_final.pth', b'final'), ('fold_all/training_log.txt', b'log'), ('fold_0/checkpoint_best.pth', b'fold 0'),
+    ]:
+        os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+
+
+def test_package_contents_and_upload():
+    with tempfile.TemporaryDirectory() as directory:
+        model_dir = os.path.join(directory, 'results')
+        make_model_folder(model_dir)
+        filename = model_package.create_sagemaker_model_package(model_dir, output_dir=directory, num_threads=3)
+
+        with tarfile.open(filename) as tar:
+            names = tar.getnames()
+            assert names == sorted(
+                [f'code/{file_name}' for file_name in model_package.required_files]
+                + ['model/dataset.json', 'model/fold_all/checkpoint_best.pth', 'model/plans.json']
+            )
+            with open(os.path.join(model_dir, 'fold_all/checkpoint_best.pth'), 'rb') as f:
+                assert tar.extractfile('model/fold_all/checkpoint_best.pth').read() == f.read()
+            assert all(member.mtime == 0 and member.uid == 0 for member in tar.getmembers())
+        # Several gzip members, read as one stream
+        with open(filename, 'rb') as f:
+            assert f.read().count(b'\x1f\x8b\x08') >= 4
+        with gzip.open(filename) as f:
+            assert len(f.read()) % tarfile.RECORDSIZE == 0
+
+        # Same model and code, same name (and bytes); another fold, another name
+        again = model_package.create_sagemaker_model_package(model_dir, output_dir=directory, num_threads=1)
+        assert again == filename
+        fold_0 = model_package.create_sagemaker_model_package(model_dir, output_dir=directory, fold='0')
+        assert fold_0 != filename
+
+        store = cache.DirectoryObjectStore(os.path.join(directory, 'buckets'))
+        url = model_package.upload_model_package(store, filename, 'models', 'dev/meshing')
+        assert url == f's3://models/dev/meshing/{os.path.basename(filename)}'
+        uploaded = store.get_path('models', f'dev/meshing/{os.path.basename(filename)}')
+        mtime = os.stat(uploaded).st_mtime_ns
+        assert model_package.upload_model_package(store, filename, 'models', 'dev/meshing') == url
+        assert os.stat(uploaded).st_mtime_ns == mtime  # not uploaded again
+
+
+if __name__ == '__main__':
+    test_package_contents_and_upload()
+    print('ok')
@@ -0,0 +1,73 @@
+import os
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pipeline
+
+
+class Counter:
+    # Tracks the most jobs running at once
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def job(self, value):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        if value < 0:
+            raise ValueError(value)
+        return value * 2
+
+
+def test_gpu_worker_runs_one_job_at_a_time():
+    counter = Counter()
+    worker = pipeline.GpuWorker()
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda value: worker.submit(counter.job, value).result(), range(16)))
+    assert results == [value * 2 for value in range(16)]
+    assert counter.max_running == 1
+
+    try:
+        worker.submit(counter.job, -1).result()
+        assert False, 'expected the job to raise'
+    except ValueError:
+        pass
+    assert worker.submit(counter.job, 3).result() == 6
+
+
+def test_workers_sharing_a_lock_file_take_turns():
+    # flock locks belong to the open file, so two workers in one process exclude each other as processes would
+    counter = Counter()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        lock_path = os.path.join(temp_dir, 'gpu.lock')
+        workers = [pipeline.GpuWorker(lock_path), pipeline.GpuWorker(lock_path)]
+        futures = [workers[idx % 2].submit(counter.job, idx) for idx in range(16)]
+        assert [future.result() for future in futures] == [idx * 2 for idx in range(16)]
+    assert counter.max_running == 1
+
+
+def test_volume_slots_bound_concurrency():
+    counter = Counter()
+    slots = pipeline.VolumeSlots(2)
+
+    def request(value):
+        with slots.slot():
+            return counter.job(value)
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(request, range(16)))
+    assert counter.max_running == 2
+
+
+if __name__ == '__main__':
+    test_gpu_worker_runs_one_job_at_a_time()
+    test_workers_sharing_a_lock_file_take_turns()
+    test_volume_slots_bound_concurrency()
+    print('ok')
@@ -0,0 +1,125 @@
+import io
+import json
+import struct
+
+import numpy as np
+import trimesh
+
+import errors
+import meshing
+import serialization
+
+
+def make_meshes():
+    labels = np.zeros((40, 30, 20), dtype=np.uint8)
+    labels[5:15, 5:25, 2:18] = 1
+    labels[20:35, 10:20, 5:15] = 2
+    return meshing.convert_array_to_meshes(labels, (0.5, 0.5, 1.2), {1: 'tibia', 2: 'talus'})
+
+
+def test_json_fallback():
+    meshes = make_meshes()
+    response, content_type = serialization.serialize_meshes(meshes, 'text/csv')
+    assert content_type == 'application/json'
+    assert [mesh['id'] for mesh in json.loads(json.dumps(response))] == list(meshes)
+
+
+def test_container_round_trip():
+    meshes = make_meshes()
+    response, content_type = serialization.serialize_meshes(meshes, 'application/x-orthovis-meshes')
+    assert content_type == 'application/x-orthovis-meshes'
+    decoded = serialization.deserialize_container(response)
+    assert list(decoded) == list(meshes)
+    for mesh_id, (vertices, faces) in decoded.items():
+        assert np.allclose(vertices, meshes[mesh_id].vertices, atol=1e-4)
+        assert np.array_equal(faces, meshes[mesh_id].faces)
+
+
+def test_quantized_container_round_trip():
+    meshes = make_meshes()
+    response, _ = serialization.serialize_meshes(meshes, 'application/x-orthovis-meshes; quantize=16')
+    for mesh_id, (vertices, faces) in serialization.deserialize_container(response).items():
+        extent = np.ptp(meshes[mesh_id].vertices, axis=0)
+        assert np.all(np.abs(vertices - meshes[mesh_id].vertices) <= extent / 2 ** 16 + 1e-5)
+        assert np.array_equal(faces, meshes[mesh_id].faces)
+
+
+def test_parse_accept():
+    assert serialization.parse_accept('Application/X-Orthovis-Meshes; Quantize=8, application/json') == (
+        'application/x-orthovis-meshes', {'quantize': '8'}
+    )
+    assert serialization.parse_accept(None) == ('application/json', {})
+    for accept in ['model/gltf-binary; quantize=12', 'application/x-orthovis-meshes; quantize=']:
+        try:
+            serialization.parse_accept(accept)
+            assert False, f'{accept} should be rejected'
+        except errors.BadRequestError as e:
+            assert e.status_code == 400 and '8 or 16' in str(e)
+
+
+def test_glb_loads():
+    meshes = make_meshes()
+    response, content_type = serialization.serialize_meshes(meshes, 'model/gltf-binary')
+    assert content_type == 'model/gltf-binary'
+    scene = trimesh.load(io.BytesIO(response), file_type='glb', process=False)
+    assert len(scene.geometry) == len(meshes)
+    for mesh_id, mesh in meshes.items():
+        assert np.allclose(scene.geometry[mesh_id].vertices, mesh.vertices, atol=1e-4)
+
+
+def read_glb(data):
+    # JSON and binary chunks of a GLB
+    json_length, _ = struct.unpack_from('<I4s', data, 12)
+    gltf = json.loads(data[20 : 20 + json_length])
+    binary_length, _ = struct.unpack_from('<I4s', data, 20 + json_length)
+    return gltf, data[28 + json_length : 28 + json_length + binary_length]
+
+
+def test_quantized_glb_round_trip():
+    meshes = make_meshes()
+    for bits, component_type, dtype in [(8, 5121, np.uint8), (16, 5123, np.uint16)]:
+        response, _ = serialization.serialize_meshes(meshes, f'model/gltf-binary; quantize={bits}')
+        gltf, binary = read_glb(response)
+        assert gltf['extensionsRequired'] == ['KHR_mesh_quantization']
+        for node, (mesh_id, mesh) in zip(gltf['nodes'], meshes.items()):
+            primitive = gltf['meshes'][node['mesh']]['primitives'][0]
+            accessor = gltf['accessors'][primitive['attributes']['POSITION']]
+            view = gltf['bufferViews'][accessor['bufferView']]
+            # Each element (xyz plus a padding component) starts on a 4-byte boundary
+            assert accessor['componentType'] == component_type and accessor['type'] == 'VEC3'
+            assert view['byteStride'] == 4 * np.dtype(dtype).itemsize and view['byteOffset'] % 4 == 0
+            assert accessor['count'] == len(mesh.vertices) and view['byteLength'] == accessor['count'] * view['byteStride']
+            quantized = np.frombuffer(binary, dtype='<' + np.dtype(dtype).str[1:], count=4 * accessor['count'], offset=view['byteOffset'])
+            quantized = quantized.reshape(-1, 4)[:, :3]
+            assert np.array_equal(quantized.min(axis=0), accessor['min']) and np.array_equal(quantized.max(axis=0), accessor['max'])
+            vertices = quantized * np.asarray(node['scale']) + np.asarray(node['translation'])
+            extent = np.ptp(mesh.vertices, axis=0)
+            assert np.all(np.abs(vertices - mesh.vertices) <= extent / 2 ** bits + 1e-5)
+
+            index_accessor = gltf['accessors'][primitive['indices']]
+            index_view = gltf['bufferViews'][index_accessor['bufferView']]
+            faces = np.frombuffer(binary, dtype='<u4', count=index_accessor['count'], offset=index_view['byteOffset'])
+            assert np.array_equal(faces.reshape(-1, 3), mesh.faces)
+
+
+def test_labels_round_trip():
+    labels = np.zeros((20, 10, 5), dtype=np.uint8)
+    labels[2:8, 3:6, 1:4] = 1
+    labels[10:15, 2:4, 0:2] = 2
+    data = serialization.serialize_labels(labels, (0.4, 0.4, 1.), {0: 'background', 1: 'tibia', 2: 'talus'})
+    assert len(data) < labels.nbytes
+    decoded, spacing, label_to_name = serialization.deserialize_labels(data)
+    assert decoded.dtype == np.uint8 and np.array_equal(decoded, labels)
+    assert spacing == (0.4, 0.4, 1.)
+    assert label_to_name == {0: 'background', 1: 'tibia', 2: 'talus'}
+
+
+if __name__ == '__main__':
+    test_json_fallback()
+    test_container_round_trip()
+    test_quantized_container_round_trip()
+    test_parse_accept()
+    test_glb_loads()
+    test_quantized_glb_round_trip()
+    test_labels_round_trip()
+    print('ok')
@@ -0,0 +1,49 @@
+import numpy as np
+from scipy import ndimage
+
+import tiling
+
+
+def test_plan_slabs_covers_rows_once():
+    slabs = tiling.plan_slabs(100, 30, 8)
+    assert [(core.start, core.stop) for core, _ in slabs] == [(0, 30), (30, 60), (60, 90), (90, 100)]
+    assert [(context.start, context.stop) for _, context in slabs] == [(0, 38), (22, 68), (52, 98), (82, 100)]
+    assert tiling.get_rows_per_slab(1000, 10, 8, min_rows=20) == 84
+    assert tiling.get_rows_per_slab(100, 10, 8, min_rows=20) == 20
+
+
+def predict_logits(data):
+    # Stands in for the network: two classes, from a blurred channel, so predictions depend on context
+    blurred = ndimage.gaussian_filter(data[0], 2.)
+    return np.stack([-blurred, blurred]).astype(np.float16)
+
+
+def resample(logits, shape):
+    return np.stack([
+        ndimage.zoom(channel.astype(np.float32), np.asarray(shape) / channel.shape, order=1, grid_mode=True, mode='nearest')
+        for channel in logits
+    ])
+
+
+def to_labels(logits):
+    return np.argmax(logits, axis=0)
+
+
+def test_slabs_match_whole_volume():
+    rng = np.random.default_rng(0)
+    data = ndimage.gaussian_filter(rng.normal(size=(1, 60, 40, 40)), 3.)
+    shape_out = (90, 50, 50)
+    whole = to_labels(resample(predict_logits(data), shape_out))
+    slabs = tiling.predict_in_slabs(data, shape_out, 16, 8, predict_logits, resample, to_labels)
+    assert slabs.dtype == np.uint8 and slabs.shape == shape_out
+    # Only resampling at slab boundaries can differ
+    assert np.mean(slabs != whole) < 0.01
+
+    one_slab = tiling.predict_in_slabs(data, shape_out, 60, 8, predict_logits, resample, to_labels)
+    assert np.array_equal(one_slab, whole)
+
+
+if __name__ == '__main__':
+    test_plan_slabs_covers_rows_once()
+    test_slabs_match_whole_volume()
+    print('ok')
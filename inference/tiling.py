@@ -0,0 +1,54 @@
+import numpy as np
+
+
+def plan_slabs(num_rows, rows_per_slab, margin):
+    """
+    Split rows [0, num_rows) of the first spatial axis into slabs of at most rows_per_slab rows, each predicted
+    with up to margin rows of context on either side (so tiles near a slab's edge see what they would in the
+    full volume).
+
+    Returns:
+        list of (core, context) slices; cores cover all rows without overlapping
+    """
+    slabs = []
+    for start in range(0, num_rows, rows_per_slab):
+        stop = min(start + rows_per_slab, num_rows)
+        slabs.append((slice(start, stop), slice(max(start - margin, 0), min(stop + margin, num_rows))))
+    return slabs
+
+
+def scale_slice(rows, scale):
+    # The rows of the resampled volume that rows of the preprocessed volume map to
+    return slice(int(round(rows.start * scale)), int(round(rows.stop * scale)))
+
+
+def get_rows_per_slab(budget_bytes, bytes_per_row, margin, min_rows):
+    # As many rows as fit the budget once the context is added, but at least a patch's worth
+    return max(int(budget_bytes // bytes_per_row) - 2 * margin, min_rows)
+
+
+def predict_in_slabs(data, shape_out, rows_per_slab, margin, predict_logits, resample, to_labels, dtype=np.uint8):
+    """
+    Labels for a preprocessed volume, predicted, resampled and reduced to labels one slab (along the first
+    spatial axis) at a time, so only one slab's logits are held at once rather than the whole volume's.
+
+    Args:
+        data: preprocessed volume, channels first (c, z, y, x)
+        shape_out: spatial shape of the labels, i.e. data's after resampling back
+        predict_logits: function of a slab of data, giving logits (classes, rows, y, x)
+        resample: function of logits and a spatial shape, giving logits at that shape
+        to_labels: function of logits, giving labels (rows, y, x)
+
+    Returns:
+        labels of shape shape_out; close to predicting the whole volume at once, but resampling near slab
+        boundaries may differ by a voxel, as it only sees the slab's context
+    """
+    labels = np.zeros(shape_out, dtype=dtype)
+    scale = shape_out[0] / data.shape[1]
+    for core, context in plan_slabs(data.shape[1], rows_per_slab, margin):
+        logits = predict_logits(np.ascontiguousarray(data[:, context]))
+        core_out, context_out = scale_slice(core, scale), scale_slice(context, scale)
+        logits = resample(logits, (context_out.stop - context_out.start, *shape_out[1:]))
+        labels[core_out] = to_labels(logits[:, core_out.start - context_out.start : core_out.stop - context_out.start])
+        del logits
+    return labels
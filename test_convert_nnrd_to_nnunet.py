@@ -0,0 +1,168 @@
+import os
+import time
+import tempfile
+
+import numpy as np
+import fastremap
+import SimpleITK as sitk
+
+import convert_nnrd_to_nnunet as convert
+
+
+def make_segmentation(array, segments, is_vector):
+    # segments: (layer, label value, name) per Slicer segment
+    image = sitk.GetImageFromArray(array, isVector=is_vector)
+    for idx, (layer, value, name) in enumerate(segments):
+        image.SetMetaData(f'Segment{idx}_Layer', str(layer))
+        image.SetMetaData(f'Segment{idx}_LabelValue', str(value))
+        image.SetMetaData(f'Segment{idx}_Name', name)
+    return image
+
+
+def relabel_with_fastremap(array, segments, variant):
+    # What relabel did before lookup tables: remap each layer to instance labels (numbered in segment order),
+    # merge layers with np.maximum, then remap instance labels to the variant's classes
+    if array.ndim == 3:
+        label_to_bone = {value: name.replace(' ', '_').split('_')[0] for _, value, name in segments}
+        merged = array
+    else:
+        label_to_bone = {}
+        merged = np.zeros_like(array[..., 0])
+        for layer in sorted({layer for layer, _, _ in segments}):
+            mapping = {0: 0}
+            for idx, (segment_layer, value, name) in enumerate(segments):
+                if segment_layer == layer:
+                    mapping[value] = idx + 1
+                    label_to_bone[idx + 1] = name.replace(' ', '_').split('_')[0]
+            merged = np.maximum(merged, fastremap.remap(array[..., layer], mapping))
+    if variant == 'binary':
+        return fastremap.remap(merged, {0: 0, **{label: 1 for label in label_to_bone}})
+    return fastremap.remap(merged, {0: 0, **{label: convert.bone_name_to_label[bone.lower()] for label, bone in label_to_bone.items()}})
+
+
+def test_relabel_matches_fastremap():
+    rng = np.random.default_rng(0)
+    cases = [
+        (rng.integers(0, 4, (20, 30, 40)).astype(np.uint8), [(0, 1, 'Tibia'), (0, 2, 'Fibula 1'), (0, 3, 'calcaneus')]),
+        (rng.integers(0, 4, (20, 30, 40)).astype(np.int16) * 100, [(0, 100, 'Tibia'), (0, 200, 'talus_left'), (0, 300, 'Fibula')]),
+        # 32-bit values go through a lookup table of known values, clipped
+        (rng.integers(0, 4, (20, 30, 40)).astype(np.int32) * 70000, [(0, 70000, 'Tibia'), (0, 140000, 'talus'), (0, 210000, 'Fibula')]),
+        (
+            np.stack([rng.integers(0, 3, (20, 30, 40)), rng.integers(0, 2, (20, 30, 40)), rng.integers(0, 2, (20, 30, 40))], -1).astype(np.uint8),
+            [(0, 1, 'Tibia'), (1, 1, 'Fibula_1'), (0, 2, 'talus'), (2, 1, 'Calcaneus')],
+        ),
+    ]
+    for array, segments in cases:
+        seg_nrrd = make_segmentation(array, segments, array.ndim == 4)
+        # Chunks of a few slices, not dividing the volume evenly
+        relabelled = convert.relabel(seg_nrrd, chunk_voxels=3 * 30 * 40)
+        for variant, image in relabelled.items():
+            labels = sitk.GetArrayFromImage(image)
+            assert labels.dtype == np.uint8 and labels.shape == array.shape[:3]
+            assert np.array_equal(labels, relabel_with_fastremap(array, segments, variant)), variant
+
+
+def test_relabel_whole_body_crop_and_unknown_labels():
+    # Without segment metadata, labels are taken as ours already
+    array = np.random.default_rng(1).integers(0, 5, (10, 12, 14)).astype(np.uint8)
+    relabelled = convert.relabel(make_segmentation(array, [], False))
+    assert np.array_equal(sitk.GetArrayFromImage(relabelled['multiclass']), array)
+    assert np.array_equal(sitk.GetArrayFromImage(relabelled['binary']), array > 0)
+
+    # Label values missing from the metadata fail, including negative ones and ones beyond a 32-bit lookup table
+    for value, dtype in [(7, np.uint8), (300, np.uint16), (-5, np.int32), (10 ** 6, np.int32)]:
+        array = np.zeros((4, 5, 6), dtype=dtype)
+        array[2, 2, 2] = value
+        try:
+            convert.relabel(make_segmentation(array, [(0, 1, 'Tibia')], False))
+        except AssertionError:
+            pass
+        else:
+            assert False, f'label {value} not caught'
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def run_plan(legs, manifest, dataset_dirs, force=False):
+    # plan_conversion, then what main does with a successful conversion: write the outputs and the manifest
+    entries, to_convert, removed, next_case_idx = convert.plan_conversion(legs, manifest, dataset_dirs, force)
+    for entry in removed.values():
+        convert.remove_outputs(entry, dataset_dirs)
+    for leg_dir, entry in entries.items():
+        if entry['case_id'] in to_convert:
+            convert.remove_outputs(entry, dataset_dirs)
+            for path in convert.get_output_paths(entry['case_id'], entry['seg'] is not None, dataset_dirs):
+                write_file(path, b'converted')
+    manifest = {'params': convert.get_conversion_params(), 'next_case_idx': next_case_idx, 'legs': entries}
+    return manifest, sorted(to_convert), sorted(entry['case_id'] for entry in removed.values())
+
+
+def test_plan_conversion():
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_dirs = {variant: os.path.join(directory, name) for variant, name in convert.dataset_names.items()}
+
+        def leg(name, annotated=True):
+            write_file(os.path.join(directory, 'nrrds', name, 'ct.nrrd'), name.encode())
+            leg = {'dir': name, 'ct_path': os.path.join(directory, 'nrrds', name, 'ct.nrrd')}
+            if annotated:
+                write_file(os.path.join(directory, 'nrrds', name, 'seg.nrrd'), name.encode() + b' seg')
+                leg['seg_path'] = os.path.join(directory, 'nrrds', name, 'seg.nrrd')
+            return leg
+
+        legs = [leg('a'), leg('b'), leg('c', annotated=False)]
+        manifest, converted, removed = run_plan(legs, convert.load_manifest(os.path.join(directory, 'missing.json')), dataset_dirs)
+        # First run: all legs, numbered as full conversions did
+        assert converted == ['ankle_0000', 'ankle_0001', 'ankle_0002'] and removed == []
+        assert [manifest['legs'][name]['case_id'] for name in 'abc'] == ['ankle_0000', 'ankle_0001', 'ankle_0002']
+        assert run_plan(legs, manifest, dataset_dirs)[1:] == ([], [])
+
+        # A new leg (sorting first) gets the next id; a changed one keeps its id
+        time.sleep(0.01)
+        write_file(legs[1]['seg_path'], b'edited segmentation')
+        legs = [leg('0'), *legs]
+        manifest, converted, removed = run_plan(legs, manifest, dataset_dirs)
+        assert converted == ['ankle_0001', 'ankle_0003'] and manifest['legs']['0']['case_id'] == 'ankle_0003'
+
+        # A removed leg's outputs go, and its id isn't reused
+        manifest, converted, removed = run_plan([leg for leg in legs if leg['dir'] != '0'], manifest, dataset_dirs)
+        assert converted == [] and removed == ['ankle_0003']
+        assert not os.path.exists(os.path.join(dataset_dirs['binary'], 'imagesTr', 'ankle_0003_0000.nii.gz'))
+        legs = [leg for leg in legs if leg['dir'] != '0'] + [leg('d')]
+        manifest, converted, _ = run_plan(legs, manifest, dataset_dirs)
+        assert converted == ['ankle_0004']
+
+        # Annotating a test case makes it a training case, under the same id
+        legs = [leg if leg['dir'] != 'c' else {**leg, 'seg_path': os.path.join(directory, 'nrrds', 'c', 'seg.nrrd')} for leg in legs]
+        write_file(legs[2]['seg_path'], b'c seg')
+        manifest, converted, _ = run_plan(legs, manifest, dataset_dirs)
+        assert converted == ['ankle_0002']
+        assert not os.path.exists(os.path.join(dataset_dirs['binary'], 'imagesTs', 'ankle_0002_0000.nii.gz'))
+        assert os.path.exists(os.path.join(dataset_dirs['binary'], 'labelsTr', 'ankle_0002.nii.gz'))
+
+        # Missing outputs, force, and changed label parameters all reconvert
+        os.remove(os.path.join(dataset_dirs['multiclass'], 'labelsTr', 'ankle_0000.nii.gz'))
+        assert run_plan(legs, manifest, dataset_dirs)[1] == ['ankle_0000']
+        all_cases = ['ankle_0000', 'ankle_0001', 'ankle_0002', 'ankle_0004']
+        assert run_plan(legs, manifest, dataset_dirs, force=True)[1] == all_cases
+        assert run_plan(legs, {**manifest, 'params': {**manifest['params'], 'bone_name_to_label': {}}}, dataset_dirs)[1] == all_cases
+
+        # An interrupted run's unconverted legs are converted next time
+        unconverted = {**manifest, 'legs': {**manifest['legs'], 'd': {**manifest['legs']['d'], 'converted': False}}}
+        assert run_plan(legs, unconverted, dataset_dirs)[1] == ['ankle_0004']
+
+        # Moving a leg's files (same size and mtime) re-hashes rather than trusting the old entry
+        os.rename(os.path.join(directory, 'nrrds', 'a'), os.path.join(directory, 'nrrds', 'moved'))
+        moved = {'dir': 'a', 'ct_path': os.path.join(directory, 'nrrds', 'moved', 'ct.nrrd'), 'seg_path': os.path.join(directory, 'nrrds', 'moved', 'seg.nrrd')}
+        entries = convert.plan_conversion([moved], manifest, dataset_dirs)[0]
+        assert entries['a']['ct']['path'] == moved['ct_path']
+
+
+if __name__ == '__main__':
+    test_relabel_matches_fastremap()
+    test_relabel_whole_body_crop_and_unknown_labels()
+    test_plan_conversion()
+    print('ok')
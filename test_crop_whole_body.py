@@ -0,0 +1,75 @@
+import os
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+import crop_whole_body
+
+
+def write_volumes(directory):
+    # Scalar and vector (multi-layer segmentation) volumes, raw and gzip, with non-trivial geometry
+    rng = np.random.default_rng(0)
+    paths = []
+    for name, array, is_vector in [
+        ('ct', rng.integers(-1000, 2000, (30, 12, 14)).astype(np.int16), False),
+        ('float', rng.normal(size=(30, 12, 14)).astype(np.float32), False),
+        ('layers', rng.integers(0, 3, (30, 12, 14, 2)).astype(np.uint8), True),
+    ]:
+        image = sitk.GetImageFromArray(array, isVector=is_vector)
+        image.SetSpacing((0.8, 0.7, 1.5))
+        image.SetOrigin((-10., 5., 100.))
+        for compress in (False, True):
+            path = os.path.join(directory, f"{name}_{'gzip' if compress else 'raw'}.nrrd")
+            sitk.WriteImage(image, path, compress)
+            paths.append(path)
+    return paths
+
+
+def test_rows_match_simpleitk():
+    with tempfile.TemporaryDirectory() as directory:
+        for path in write_volumes(directory):
+            assert crop_whole_body.get_unhandled_layout(crop_whole_body.read_nrrd_header(path)) is None, path
+            expected = sitk.GetArrayFromImage(sitk.ReadImage(path))
+            assert np.array_equal(crop_whole_body.read_nrrd_rows(path, 7, 19), expected[7:19]), path
+            assert np.array_equal(crop_whole_body.read_nrrd_rows(path, 25, 40), expected[25:]), path
+            chunks = list(crop_whole_body.iter_nrrd_rows(path, 3, 29, chunk_rows=8))
+            assert [len(chunk) for chunk in chunks] == [8, 8, 8, 2]
+            assert np.array_equal(np.concatenate(chunks), expected[3:29]), path
+
+
+def test_unhandled_fields_fall_back_to_simpleitk():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'skip.nrrd')
+        array = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+        with open(path, 'wb') as f:
+            f.write(b'NRRD0004\ntype: short\ndimension: 3\nsizes: 6 5 4\nendian: little\nencoding: raw\nbyte skip: 8\n\n')
+            f.write(b'\xff' * 8 + array.tobytes())
+        assert 'byte skip' in crop_whole_body.get_unhandled_layout(crop_whole_body.read_nrrd_header(path))
+        assert np.array_equal(crop_whole_body.read_nrrd_rows(path, 1, 3), array[1:3])
+
+
+def test_z_override_skips_segmentation_scan():
+    with tempfile.TemporaryDirectory() as directory:
+        ct = sitk.GetImageFromArray(np.zeros((40, 8, 10), dtype=np.int16))
+        sitk.WriteImage(ct, os.path.join(directory, 'ct.nrrd'))
+        sitk.WriteImage(sitk.Cast(ct, sitk.sitkUInt8), os.path.join(directory, 'seg.nrrd'))  # no annotation at all
+
+        get_annotated_slices = crop_whole_body.get_annotated_slices
+        crop_whole_body.get_annotated_slices = None  # fails if called
+        try:
+            crop_whole_body.process_scan(
+                os.path.join(directory, 'ct.nrrd'), os.path.join(directory, 'seg.nrrd'), 'scan', directory,
+                z_start_override=8, z_end_override=24,
+            )
+        finally:
+            crop_whole_body.get_annotated_slices = get_annotated_slices
+        left = sitk.ReadImage(os.path.join(directory, 'scan_first-leg', 'ct.nrrd'))
+        assert left.GetSize() == (5, 8, 16) and left.GetOrigin()[2] == 8.
+
+
+if __name__ == '__main__':
+    test_rows_match_simpleitk()
+    test_unhandled_fields_fall_back_to_simpleitk()
+    test_z_override_skips_segmentation_scan()
+    print('ok')